@@ -0,0 +1,14 @@
+"""
+URL configuration for hot_path.py. Unlike django_elect.tests.urls, this
+includes the admin, which the statistics template links to.
+"""
+from django.conf.urls import patterns, url, include
+from django.contrib import admin
+from django.http import HttpResponse
+
+
+urlpatterns = patterns('',
+    url(r'^account/', lambda request: HttpResponse("LOGIN")),
+    url(r'^admin/', include(admin.site.urls)),
+    url(r'^election/', include('django_elect.urls')),
+)
@@ -0,0 +1,166 @@
+"""
+Helpers shared by the benchmark scripts: configuring Django for a throwaway
+database and generating synthetic elections.
+"""
+import os
+import sys
+import random
+import tempfile
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import django
+from django.conf import settings
+
+
+def add_database_options(parser):
+    """
+    Adds options for choosing the database to benchmark against to the given
+    OptionParser. A temporary SQLite database is used by default.
+    """
+    parser.add_option('--db-engine', default='sqlite3', dest='db_engine',
+        help="sqlite3, postgresql_psycopg2 or mysql")
+    parser.add_option('--db-name', default='election', dest='db_name',
+        help="Name of the database. The benchmark creates and destroys a "
+             "test database with 'test_' prepended to this.")
+    parser.add_option('--db-user', default='', dest='db_user')
+    parser.add_option('--db-password', default='', dest='db_password')
+    parser.add_option('--db-host', default='', dest='db_host')
+
+
+def configure(options, **extra_settings):
+    """
+    Configures Django using the database options added by
+    add_database_options(), unless DJANGO_SETTINGS_MODULE is set.
+    """
+    if not settings.configured and \
+       not os.environ.get('DJANGO_SETTINGS_MODULE'):
+        database = {
+            "ENGINE": 'django.db.backends.' + options.db_engine,
+            "NAME": options.db_name,
+            "USER": options.db_user,
+            "PASSWORD": options.db_password,
+            "HOST": options.db_host,
+        }
+        if options.db_engine == 'sqlite3':
+            # use a file, so the database can be shared with forked processes
+            database['TEST'] = {
+                'NAME': os.path.join(tempfile.mkdtemp(), 'benchmark.db'),
+            }
+        config = dict(
+            DATABASES = {'default': database},
+            INSTALLED_APPS = [
+                'django.contrib.auth',
+                'django.contrib.contenttypes',
+                'django_elect',
+            ],
+            DEBUG = False,
+            SECRET_KEY = 'benchmark',
+        )
+        config.update(extra_settings)
+        settings.configure(**config)
+    django.setup()
+
+
+def create_test_database():
+    """
+    Creates and migrates the test database and returns the name of the
+    original database, to pass to destroy_test_database().
+    """
+    from django.db import connection
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    return old_name
+
+
+def destroy_test_database(old_name):
+    from django.db import connection
+    connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def create_election(voters, ballots=2, candidates=10, preferential=0.5,
+                    secret=0.0, voted=1.0, seed=0):
+    """
+    Creates an election with the given number of voters (all of which are
+    in allowed_voters) and ballots, each with the given number of
+    candidates. "preferential" and "secret" are the shares of the ballots
+    that are preferential and secret, and "voted" is the share of the voters
+    that have already voted. Every voter's password is "voter".
+    """
+    from datetime import datetime, timedelta
+    from django.apps import apps
+    from django.contrib.auth.hashers import make_password
+    from django.core.management import call_command
+    from django_elect import settings as elect_settings
+    from django_elect.account_search import get_backend
+    from django_elect.models import Election, Candidate, Vote, \
+        VotePlurality, VotePreferential, normalize_name
+
+    rand = random.Random(seed)
+    user_model = apps.get_model(elect_settings.DJANGO_ELECT_USER_MODEL)
+    password = make_password("voter")
+    user_model.objects.bulk_create([
+        user_model(username="voter%i" % i, password=password,
+                   first_name="First%i" % i, last_name="Last%i" % i)
+        for i in range(voters)], batch_size=500)
+    # bulk_create() doesn't send the signals that index accounts for search
+    get_backend().rebuild()
+    voter_ids = list(user_model.objects.filter(username__startswith="voter")
+                                       .order_by('pk')
+                                       .values_list('pk', flat=True))
+
+    now = datetime.now()
+    election = Election.objects.create(name="Benchmark %i" % seed,
+        vote_start=now - timedelta(days=1), vote_end=now + timedelta(days=1))
+    through = Election.allowed_voters.through
+    field = Election._meta.get_field('allowed_voters')
+    through.objects.bulk_create([
+        through(**{field.m2m_field_name(): election,
+                   field.m2m_reverse_field_name() + '_id': pk})
+        for pk in voter_ids], batch_size=500)
+
+    num_preferential = int(round(ballots * preferential))
+    num_secret = int(round(ballots * secret))
+    ballot_objects = []
+    for i in range(ballots):
+        ballot = election.ballots.create(position_number=i,
+            description="Ballot %i" % i,
+            type=i < num_preferential and "Pr" or "Pl",
+            is_secret=i < num_secret,
+            seats_available=min(3, candidates))
+        Candidate.objects.bulk_create([
+            Candidate(ballot=ballot, first_name="Candidate",
+                      last_name="%i-%i" % (i, j),
+                      institution="University %i" % j,
+                      biography=j % 2 and "Biography %i" % j or "",
+                      # bulk_create() doesn't call save(), which sets this
+                      search_key=normalize_name("Candidate",
+                                                "%i-%i" % (i, j)))
+            for j in range(candidates)], batch_size=500)
+        ballot_objects.append((ballot,
+            list(ballot.candidates.values_list('pk', flat=True))))
+
+    Vote.objects.bulk_create([Vote(election=election, account_id=pk)
+                              for pk in voter_ids[:int(voters * voted)]],
+                             batch_size=500)
+    pluralities, preferentials = [], []
+    for vote_id in election.votes.values_list('pk', flat=True):
+        for ballot, candidate_ids in ballot_objects:
+            chosen = rand.sample(candidate_ids, ballot.seats_available)
+            selection_vote_id = not ballot.is_secret and vote_id or None
+            for rank, candidate_id in enumerate(chosen):
+                if ballot.type == "Pl":
+                    pluralities.append(VotePlurality(
+                        vote_id=selection_vote_id, candidate_id=candidate_id))
+                else:
+                    preferentials.append(VotePreferential(
+                        vote_id=selection_vote_id, candidate_id=candidate_id,
+                        point=len(candidate_ids) - rank))
+    VotePlurality.objects.bulk_create(pluralities, batch_size=500)
+    VotePreferential.objects.bulk_create(preferentials, batch_size=500)
+
+    # bulk_create() bypasses the signals that maintain the tallies
+    with open(os.devnull, 'w') as devnull:
+        call_command('rebuild_tallies', stdout=devnull)
+    return election
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+Benchmarks the views used on and around election day against a synthetic
+election, measuring queries per request, p50/p99 latency and peak memory
+for each endpoint. The results are written as JSON, so the reports of two
+releases can be diffed, or compared with --compare.
+
+Each endpoint is run in a forked process, so its memory usage isn't
+inflated by the endpoints before it.
+"""
+import os
+import json
+import time
+import random
+import resource
+from datetime import datetime
+from optparse import OptionParser
+
+import common
+
+
+def percentile(values, percent):
+    """
+    Returns the given percentile of values using the nearest-rank method.
+    """
+    values = sorted(values)
+    index = max(0, int(round(percent / 100.0 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def get_vote_data(election, rand):
+    """
+    Returns POST data for the vote() view filling in every ballot of the
+    given election.
+    """
+    data = {}
+    for ballot in election.ballots.all():
+        prefix = "ballot%i-" % ballot.pk
+        candidate_ids = list(ballot.candidates.filter(write_in=False)
+                                              .values_list('pk', flat=True))
+        chosen = rand.sample(candidate_ids,
+                             min(ballot.seats_available, len(candidate_ids)))
+        if ballot.type == "Pl":
+            for pk in chosen:
+                data[prefix + str(pk)] = "on"
+        else:
+            for pk in candidate_ids:
+                data[prefix + str(pk)] = "0"
+            for rank, pk in enumerate(chosen):
+                data[prefix + str(pk)] = str(len(candidate_ids) - rank)
+    return data
+
+
+def get_endpoints(election, staff, voters, rand):
+    """
+    Returns a list of (name, setup) tuples for the endpoints to benchmark.
+    setup() is called before each request, outside of the timed part, with
+    a test client, and returns a function making the request.
+    """
+    election_id = election.pk
+
+    def login(client, username):
+        client.logout()
+        client.login(username=username, password="voter")
+
+    def get(url, user=None, **params):
+        def setup(client):
+            if user and not client.session.get('_auth_user_id'):
+                login(client, user.username)
+            return lambda: client.get(url, params)
+        return setup
+
+    def vote_post(client):
+        # every vote needs a voter that hasn't voted yet
+        login(client, voters.pop().username)
+        data = get_vote_data(election, rand)
+        return lambda: client.post("/election/", data)
+
+    forward = json.dumps({'election': election_id})
+    return [
+        ("vote GET", get("/election/", voters[0])),
+        ("vote POST", vote_post),
+        ("statistics", get("/election/statistics/%i" % election_id, staff)),
+        ("generate_spreadsheet",
+         get("/election/spreadsheet/%i" % election_id, staff)),
+        ("generate_csv", get("/election/csv/%i" % election_id, staff)),
+        ("biographies", get("/election/biographies")),
+        ("plurality autocomplete",
+         get("/election/vote-plurality-autocomplete/", staff, q="1",
+             forward=forward)),
+        ("preferential autocomplete",
+         get("/election/vote-preferential-autocomplete/", staff, q="1",
+             forward=forward)),
+        ("account autocomplete",
+         get("/election/account-autocomplete/", staff, q="first1")),
+    ]
+
+
+def run_endpoint(setup, iterations):
+    """
+    Makes the request returned by setup() the given number of times and
+    returns a dict of the measurements.
+    """
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+
+    client = Client()
+    timings, queries, statuses = [], [], set()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for i in range(iterations):
+        request = setup(client)
+        with CaptureQueriesContext(connection) as context:
+            start = time.time()
+            response = request()
+            if response.streaming:
+                # the body of streaming responses is generated lazily
+                for chunk in response.streaming_content:
+                    pass
+            timings.append(time.time() - start)
+        queries.append(len(context.captured_queries))
+        statuses.add(response.status_code)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'statuses': sorted(statuses),
+        'queries': percentile(queries, 50),
+        'max_queries': max(queries),
+        'p50_ms': round(percentile(timings, 50) * 1000, 3),
+        'p99_ms': round(percentile(timings, 99) * 1000, 3),
+        'peak_rss_kb': peak,
+        'rss_growth_kb': peak - baseline,
+    }
+
+
+def run_forked(setup, iterations):
+    """
+    Runs run_endpoint() in a child process and returns its result.
+    """
+    from django.db import connection
+    # the child must not share the parent's database connection
+    connection.close()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_fd)
+        try:
+            result = run_endpoint(setup, iterations)
+        except Exception as e:
+            result = {'error': "%s: %s" % (e.__class__.__name__, e)}
+        with os.fdopen(write_fd, 'w') as pipe:
+            json.dump(result, pipe)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        output = pipe.read()
+    os.waitpid(pid, 0)
+    return output and json.loads(output) or {'error': "child process died"}
+
+
+def compare(old_report, new_report):
+    """
+    Prints the change in each measurement between two reports.
+    """
+    keys = ['queries', 'p50_ms', 'p99_ms', 'peak_rss_kb']
+    print("\n%-26s %s" % ("Change", "".join("%16s" % k for k in keys)))
+    for name, new in sorted(new_report['results'].items()):
+        old = old_report['results'].get(name)
+        if not old or 'error' in old or 'error' in new:
+            continue
+        changes = []
+        for key in keys:
+            if old[key]:
+                changes.append("%+15.1f%%" %
+                               ((new[key] - old[key]) * 100.0 / old[key]))
+            else:
+                changes.append("%16s" % "n/a")
+        print("%-26s %s" % (name, "".join(changes)))
+
+
+def main(options):
+    common.configure(options,
+        INSTALLED_APPS = [
+            'dal',
+            'dal_select2',
+            'django.contrib.auth',
+            'django.contrib.admin',
+            'django.contrib.contenttypes',
+            'django.contrib.sessions',
+            'django.contrib.staticfiles',
+            'django_elect',
+        ],
+        MIDDLEWARE_CLASSES = (
+            'django.contrib.sessions.middleware.SessionMiddleware',
+            'django.contrib.auth.middleware.AuthenticationMiddleware',
+        ),
+        # hashing passwords properly would dominate the setup time
+        PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'],
+        ROOT_URLCONF = 'benchmark_urls',
+        STATIC_URL = '/static/',
+        LOGIN_URL = '/account/',
+        ALLOWED_HOSTS = ['testserver'],
+    )
+    import django
+    from django.apps import apps
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    from django_elect import settings as elect_settings
+
+    setup_test_environment()
+    old_name = common.create_test_database()
+    try:
+        print("Creating election with %i voters, %i ballots and %i "
+              "candidates per ballot..." % (options.voters, options.ballots,
+                                            options.candidates))
+        # leave enough voters who haven't voted yet for the POST benchmark
+        unvoted = min(options.voters, options.iterations + 1)
+        election = common.create_election(options.voters,
+            ballots=options.ballots, candidates=options.candidates,
+            preferential=options.preferential, secret=options.secret,
+            voted=1 - float(unvoted) / options.voters, seed=options.seed)
+        user_model = apps.get_model(elect_settings.DJANGO_ELECT_USER_MODEL)
+        staff = user_model.objects.create_superuser("staff",
+            "staff@example.com", "voter")
+        voters = list(user_model.objects.filter(username__startswith="voter")
+                                        .exclude(vote__election=election)
+                                        .order_by('-pk'))
+
+        rand = random.Random(options.seed)
+        results = {}
+        for name, setup in get_endpoints(election, staff, voters, rand):
+            if options.only and name not in options.only:
+                continue
+            results[name] = run_forked(setup, options.iterations)
+            # the child's votes don't use up the parent's copy of the voters
+            if name == "vote POST":
+                del voters[-options.iterations:]
+            print_result(name, results[name])
+
+        report = {
+            'meta': {
+                'date': datetime.now().isoformat(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'voters': options.voters,
+                'ballots': options.ballots,
+                'candidates': options.candidates,
+                'preferential': options.preferential,
+                'secret': options.secret,
+                'iterations': options.iterations,
+                'seed': options.seed,
+            },
+            'results': results,
+        }
+    finally:
+        common.destroy_test_database(old_name)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print("\nWrote report to %s" % options.output)
+    if options.compare:
+        with open(options.compare) as f:
+            compare(json.load(f), report)
+
+
+def print_result(name, result):
+    if 'error' in result:
+        print("%-26s %s" % (name, result['error']))
+    else:
+        print("%-26s %3i queries  p50 %8.2fms  p99 %8.2fms  %7i KB peak "
+              "RSS  status %s" % (name, result['queries'], result['p50_ms'],
+              result['p99_ms'], result['peak_rss_kb'],
+              "/".join(str(s) for s in result['statuses'])))
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('--voters', default=5000, type='int', dest='voters')
+    parser.add_option('--ballots', default=4, type='int', dest='ballots')
+    parser.add_option('--candidates', default=20, type='int',
+        dest='candidates', help="Number of candidates per ballot.")
+    parser.add_option('--preferential', default=0.5, type='float',
+        dest='preferential', help="Share of the ballots that are "
+                                  "preferential.")
+    parser.add_option('--secret', default=0.25, type='float', dest='secret',
+        help="Share of the ballots that are secret.")
+    parser.add_option('--iterations', default=50, type='int',
+        dest='iterations', help="Number of requests per endpoint.")
+    parser.add_option('--seed', default=0, type='int', dest='seed')
+    parser.add_option('--only', action='append', dest='only',
+        help="Only benchmark this endpoint. May be given more than once.")
+    parser.add_option('--output', dest='output',
+        help="File to write the JSON report to.")
+    parser.add_option('--compare', dest='compare',
+        help="JSON report of an earlier run to compare the results with.")
+    common.add_database_options(parser)
+
+    (options, args) = parser.parse_args()
+
+    main(options)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Shows the query plans and timings of the hot lookup paths before and after
+the indexes added in migration 0003_hot_path_indexes, using a large synthetic
+election.
+"""
+import timeit
+from optparse import OptionParser
+
+import common
+
+
+def get_queries(election):
+    """
+    Returns list of (description, queryset) tuples for the hot lookup paths.
+    """
+    from django.db.models import Count, Sum
+    from django_elect.models import Candidate, Vote, VotePlurality, \
+        VotePreferential
+
+    vote = election.votes.order_by('-pk')[0]
+    pl_ballot = election.ballots.filter(type="Pl")[0]
+    pr_ballot = election.ballots.filter(type="Pr")[0]
+    pl_candidate = pl_ballot.candidates.all()[0]
+    pr_candidate = pr_ballot.candidates.all()[0]
+    return [
+        ("has_voted", Vote.objects.filter(election=election,
+            account=vote.account_id).values('pk')[:1]),
+        ("ballot candidates", Candidate.objects.filter(ballot=pl_ballot,
+            write_in=False)),
+        ("plurality tally", VotePlurality.objects.filter(
+            candidate=pl_candidate).values('candidate')
+            .annotate(votes=Count('vote'))),
+        ("preferential tally", VotePreferential.objects.filter(
+            candidate=pr_candidate).values('candidate')
+            .annotate(points=Sum('point'))),
+    ]
+
+
+def explain(queryset):
+    from django.db import connection
+    sql, params = queryset.query.sql_with_params()
+    if connection.vendor == 'sqlite':
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        prefix = "EXPLAIN "
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    return [" ".join(unicode(col) for col in row) for row in cursor.fetchall()]
+
+
+def report(election, repeat):
+    for description, queryset in get_queries(election):
+        seconds = min(timeit.repeat(lambda: list(queryset.all()),
+                                    number=1, repeat=repeat))
+        print("  %s: %.2fms" % (description, seconds * 1000))
+        for line in explain(queryset):
+            print("    %s" % line)
+
+
+def set_indexes(enabled):
+    """
+    Drops or recreates the indexes added in migration 0003_hot_path_indexes.
+    """
+    from django.db import connection
+    from django.db.migrations.loader import MigrationLoader
+
+    # like migrations, use historical models, since the schema editor would
+    # otherwise rebind the real models' reverse relations to its temporary
+    # copy of the table
+    apps = MigrationLoader(connection).project_state().apps
+    indexes = [
+        ('Vote', 'unique_together', [('election', 'account')]),
+        ('Candidate', 'index_together', [('ballot', 'write_in')]),
+        ('VotePlurality', 'index_together', [('candidate', 'vote')]),
+        ('VotePreferential', 'index_together', [('candidate', 'point')]),
+    ]
+    with connection.schema_editor() as editor:
+        for model_name, kind, fields in indexes:
+            model = apps.get_model('django_elect', model_name)
+            old, new = enabled and ([], fields) or (fields, [])
+            getattr(editor, 'alter_' + kind)(model, old, new)
+
+
+def main(options):
+    common.configure(options)
+
+    old_name = common.create_test_database()
+    try:
+        print("Creating election with %i voters and %i candidates per "
+              "ballot..." % (options.voters, options.candidates))
+        election = common.create_election(options.voters, ballots=2,
+            candidates=options.candidates)
+
+        set_indexes(False)
+        print("\nWithout indexes:")
+        report(election, options.repeat)
+        set_indexes(True)
+        print("\nWith indexes:")
+        report(election, options.repeat)
+    finally:
+        common.destroy_test_database(old_name)
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('--voters', default=20000, type='int', dest='voters')
+    parser.add_option('--candidates', default=40, type='int',
+        dest='candidates')
+    parser.add_option('--repeat', default=5, type='int', dest='repeat')
+    common.add_database_options(parser)
+
+    (options, args) = parser.parse_args()
+
+    main(options)
@@ -0,0 +1,148 @@
+"""
+Backends for searching accounts, used by the account autocomplete in the
+admin. The backend is chosen with the DJANGO_ELECT_ACCOUNT_SEARCH_BACKEND
+setting.
+
+Results are returned a page at a time using keyset pagination: each page
+comes with a cursor that's passed to the next search, so later pages cost
+the same as the first one, however many accounts there are.
+"""
+from django.apps import apps
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from django_elect import settings
+from django_elect.models import AccountSearchKey, Election, normalize_text
+
+
+def get_user_model():
+    return apps.get_model(settings.DJANGO_ELECT_USER_MODEL)
+
+
+def get_backend():
+    """
+    Returns an instance of the backend named by the
+    DJANGO_ELECT_ACCOUNT_SEARCH_BACKEND setting.
+    """
+    return import_string(settings.DJANGO_ELECT_ACCOUNT_SEARCH_BACKEND)()
+
+
+class AccountSearchBackend(object):
+    """
+    Base class for account search backends.
+    """
+    def search(self, query, election=None, after=None, limit=20):
+        """
+        Returns a tuple (accounts, cursor), where accounts is a list of up to
+        limit accounts matching the given query, and cursor is passed as
+        after to get the accounts following them, or is None if there are
+        no more. Cursors must be JSON serializable. If the election with the
+        given primary key has allowed_voters, only those are searched.
+        """
+        raise NotImplementedError
+
+    def rebuild(self, batch_size=1000):
+        """
+        Rebuilds the backend's index from scratch, if it has one, and returns
+        the number of accounts indexed.
+        """
+        return 0
+
+    def get_accounts(self, election=None):
+        """
+        Returns a queryset of the accounts that can be searched, i.e. the
+        allowed_voters of the given election if it has any, or else all of
+        them.
+        """
+        accounts = get_user_model().objects.all()
+        if election and self.is_restricted(election):
+            accounts = accounts.filter(election=election)
+        return accounts
+
+    def is_restricted(self, election):
+        """
+        Returns True if the election with the given primary key has
+        allowed_voters.
+        """
+        return Election.allowed_voters.through.objects \
+                                              .filter(election=election) \
+                                              .exists()
+
+    def _search_by_pk(self, accounts, after, limit):
+        # keyset pagination on the primary key
+        if after:
+            accounts = accounts.filter(pk__gt=after)
+        accounts = list(accounts.order_by('pk')[:limit + 1])
+        if len(accounts) > limit:
+            return accounts[:limit], accounts[limit - 1].pk
+        return accounts, None
+
+
+class FilterBackend(AccountSearchBackend):
+    """
+    Searches the user table directly using the function in the
+    DJANGO_ELECT_USER_AUTOCOMPLETE_FILTER setting.
+    """
+    def search(self, query, election=None, after=None, limit=20):
+        accounts = self.get_accounts(election)
+        if query:
+            accounts = settings.DJANGO_ELECT_USER_AUTOCOMPLETE_FILTER(
+                accounts, query)
+        return self._search_by_pk(accounts, after, limit)
+
+
+class AccountNameBackend(AccountSearchBackend):
+    """
+    Matches the query against the beginning of any of the account's names,
+    ignoring case and accents, using the AccountSearchKey table.
+    """
+    def search(self, query, election=None, after=None, limit=20):
+        query = normalize_text(query)
+        if not query:
+            return self._search_by_pk(self.get_accounts(election), after,
+                                      limit)
+        matching = AccountSearchKey.objects.filter(key__startswith=query)
+        if election and self.is_restricted(election):
+            matching = matching.filter(account__election=election)
+        keys = matching
+        if after:
+            after_key, after_pk = after
+            keys = keys.filter(Q(key__gt=after_key) |
+                               Q(key=after_key, account__gt=after_pk))
+        rows = list(keys.order_by('key', 'account')
+                        .values_list('key', 'account')[:limit + 1])
+        cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            cursor = list(rows[-1])
+        # an account with several names starting with the query is only
+        # listed under the first of them, so it doesn't appear again on a
+        # later page
+        first_keys = {}
+        account_keys = matching.filter(account__in=[row[1] for row in rows])
+        for key, pk in account_keys.values_list('key', 'account'):
+            first_keys[pk] = min(key, first_keys.get(pk, key))
+        rows = [row for row in rows if row[0] == first_keys[row[1]]]
+        found = get_user_model().objects.in_bulk([row[1] for row in rows])
+        return [found[row[1]] for row in rows if row[1] in found], cursor
+
+    def update_accounts(self, accounts):
+        """
+        Called with accounts that were saved, to update their search keys.
+        """
+        AccountSearchKey.update_accounts(accounts)
+
+    def rebuild(self, batch_size=1000):
+        accounts = get_user_model().objects.only('first_name', 'last_name') \
+                                           .order_by('pk')
+        indexed, last_pk = 0, None
+        while True:
+            batch = accounts
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            batch = list(batch[:batch_size])
+            if not batch:
+                return indexed
+            AccountSearchKey.update_accounts(batch)
+            indexed += len(batch)
+            last_pk = batch[-1].pk
@@ -1,6 +1,8 @@
 from django.core.urlresolvers import reverse
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from django.http import HttpResponseRedirect
+from django.template.loader import render_to_string
 from django import forms
 
 from dal import autocomplete
@@ -19,10 +21,12 @@ class ElectionAdmin(admin.ModelAdmin):
     actions_html = """
         <a href="%s">View Statistics</a> |
         <a href="%s">Generate Excel Spreadsheet</a> |
+        <a href="%s">Download CSV</a> |
         <a href="%s/">Disassociate Accounts</a>
     """
     list_display = ('name', 'vote_start', 'vote_end', 'admin_actions')
     filter_horizontal = ("allowed_voters",)
+    prepopulated_fields = {"slug": ("name",)}
     inlines = [BallotInline]
 
     def admin_actions(self, obj):
@@ -30,6 +34,7 @@ class ElectionAdmin(admin.ModelAdmin):
         return self.actions_html % (
             reverse('django_elect_stats', kwargs=kwargs),
             reverse('django_elect_spreadsheet', kwargs=kwargs),
+            reverse('django_elect_csv', kwargs=kwargs),
             reverse('django_elect_disassociate', kwargs=kwargs),
         )
     admin_actions.short_description = "Administrative Actions"
@@ -93,17 +98,36 @@ class AdminVoteForm(forms.ModelForm):
         model = Vote
         fields = '__all__'
         widgets = {
-            'account': autocomplete.ModelSelect2(url='account-autocomplete'),
+            'account': autocomplete.ModelSelect2(forward=['election'],
+                url='account-autocomplete'),
         }
 
 
+class VoteChangeList(ChangeList):
+    def get_results(self, request):
+        super(VoteChangeList, self).get_results(request)
+        # load the selections of all the votes on the page at once
+        self.result_list = list(self.result_list)
+        Vote.prefetch_details(self.result_list)
+
+
 class VoteAdmin(admin.ModelAdmin):
     form = AdminVoteForm
-    list_display = ('election', 'account')
+    list_display = ('election', 'account', 'details')
     list_filter = ['election']
+    list_select_related = ('election', 'account')
     search_fields = ['account__first_name', 'account__last_name']
     inlines = [VotePreferentialInline, VotePluralityInline]
 
+    def get_changelist(self, request, **kwargs):
+        return VoteChangeList
+
+    def details(self, obj):
+        return render_to_string('django_elect/vote_details.html',
+                                {'vote': obj})
+    details.short_description = "Selections"
+    details.allow_tags = True
+
     class Media:
         js = ('django_elect/js/admin.js',)
 admin.site.register(Vote, VoteAdmin)
@@ -1,16 +1,76 @@
-from django.apps import apps
+import json
+import threading
+from collections import OrderedDict
+from hashlib import md5
+
 from django.contrib.admin.views.decorators import staff_member_required
-from django.db.models.functions import Concat
-from django.db.models import Value as V
 from django.utils.decorators import method_decorator
 
 from dal import autocomplete
 
-from django_elect import settings
-from django_elect.models import Candidate
+from django_elect import caching
+from django_elect.account_search import get_backend
+from django_elect.models import Ballot, Candidate, normalize_text
+
+
+# maximum number of ballots whose candidate names are kept in memory by each
+# process, and the maximum number of candidates a search returns
+NAME_CACHE_SIZE = 50
+MAX_MATCHES = 500
+
+# number of seconds to keep the cursors for the next pages of account
+# searches
+CURSOR_TIMEOUT = 15 * 60
+
+_names = OrderedDict()
+_names_lock = threading.Lock()
+
+
+def get_candidate_names(ballot_id):
+    """
+    Returns a list of (search key, candidate ID) tuples for the candidates on
+    the given ballot. The lists for recently used ballots are kept in memory
+    until one of the ballot's candidates changes.
+    """
+    version = caching.get_version("candidates", ballot_id)
+    with _names_lock:
+        cached = _names.pop(ballot_id, None)
+        if cached is not None and cached[0] == version:
+            _names[ballot_id] = cached
+            return cached[1]
+    names = list(Candidate.objects.filter(ballot=ballot_id)
+                                  .values_list('search_key', 'pk'))
+    with _names_lock:
+        _names[ballot_id] = (version, names)
+        while len(_names) > NAME_CACHE_SIZE:
+            _names.popitem(last=False)
+    return names
+
+
+def find_candidates(ballot_ids, query):
+    """
+    Returns the IDs of up to MAX_MATCHES candidates on the given ballots
+    whose name, or a word of whose name, starts with the given query.
+    """
+    key = normalize_text(query)
+    word = u" " + key
+    matches = []
+    for ballot_id in ballot_ids:
+        for name, pk in get_candidate_names(ballot_id):
+            if name.startswith(key) or word in name:
+                matches.append(pk)
+                if len(matches) >= MAX_MATCHES:
+                    return matches
+    return matches
 
 
 class CandidateAutocomplete(autocomplete.Select2QuerySetView):
+    """
+    Searches the candidates on ballots of the given type. When an election
+    is forwarded, the names of its candidates are searched in memory, so
+    any word of a name can be matched. Otherwise, only the beginning of the
+    full name is matched, using the index on Candidate.search_key.
+    """
     ballot_type = None
 
     @method_decorator(staff_member_required)
@@ -21,30 +81,58 @@ class CandidateAutocomplete(autocomplete.Select2QuerySetView):
         if not self.ballot_type:
             raise "Ballot type not specified"
 
-        qs = Candidate.objects.annotate(
-            full_name=Concat('first_name', V(' '), 'last_name'),
-        ).filter(ballot__type=self.ballot_type)
+        qs = Candidate.objects.filter(ballot__type=self.ballot_type)
 
         election = self.forwarded.get('election', None)
         if election:
             qs = qs.filter(ballot__election=election)
 
-        if self.q:
-            qs = qs.filter(full_name__icontains=self.q)
+        if self.q and election:
+            ballot_ids = Ballot.objects.filter(election=election,
+                type=self.ballot_type).values_list('pk', flat=True)
+            qs = qs.filter(pk__in=find_candidates(ballot_ids, self.q))
+        elif self.q:
+            qs = qs.filter(search_key__startswith=normalize_text(self.q))
 
         return qs
 
 
 class AccountAutocomplete(autocomplete.Select2QuerySetView):
+    """
+    Searches accounts with the backend from django_elect.account_search,
+    restricted to the allowed_voters of the forwarded election, if any.
+    Select2 only sends the page number, so the backend's cursor for the
+    next page is kept in the cache.
+    """
     @method_decorator(staff_member_required)
     def dispatch(self, *args, **kwargs):
         return super(AccountAutocomplete, self).dispatch(*args, **kwargs)
 
-    def get_queryset(self):
-        user_model = apps.get_model(settings.DJANGO_ELECT_USER_MODEL)
-        qs = user_model.objects.all()
-
-        if self.q:
-            qs = settings.DJANGO_ELECT_USER_AUTOCOMPLETE_FILTER(qs, self.q)
+    def get(self, request, *args, **kwargs):
+        election = self.forwarded.get('election', None)
+        try:
+            page = max(1, int(request.GET.get('page', 1)))
+        except ValueError:
+            page = 1
+        search = md5(json.dumps([request.user.pk, self.q, election])
+                     .encode('utf-8')).hexdigest()
+        cache = caching.get_cache()
+        after = None
+        if page > 1:
+            after = cache.get("django_elect:account_search:%s:%i" %
+                              (search, page))
+            if after is None:
+                # the cursor expired, or the page was requested out of order
+                return self.render_to_response({'object_list': []})
+        accounts, cursor = get_backend().search(self.q, election=election,
+            after=after, limit=self.paginate_by)
+        if cursor is not None:
+            cache.set("django_elect:account_search:%s:%i" % (search, page + 1),
+                      cursor, CURSOR_TIMEOUT)
+        return self.render_to_response({
+            'object_list': accounts,
+            'more': cursor is not None,
+        })
 
-        return qs
+    def has_more(self, context):
+        return context.get('more', False)
@@ -0,0 +1,268 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.signals import request_finished
+from django.db import connection
+from django.dispatch import receiver
+
+from django_elect import settings
+
+
+# invalidations to repeat once the current transaction has been committed
+_pending = threading.local()
+
+
+def get_cache():
+    """Returns the cache used by django_elect."""
+    return caches[settings.DJANGO_ELECT_CACHE]
+
+
+def _invalidate_after_commit(func, *args):
+    """
+    Calls func(*args), which invalidates cached data, and if a transaction
+    is in progress, calls it again once the transaction has been committed.
+    Otherwise a request that read the old data between the invalidation and
+    the commit could cache it again. Django 1.8 has no on-commit hooks, so
+    this is done at the end of the request, or by
+    run_pending_invalidations() after the transaction.
+    """
+    func(*args)
+    if connection.in_atomic_block:
+        if not hasattr(_pending, 'calls'):
+            _pending.calls = set()
+        _pending.calls.add((func, args))
+
+
+def run_pending_invalidations(force=False):
+    """
+    Repeats the invalidations done during the transaction that was just
+    committed. Does nothing while a transaction is still in progress,
+    unless force is True.
+    """
+    if connection.in_atomic_block and not force:
+        return
+    calls = getattr(_pending, 'calls', None)
+    while calls:
+        func, args = calls.pop()
+        func(*args)
+
+
+@receiver(request_finished)
+def _request_finished(**kwargs):
+    # any transaction started by the request has ended by now
+    run_pending_invalidations(force=True)
+
+
+@checks.register()
+def check_cache(app_configs, **kwargs):
+    """
+    Warns if DJANGO_ELECT_CACHE isn't shared between processes. The version
+    stamps that invalidate cached data and ETags are kept in it, so with a
+    per-process cache a change made by one process isn't seen by the others,
+    which keep serving stale pages and answering conditional requests with
+    304 Not Modified.
+    """
+    if not isinstance(get_cache(), (LocMemCache, DummyCache)):
+        return []
+    return [checks.Warning(
+        "DJANGO_ELECT_CACHE (%r) isn't shared between processes."
+        % settings.DJANGO_ELECT_CACHE,
+        hint="Use a shared cache such as memcached or the database cache, "
+             "unless the site is served by a single process.",
+        obj=settings.DJANGO_ELECT_CACHE,
+        id='django_elect.W001',
+    )]
+
+
+def get_version(namespace, pk):
+    """
+    Returns the current version of the given namespace (e.g. "eligibility")
+    for the object with the given primary key. Cache keys that include the
+    version are invalidated all at once by calling bump_version().
+    """
+    cache = get_cache()
+    key = "django_elect:%s:%s:version" % (namespace, pk)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(namespace, pk):
+    """
+    Changes the version of the given namespace for the object with the given
+    primary key, invalidating all cache keys that include it.
+    """
+    key = "django_elect:%s:%s:version" % (namespace, pk)
+    get_cache().set(key, uuid4().hex, None)
+
+
+def get_election_version(election_id):
+    """
+    Returns a stamp that changes whenever the votes, ballots or candidates
+    of the election with the given primary key change, e.g. for ETags.
+    """
+    return get_version("election", election_id)
+
+
+def invalidate_election(election_id):
+    """
+    Changes the version stamp of the election with the given primary key.
+    This is repeated after the current transaction is committed, so the old
+    content can't be served under the new stamp.
+    """
+    _invalidate_after_commit(bump_version, "election", election_id)
+
+
+def invalidate_ballot(ballot_id):
+    """
+    Invalidates the cached table of the ballot with the given primary key on
+    the voting page. This is repeated after the current transaction is
+    committed.
+    """
+    _invalidate_after_commit(bump_version, "ballot", ballot_id)
+
+
+def invalidate_biographies(election_id):
+    """
+    Invalidates the cached biographies page of the election with the given
+    primary key. This is repeated after the current transaction is
+    committed.
+    """
+    _invalidate_after_commit(bump_version, "biographies", election_id)
+
+
+def invalidate_candidates(ballot_id):
+    """
+    Invalidates the candidate names of the ballot with the given primary key
+    that the autocomplete keeps in each process. This is repeated after the
+    current transaction is committed.
+    """
+    _invalidate_after_commit(bump_version, "candidates", ballot_id)
+
+
+# maximum number of elections kept in memory by each process
+ELECTION_CACHE_SIZE = 20
+
+# the elections last read from the cache by this process, keyed by slug (None
+# for the latest election), in the form (cache key, expiry time, election)
+_current_elections = OrderedDict()
+_current_elections_lock = threading.Lock()
+
+
+def get_current_election(slug=None):
+    """
+    Returns Election.get_latest_prefetched(slug), which is kept in the cache
+    and in each process until an election, ballot or candidate changes, or
+    voting in the election starts or ends. Returns None if there is no such
+    election, which isn't cached, so unknown slugs can't fill the cache.
+    """
+    key = "django_elect:current_election:%s:%s" % (
+        get_version("current_election", "latest"), slug or "")
+    now = datetime.now()
+    with _current_elections_lock:
+        local = _current_elections.pop(slug, None)
+        if local is not None and local[0] == key and local[1] > now:
+            _current_elections[slug] = local
+            return local[2]
+    cache = get_cache()
+    cached = cache.get(key)
+    if cached is None or cached[0] <= now:
+        from django_elect.models import Election
+        election = Election.get_latest_prefetched(slug)
+        if election is None:
+            return None
+        expires = min([now + timedelta(
+            seconds=settings.DJANGO_ELECT_ELECTION_CACHE_TIMEOUT)] +
+            [boundary for boundary in (election.vote_start, election.vote_end)
+             if boundary > now])
+        cached = (expires, election)
+        cache.set(key, cached,
+                  max(1, int((expires - now).total_seconds()) + 1))
+    with _current_elections_lock:
+        _current_elections[slug] = (key,) + cached
+        while len(_current_elections) > ELECTION_CACHE_SIZE:
+            _current_elections.popitem(last=False)
+    return cached[1]
+
+
+def invalidate_current_election():
+    """
+    Makes get_current_election() read the elections again. This is repeated
+    after the current transaction is committed.
+    """
+    _invalidate_after_commit(bump_version, "current_election", "latest")
+
+
+def _eligibility_key(election_id, account_id):
+    return "django_elect:eligibility:%s:%s:%s" % (election_id,
+        get_version("eligibility", election_id), account_id)
+
+
+def get_eligibility(election, user):
+    """
+    Cached version of Election.get_eligibility().
+    """
+    cache = get_cache()
+    key = _eligibility_key(election.pk, user.pk)
+    eligibility = cache.get(key)
+    if eligibility is None:
+        eligibility = election.get_eligibility(user)
+        cache.set(key, eligibility,
+                  settings.DJANGO_ELECT_ELIGIBILITY_CACHE_TIMEOUT)
+    return eligibility
+
+
+def invalidate_eligibility(election_id, account_id=None):
+    """
+    Invalidates the cached eligibility of the given account in the given
+    election, or of all accounts if account_id is None. This is repeated
+    after the current transaction is committed.
+    """
+    _invalidate_after_commit(_invalidate_eligibility, election_id,
+                             account_id)
+
+
+def _invalidate_eligibility(election_id, account_id):
+    if account_id is None:
+        bump_version("eligibility", election_id)
+    else:
+        get_cache().delete(_eligibility_key(election_id, account_id))
+
+
+def get_job_status(name, pk):
+    """
+    Returns the dictionary last stored with set_job_status() for the given
+    job, or None if it hasn't been run or its status has expired.
+    """
+    return get_cache().get("django_elect:job:%s:%s" % (name, pk))
+
+
+def set_job_status(name, pk, timeout, **status):
+    """
+    Stores the status of a job, e.g. the disassociation of accounts for the
+    election with the given primary key, for the given number of seconds.
+    """
+    get_cache().set("django_elect:job:%s:%s" % (name, pk), status, timeout)
+
+
+def acquire_lock(name, pk, timeout):
+    """
+    Returns True if the lock with the given name for the object with the
+    given primary key was acquired, or False if it's held by someone else.
+    The lock expires after the given number of seconds in case its holder
+    dies without releasing it.
+    """
+    return get_cache().add("django_elect:lock:%s:%s" % (name, pk), True,
+                           timeout)
+
+
+def release_lock(name, pk):
+    get_cache().delete("django_elect:lock:%s:%s" % (name, pk))
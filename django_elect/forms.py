@@ -1,51 +1,39 @@
 from string import Template
 
 from django import forms
-from django.conf import settings
+from django.conf import settings as django_settings
 from django.core.urlresolvers import reverse
+from django.db import transaction
 from django.utils.http import urlquote
 from django.utils.safestring import mark_safe
 
-from django_elect.models import Candidate, VotePlurality, VotePreferential
+from django_elect import caching, settings
+from django_elect.instrumentation import timed
+from django_elect.models import Candidate, CandidateTally, VotePlurality, \
+    VotePreferential
 
 
 class CandidateRowWidget(forms.Widget):
     """
     Form widget for showing a table row with information on a single candidate.
     """
-    def __init__(self, candidate, form_widget, template, *args, **kwargs):
+    def __init__(self, candidate, form_widget, row, *args, **kwargs):
         """
-        "candidate" is the Candidate to show, and "form_widget" is the form
-        input to show next to the candidate's name
+        "candidate" is the Candidate to show, "form_widget" is the form
+        input to show next to the candidate's name, and "row" is a tuple of
+        the HTML to show before and after the form input
         """
         super(CandidateRowWidget, self).__init__(*args, **kwargs)
         self.candidate = candidate
         self.form_widget = form_widget
-        self.template = template
+        self.row = row
 
     def value_from_datadict(self, data, files, name):
         return self.form_widget.value_from_datadict(data, files, name)
 
     def render(self, name, value, attrs=None):
-        candidate_name = self.candidate.get_name()
-        if self.candidate.biography:
-            # make candidate's name a link to the appropriate anchor
-            # on the auto-generated biographies page
-            candidate_name = '<a target="_blank" href="%s/#%s">%s</a>' % (
-                reverse('django_elect_biographies'),
-                urlquote(candidate_name),
-                candidate_name,
-            )
         select = self.form_widget.render(name, value, attrs)
-        photo_unavailable = settings.STATIC_URL + \
-                            "django_elect/img/photo_unavailable.gif"
-        return mark_safe(self.template.substitute({
-            'select': select,
-            'incum': self.candidate.incumbent and "*" or "",
-            'name': candidate_name,
-            'inst': self.candidate.institution or "N/A",
-            'image': self.candidate.image_url or photo_unavailable,
-        }))
+        return mark_safe(self.row[0] + select + self.row[1])
 
 
 class BaseVoteForm(forms.Form):
@@ -53,14 +41,26 @@ class BaseVoteForm(forms.Form):
     Base class for representing the form for a single ballot
     """
     ballot = None
+    candidates = None
     candidate_list = None
+    write_in = None
+    write_in_candidate = None
+    table_info = None
+    selection_model = None
 
     def __init__(self, ballot, *args, **kwargs):
         super(BaseVoteForm, self).__init__(*args, **kwargs)
         self.ballot = ballot
-
+        # filter in Python so candidates prefetched with
+        # prefetch_related('candidates') don't cause another query
+        self.candidates = [c for c in ballot.candidates.all()
+                           if not c.write_in]
+        self.candidate_map = dict((c.pk, c) for c in self.candidates)
+        self.table_info = self.get_table_info()
+
+    @timed("ballot_form")
     def __unicode__(self):
-        output = ['<table class="ballot">', self.get_table_info()['header']]
+        output = ['<table class="ballot">', self.table_info['header']]
         for name, field in self.fields.items():
             bf = forms.forms.BoundField(self, field, name)
             output.append(unicode(bf))
@@ -71,20 +71,36 @@ class BaseVoteForm(forms.Form):
         """
         Returns True if this form is valid and contains at least one candidate
         """
-        return self.is_valid() and len(self.candidate_list) >= 1
+        return self.is_valid() and \
+            (len(self.candidate_list) >= 1 or bool(self.write_in))
 
     def get_table_info(self):
         """
         Returns the string to use for constructing the ballot table's header
-        row and a Template object to use for each body row.
+        row and a dictionary mapping the ID of each candidate to the HTML to
+        show before and after the candidate's form input.
 
         This is done dynamically so that the columns for "candidate image" and
         "candiate institution" are ommitted if no candidates in the ballot have
-        a image or institution defined.
+        a image or institution defined. The result is cached until the ballot
+        or one of its candidates is changed, or the election's slug (which is
+        in the links to the biographies) is.
         """
-        candidates = self.ballot.candidates.filter(write_in=False)
-        has_image = any([c.image_url for c in candidates])
-        has_institution = any([c.institution for c in candidates])
+        cache = caching.get_cache()
+        key = "django_elect:ballot_table:%s:%s:%s" % (self.ballot.pk,
+            caching.get_version("ballot", self.ballot.pk),
+            self.ballot.election.slug)
+        table_info = cache.get(key)
+        if table_info is None or \
+           set(table_info['rows']) != set(self.candidate_map):
+            table_info = self._build_table_info()
+            cache.set(key, table_info,
+                      settings.DJANGO_ELECT_BALLOT_CACHE_TIMEOUT)
+        return table_info
+
+    def _build_table_info(self):
+        has_image = any([c.image_url for c in self.candidates])
+        has_institution = any([c.institution for c in self.candidates])
         header_cols = """
             <col class="ballot-col-select" />
             <col class="ballot-col-name" />"""
@@ -92,9 +108,10 @@ class BaseVoteForm(forms.Form):
             <tr>
                 <th>&nbsp;</th>
                 <th>Name</th>"""
-        row_template = """
+        row_start = """
             <tr class="candidate-row">
-                <td>$select</td>
+                <td>"""
+        row_template = """</td>
                 <td>$incum$name</td>"""
         if has_institution:
             row_template += "<td>$inst</td>"
@@ -106,9 +123,32 @@ class BaseVoteForm(forms.Form):
             header += '<th>Picture</th>'
         row_template += '</tr>'
         header += '</tr>'
+
+        row_template = Template(row_template)
+        biographies_url = reverse('django_elect_election_biographies',
+                                  kwargs={'slug': self.ballot.election.slug})
+        photo_unavailable = django_settings.STATIC_URL + \
+                            "django_elect/img/photo_unavailable.gif"
+        rows = {}
+        for candidate in self.candidates:
+            candidate_name = candidate.get_name()
+            if candidate.biography:
+                # make candidate's name a link to the appropriate anchor
+                # on the auto-generated biographies page
+                candidate_name = '<a target="_blank" href="%s/#%s">%s</a>' % (
+                    biographies_url,
+                    urlquote(candidate_name),
+                    candidate_name,
+                )
+            rows[candidate.pk] = (row_start, row_template.substitute({
+                'incum': candidate.incumbent and "*" or "",
+                'name': candidate_name,
+                'inst': candidate.institution or "N/A",
+                'image': candidate.image_url or photo_unavailable,
+            }))
         return {
             'header': header_cols + header,
-            'row_template': Template(row_template),
+            'rows': rows,
         }
 
     def save(self, vote):
@@ -117,27 +157,46 @@ class BaseVoteForm(forms.Form):
         them with the given Vote object, unless the associated ballot
         is secret.
         """
-        if self.ballot.is_secret:
-            vote = None
-        return self._do_save(vote)
+        with transaction.atomic():
+            selections = self.get_selections(vote)
+            self.selection_model.objects.bulk_create(selections)
+            CandidateTally.add_selections(selections)
 
-    def _do_save(self, vote):
+    def get_record(self):
         """
-        Must be implemented by sub-classes to save VotePreferential and
-        VotePlurality objects
+        Returns the choices on this (valid) form as a dictionary that can be
+        serialized, for storing the vote later (see django_elect.spool).
+        """
+        return {
+            'ballot': self.ballot.pk,
+            'candidates': self._get_choices(),
+            'write_in': self.write_in,
+        }
+
+    def _get_choices(self):
+        """
+        Must be implemented by sub-classes to return a list of
+        (candidate ID, points) tuples for the selected candidates
         """
         raise NotImplementedError
 
-    def get_write_in_candidate(self, write_in):
+    def get_selections(self, vote):
+        """
+        Returns list of unsaved selection objects (i.e. instances of
+        selection_model) for each candidate choice. The selections won't be
+        associated with the given Vote object if the ballot is secret.
+        """
+        resolve_write_ins([self])
+        if self.ballot.is_secret:
+            vote = None
+        return self._build_selections(vote)
+
+    def _build_selections(self, vote):
         """
-        Returns write-in candidate corresponding to given dictionary if this
-        ballot has been marked to accept write-in candidates, else returns None
+        Must be implemented by sub-classes to build VotePreferential and
+        VotePlurality objects
         """
-        if not self.ballot.write_in_available or not write_in:
-            return None
-        return Candidate.objects.get_or_create(ballot=self.ballot,
-            write_in=True, first_name=write_in['first_name'],
-            last_name=write_in['last_name'], incumbent=False)[0]
+        raise NotImplementedError
 
 
 class WriteInField(forms.MultiValueField):
@@ -173,17 +232,19 @@ class PluralityVoteForm(BaseVoteForm):
     """
     Extends BaseVoteForm to implement the vote form for plurality ballots.
     """
+    selection_model = VotePlurality
+
     def __init__(self, *args, **kwargs):
         super(PluralityVoteForm, self).__init__(*args, **kwargs)
-        template = self.get_table_info()['row_template']
-        candidates = self.ballot.candidates.filter(write_in=False)
+        rows = self.table_info['rows']
         if self.ballot.seats_available == 1 and \
             not self.ballot.write_in_available:
             select = self.RadioWidget(self.ballot.pk)
         else:
             select = forms.CheckboxInput()
-        for candidate in candidates:
-            widget = CandidateRowWidget(candidate, select, template)
+        for candidate in self.candidates:
+            widget = CandidateRowWidget(candidate, select,
+                                        rows[candidate.pk])
             self.fields[candidate.pk] = forms.BooleanField(label="",
                 widget=widget, required=False)
         if self.ballot.write_in_available:
@@ -233,42 +294,48 @@ class PluralityVoteForm(BaseVoteForm):
 
     def clean(self):
         clean = super(PluralityVoteForm, self).clean()
-        candidates = [cand for cand, selected in clean.items()
-                      if selected and isinstance(cand, long)]
-        self.candidate_list = Candidate.objects.in_bulk(candidates).values()
+        self.candidate_list = [self.candidate_map[cand]
+                               for cand, selected in clean.items()
+                               if selected and cand in self.candidate_map]
         seats = self.ballot.seats_available
         write_in = clean.get('write_in')
         if (len(self.candidate_list) + (write_in and 1 or 0)) > seats:
             message = 'Please select %i or fewer candidates.' % (seats)
             raise forms.ValidationError(message)
-
-        if write_in:
-            self.candidate_list.append(self.get_write_in_candidate(write_in))
+        self.write_in = write_in
         return clean
 
-    def _do_save(self, vote):
-        for candidate in self.candidate_list:
-            VotePlurality(vote=vote, candidate=candidate).save()
+    def _get_choices(self):
+        return [(candidate.pk, None) for candidate in self.candidate_list]
+
+    def _build_selections(self, vote):
+        candidates = list(self.candidate_list)
+        if self.write_in_candidate:
+            candidates.append(self.write_in_candidate)
+        return [VotePlurality(vote=vote, candidate=candidate)
+                for candidate in candidates]
 
 
 class PreferentialVoteForm(BaseVoteForm):
     """
     Extends BaseVoteForm to implement the vote form for preferential ballots.
     """
+    selection_model = VotePreferential
+
     def __init__(self, *args, **kwargs):
         super(PreferentialVoteForm, self).__init__(*args, **kwargs)
-        template = self.get_table_info()['row_template']
-        candidates = self.ballot.candidates.filter(write_in=False)
+        rows = self.table_info['rows']
         #we use the Borda count method for preferential ballots, so each
         #candidate select box should have options in the format
         #[(0, 0), (1, 3), (2, 2), (3, 1)]
         point_options = [(0, 0)]
-        points = range(1, candidates.count() + 1)
+        points = range(1, len(self.candidates) + 1)
         point_options += zip(points[::-1], points)
         select = forms.Select(choices=point_options,
             attrs={'style': 'width: 40px'})
-        for candidate in candidates:
-            widget = CandidateRowWidget(candidate, select, template)
+        for candidate in self.candidates:
+            widget = CandidateRowWidget(candidate, select,
+                                        rows[candidate.pk])
             self.fields[candidate.pk] = forms.ChoiceField(label="",
                 choices=point_options, widget=widget)
         if self.ballot.write_in_available:
@@ -283,8 +350,7 @@ class PreferentialVoteForm(BaseVoteForm):
             point_list.append(write_in['points'])
         message = ""
         # check that no point value exceeds the number of candidates
-        candidates = self.ballot.candidates.filter(write_in=False)
-        num = candidates.count()
+        num = len(self.candidates)
         if point_list and filter(lambda x: x > num, point_list):
             message = "Please rank your preferences from 1 to %i." % num
         # check that there are no duplicate points
@@ -293,17 +359,22 @@ class PreferentialVoteForm(BaseVoteForm):
                       "zero) to more than one candidate."
         if message:
             raise forms.ValidationError(message)
-        self.candidate_list = [(candidates.get(id=c), int(p))
+        self.candidate_list = [(self.candidate_map[c], int(p))
                                for c, p in clean.items() if int(p) > 0]
-        if write_in:
-            candidate = self.get_write_in_candidate(write_in)
-            self.candidate_list.append((candidate, write_in['points']))
+        self.write_in = write_in or None
         return clean
 
-    def _do_save(self, vote):
-        for candidate, points in self.candidate_list:
-            VotePreferential(vote=vote, candidate=candidate,
-                             point=points).save()
+    def _get_choices(self):
+        return [(candidate.pk, points)
+                for candidate, points in self.candidate_list]
+
+    def _build_selections(self, vote):
+        candidates = list(self.candidate_list)
+        if self.write_in_candidate:
+            candidates.append((self.write_in_candidate,
+                               self.write_in['points']))
+        return [VotePreferential(vote=vote, candidate=candidate, point=points)
+                for candidate, points in candidates]
 
 
 class PreferentialWriteInField(WriteInField):
@@ -358,3 +429,43 @@ class PreferentialWriteInField(WriteInField):
                     <td>%s</td>
                     <td>%s</td>
                 </tr>""" % tuple(rendered_widgets))
+
+
+def save_vote_forms(election, account, forms, token=None):
+    """
+    Creates a Vote for the given account (with the given idempotency token)
+    and saves the selections from all the given (valid) vote forms using a
+    single bulk insert per selection model. Everything is done in one
+    transaction, so either the whole vote is recorded or none of it is.
+    """
+    with transaction.atomic():
+        vote = election.create_vote(account, token)
+        resolve_write_ins(forms)
+        selections = {}
+        for form in forms:
+            selections.setdefault(form.selection_model, []).extend(
+                form.get_selections(vote))
+        for model, objects in selections.items():
+            if objects:
+                model.objects.bulk_create(objects)
+        # bulk_create() doesn't send post_save signals, so the tallies have
+        # to be updated explicitly
+        CandidateTally.add_selections(sum(selections.values(), []))
+    caching.invalidate_election(election.pk)
+    caching.run_pending_invalidations()
+    return vote
+
+
+def resolve_write_ins(forms):
+    """
+    Sets write_in_candidate for each of the given (valid) vote forms with a
+    write-in candidate, creating the candidates as needed. All the write-ins
+    are resolved together, so existing candidates are fetched with a single
+    query. Should be called in the transaction that saves the vote.
+    """
+    forms = [f for f in forms if f.write_in and not f.write_in_candidate]
+    candidates = Candidate.resolve_write_ins([
+        (f.ballot, f.write_in['first_name'], f.write_in['last_name'])
+        for f in forms])
+    for form, candidate in zip(forms, candidates):
+        form.write_in_candidate = candidate
@@ -0,0 +1,290 @@
+"""
+Opt-in instrumentation of django_elect's views. Add
+"django_elect.instrumentation.InstrumentationMiddleware" to
+MIDDLEWARE_CLASSES to record, for every request to a django_elect view, the
+number of queries, the time spent in the database, the time spent rendering
+templates and the time spent in parts of templates such as the show_errors
+tag and the ballot forms. Other code can be measured the same way with the
+measure() context manager.
+
+Each measurement is sent with the request_measured signal, logged as JSON to
+the "django_elect.instrumentation" logger, and added to counters in the
+django_elect cache, which django_elect.views.metrics() exports in the
+Prometheus text format. Queries that are repeated with different parameters
+within one measurement (e.g. Candidate.objects.get() in a loop) are logged
+as warnings, since they usually mean a missing select_related() or
+prefetch_related().
+
+Only queries on the default database are counted.
+"""
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+from functools import wraps
+
+from django import shortcuts
+from django.db import connection
+from django.dispatch import Signal
+from django.template import loader
+
+from django_elect import caching, settings
+
+
+logger = logging.getLogger(__name__)
+
+request_measured = Signal(providing_args=["measurement", "request"])
+
+# names of the parts measured with timed(), which are exported by metrics()
+PARTS = set()
+
+_local = threading.local()
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_LIST_RE = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+
+
+def normalize_query(sql):
+    """
+    Returns the given SQL with its literal values replaced by question
+    marks, so queries that only differ in their parameters are equal.
+    """
+    sql = _NUMBER_RE.sub("?", _STRING_RE.sub("?", sql))
+    return _LIST_RE.sub("(...)", sql)
+
+
+class Measurement(object):
+    """
+    Measurements of a request or block of code. Times are in seconds, and
+    self.timings maps the names of parts measured with timed() to the time
+    spent in them. self.repeated_queries is a list of (normalized SQL,
+    number of times run) tuples for the queries that were run at least
+    DJANGO_ELECT_REPEATED_QUERY_THRESHOLD times.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.db_time = 0.0
+        self.duration = 0.0
+        self.timings = defaultdict(float)
+        self.repeated_queries = []
+        self._query_counts = Counter()
+
+    def start(self):
+        self._force_debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        if not isinstance(connection.queries_log, _QueryLog):
+            connection.queries_log = _QueryLog(
+                connection.queries_log, connection.queries_log.maxlen)
+        self._start = time.time()
+        _get_stack().append(self)
+
+    def add_query(self, query):
+        """
+        Called with each query logged while the measurement is in progress.
+        """
+        self.queries += 1
+        self.db_time += float(query['time'])
+        self._query_counts[normalize_query(query['sql'])] += 1
+
+    def stop(self):
+        self.duration = time.time() - self._start
+        stack = _get_stack()
+        if self in stack:
+            stack.remove(self)
+        connection.force_debug_cursor = self._force_debug_cursor
+        threshold = settings.DJANGO_ELECT_REPEATED_QUERY_THRESHOLD
+        self.repeated_queries = sorted(
+            [(sql, n) for sql, n in self._query_counts.items()
+             if n >= threshold],
+            key=lambda item: -item[1])
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'queries': self.queries,
+            'db_time': round(self.db_time, 6),
+            'duration': round(self.duration, 6),
+            'timings': dict((k, round(v, 6))
+                            for k, v in self.timings.items()),
+            'repeated_queries': self.repeated_queries,
+        }
+
+
+class _QueryLog(deque):
+    """
+    Replacement for the connection's queries_log that also adds each query
+    to the measurements in progress. The log itself only keeps the last
+    queries_limit queries, so it can't be used to count them.
+    """
+    def append(self, query):
+        deque.append(self, query)
+        for measurement in _get_stack():
+            measurement.add_query(query)
+
+
+def _get_stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+@contextmanager
+def measure(name, request=None):
+    """
+    Measures the enclosed block under the given name, and records the
+    measurement with record() when it's done.
+    """
+    measurement = Measurement(name)
+    measurement.start()
+    try:
+        yield measurement
+    finally:
+        measurement.stop()
+        record(measurement, request)
+
+
+def timed(part):
+    """
+    Decorator that adds the time spent in the decorated function to the
+    timings of the measurements in progress, under the given name.
+    """
+    PARTS.add(part)
+
+    def decorator(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            stack = _get_stack()
+            if not stack:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                for measurement in stack:
+                    measurement.timings[part] += elapsed
+        return inner
+    return decorator
+
+
+# versions of Django's rendering functions that record the time spent
+# rendering templates
+render_to_response = timed("render")(shortcuts.render_to_response)
+render_to_string = timed("render")(loader.render_to_string)
+
+
+def record(measurement, request=None):
+    """
+    Sends the request_measured signal for the given measurement, logs it
+    and adds it to the counters exported by metrics().
+    """
+    request_measured.send(sender=Measurement, measurement=measurement,
+                          request=request)
+    data = measurement.as_dict()
+    logger.info(json.dumps(data, sort_keys=True),
+                extra={'measurement': data})
+    for sql, count in measurement.repeated_queries:
+        logger.warning("Query run %i times in %s: %s", count,
+                       measurement.name, sql)
+    # the cache only increments integers, so times are kept in microseconds
+    counters = {
+        'requests': 1,
+        'queries': measurement.queries,
+        'db_us': int(measurement.db_time * 1e6),
+        'duration_us': int(measurement.duration * 1e6),
+        'repeated_queries': len(measurement.repeated_queries),
+    }
+    for part, seconds in measurement.timings.items():
+        counters['part:%s:us' % part] = int(seconds * 1e6)
+    cache = caching.get_cache()
+    for counter, value in counters.items():
+        key = _counter_key(measurement.name, counter)
+        if not cache.add(key, value, None):
+            try:
+                cache.incr(key, value)
+            except ValueError:
+                # expired between add() and incr()
+                cache.set(key, value, None)
+
+
+def _counter_key(name, counter):
+    return "django_elect:metrics:%s:%s" % (name, counter)
+
+
+class InstrumentationMiddleware(object):
+    """
+    Measures requests to django_elect's views, under the name of their URL
+    pattern. The body of streaming responses isn't included.
+    """
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        name = request.resolver_match.url_name
+        if name not in get_view_names():
+            return None
+        measurement = Measurement(name)
+        measurement.start()
+        request._django_elect_measurement = measurement
+        return None
+
+    def process_response(self, request, response):
+        measurement = getattr(request, '_django_elect_measurement', None)
+        if measurement is not None:
+            del request._django_elect_measurement
+            measurement.stop()
+            record(measurement, request)
+        return response
+
+
+def get_view_names():
+    """
+    Returns the names of the URL patterns of django_elect's views.
+    """
+    from django_elect.urls import urlpatterns
+    return [p.name for p in urlpatterns if p.name]
+
+
+METRICS = [
+    ('requests', 'requests_total', 1,
+     "Requests handled by django_elect views."),
+    ('queries', 'queries_total', 1, "Database queries run."),
+    ('db_us', 'db_seconds_total', 1e-6, "Time spent in the database."),
+    ('duration_us', 'seconds_total', 1e-6, "Time spent in the views."),
+    ('repeated_queries', 'repeated_queries_total', 1,
+     "Queries repeated with different parameters within one request."),
+]
+
+
+def format_metrics():
+    """
+    Returns the counters recorded for django_elect's views in the Prometheus
+    text format.
+    """
+    names = sorted(get_view_names())
+    parts = sorted(PARTS)
+    keys = [_counter_key(name, counter) for name in names
+            for counter, metric, scale, description in METRICS]
+    keys += [_counter_key(name, 'part:%s:us' % part)
+             for name in names for part in parts]
+    values = caching.get_cache().get_many(keys)
+
+    lines = []
+    for counter, metric, scale, description in METRICS:
+        lines.append("# HELP django_elect_%s %s" % (metric, description))
+        lines.append("# TYPE django_elect_%s counter" % metric)
+        for name in names:
+            value = values.get(_counter_key(name, counter), 0)
+            lines.append('django_elect_%s{view="%s"} %s' % (metric, name,
+                                                           value * scale))
+    lines.append("# HELP django_elect_part_seconds_total Time spent in "
+                 "parts of the views, e.g. rendering templates.")
+    lines.append("# TYPE django_elect_part_seconds_total counter")
+    for name in names:
+        for part in parts:
+            value = values.get(_counter_key(name, 'part:%s:us' % part), 0)
+            lines.append('django_elect_part_seconds_total{view="%s",'
+                         'part="%s"} %s' % (name, part, value * 1e-6))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from django_elect import settings
+from django_elect.models import Election
+
+
+class Command(BaseCommand):
+    help = "Disassociates accounts from the votes of an election in " +\
+           "batches, so the votes table isn't locked for long."
+
+    def add_arguments(self, parser):
+        parser.add_argument('election_id', type=int)
+        parser.add_argument('--batch-size', type=int,
+            default=settings.DJANGO_ELECT_DISASSOCIATE_BATCH_SIZE,
+            help="Number of votes to update at a time.")
+        parser.add_argument('--sleep', type=float,
+            default=settings.DJANGO_ELECT_DISASSOCIATE_SLEEP,
+            help="Seconds to wait between batches.")
+        parser.add_argument('--start-pk', type=int, default=0,
+            help="Skip votes with an ID less than or equal to this, e.g. "
+                 "to resume an interrupted run.")
+
+    def handle(self, *args, **options):
+        try:
+            election = Election.objects.get(pk=options['election_id'])
+        except Election.DoesNotExist:
+            raise CommandError("Election %s does not exist." %
+                               options['election_id'])
+        if options['batch_size'] < 1:
+            raise CommandError("Batch size must be at least 1.")
+
+        total = election.votes.filter(account__isnull=False,
+                                      pk__gt=options['start_pk']).count()
+
+        def progress(updated, last_pk):
+            self.stdout.write("Disassociated %i of %i votes (last vote ID: "
+                              "%i)" % (updated, total, last_pk))
+
+        updated = election.disassociate_accounts_in_batches(
+            options['batch_size'], options['sleep'], options['start_pk'],
+            progress)
+        self.stdout.write("Done. Disassociated %i votes for %s." %
+                          (updated, election))
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_elect import settings, spool
+
+
+class Command(BaseCommand):
+    help = "Stores the votes in the vote spool (see the " +\
+           "DJANGO_ELECT_SPOOL_PATH setting) in the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+            default=settings.DJANGO_ELECT_SPOOL_BATCH_SIZE,
+            help="Number of votes to store at a time.")
+        parser.add_argument('--forever', action='store_true', default=False,
+            help="Keep waiting for new votes instead of exiting once the "
+                 "spool is empty.")
+        parser.add_argument('--interval', type=float, default=1.0,
+            help="Seconds to wait before checking for new votes when the "
+                 "spool is empty, with --forever.")
+
+    def handle(self, *args, **options):
+        if not spool.is_enabled():
+            raise CommandError("DJANGO_ELECT_SPOOL_PATH isn't set.")
+        if options['batch_size'] < 1:
+            raise CommandError("Batch size must be at least 1.")
+
+        total = 0
+        while True:
+            processed = spool.drain(options['batch_size'])
+            total += processed
+            if processed:
+                self.stdout.write("Processed %i votes" % processed)
+            elif options['forever']:
+                time.sleep(options['interval'])
+            else:
+                break
+        failed = sum(e['failed'] for e in spool.get_status())
+        self.stdout.write("Done. Processed %i votes, %i failed in total." %
+                          (total, failed))
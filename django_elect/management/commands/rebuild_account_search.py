@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from django_elect.account_search import get_backend
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the index of the account search backend, e.g. after " +\
+           "accounts were imported in bulk."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help="Number of accounts to index at a time.")
+
+    def handle(self, *args, **options):
+        indexed = get_backend().rebuild(options['batch_size'])
+        self.stdout.write("Indexed %i accounts." % indexed)
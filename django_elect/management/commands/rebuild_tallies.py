@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from django_elect.models import Candidate, CandidateTally
+
+
+class Command(BaseCommand):
+    help = "Verifies the candidate tallies against the vote tables and " +\
+           "rebuilds any that are wrong."
+
+    def add_arguments(self, parser):
+        parser.add_argument('election_ids', nargs='*', type=int,
+            help="Only check candidates in these elections.")
+        parser.add_argument('--verify', action='store_true', default=False,
+            help="Only report incorrect tallies instead of fixing them.")
+
+    def handle(self, *args, **options):
+        candidates = Candidate.objects.all()
+        if options['election_ids']:
+            candidates = candidates.filter(
+                ballot__election__in=options['election_ids'])
+
+        with transaction.atomic():
+            counts = CandidateTally.count_selections(candidates)
+            tallies = CandidateTally.objects.select_for_update() \
+                .in_bulk(counts.keys())
+            wrong = []
+            for pk, (votes, points) in sorted(counts.items()):
+                tally = tallies.get(pk)
+                if tally and (tally.votes, tally.points) == (votes, points):
+                    continue
+                wrong.append(pk)
+                self.stdout.write("Candidate %i: tally is %s, should be "
+                    "%i votes and %i points" % (pk,
+                    tally and "%i votes and %i points" % (tally.votes,
+                        tally.points) or "missing", votes, points))
+                if not options['verify']:
+                    CandidateTally.objects.update_or_create(candidate_id=pk,
+                        defaults={'votes': votes, 'points': points})
+
+        self.stdout.write("Checked %i tallies, %i incorrect." % (len(counts),
+                                                                len(wrong)))
+        if wrong and options['verify']:
+            raise CommandError("Tallies don't match the vote tables.")
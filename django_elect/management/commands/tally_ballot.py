@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from django_elect.models import Ballot
+from django_elect.tally import TallyError
+
+
+class Command(BaseCommand):
+    help = "Counts the votes of a ballot and prints the winners and the " +\
+           "rounds of counting."
+
+    def add_arguments(self, parser):
+        parser.add_argument('ballot_id', type=int)
+        parser.add_argument('--method',
+            help="Tally method to use instead of the ballot's, e.g. irv, "
+                 "stv, schulze or borda.")
+
+    def handle(self, *args, **options):
+        try:
+            ballot = Ballot.objects.get(pk=options['ballot_id'])
+        except Ballot.DoesNotExist:
+            raise CommandError("Ballot %s does not exist." %
+                               options['ballot_id'])
+        try:
+            result = ballot.get_result(options['method'])
+        except TallyError as e:
+            raise CommandError(e)
+
+        self.stdout.write("%s count for %s" % (result.method, ballot))
+        for round in result.rounds:
+            self.stdout.write("Round %i:" % round.number)
+            for candidate, count in round.counts:
+                self.stdout.write("  %s: %.2f" % (candidate, count))
+            if round.exhausted:
+                self.stdout.write("  Exhausted: %.2f" % round.exhausted)
+            if round.tied:
+                self.stdout.write("  Tie between %s" %
+                                  ", ".join(map(unicode, round.tied)))
+            for candidate in round.elected:
+                self.stdout.write("  Elected: %s" % candidate)
+            for candidate in round.eliminated:
+                self.stdout.write("  Eliminated: %s" % candidate)
+        self.stdout.write("Elected: %s" %
+                          ", ".join(map(unicode, result.winners)))
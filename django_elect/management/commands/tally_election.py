@@ -0,0 +1,48 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_elect.models import Election
+from django_elect.tally import tally_ballots
+
+
+class Command(BaseCommand):
+    help = "Counts the votes of all the ballots of an election, in " +\
+           "parallel, and prints the winners of each ballot."
+
+    def add_arguments(self, parser):
+        parser.add_argument('election_id', type=int)
+        parser.add_argument('--method',
+            help="Tally method to use instead of each ballot's, e.g. irv, "
+                 "stv, schulze or borda.")
+        parser.add_argument('--processes', type=int,
+            default=multiprocessing.cpu_count(),
+            help="Number of worker processes. Defaults to the number of "
+                 "CPUs.")
+
+    def handle(self, *args, **options):
+        try:
+            election = Election.objects.get(pk=options['election_id'])
+        except Election.DoesNotExist:
+            raise CommandError("Election %s does not exist." %
+                               options['election_id'])
+        if options['processes'] < 1:
+            raise CommandError("Number of processes must be at least 1.")
+
+        start = time.time()
+        outcomes = tally_ballots(election.ballots.all(), options['method'],
+                                 options['processes'])
+        failed = 0
+        for ballot, result, error in outcomes:
+            if error is not None:
+                failed += 1
+                self.stdout.write("%s: %s" % (ballot, error))
+            else:
+                self.stdout.write("%s (%s): %s" % (ballot, result.method.name,
+                    ", ".join(map(unicode, result.winners))))
+        self.stdout.write("Counted %i ballots for %s in %.2f seconds." %
+                          (len(outcomes) - failed, election,
+                           time.time() - start))
+        if failed:
+            raise CommandError("%i ballots couldn't be counted." % failed)
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_elect import spool
+
+
+class Command(BaseCommand):
+    help = "Shows the number of votes in the vote spool that haven't been " +\
+           "stored in the database yet, and the votes that failed."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true',
+            default=False,
+            help="Mark the failed votes as pending, so they're stored again.")
+
+    def handle(self, *args, **options):
+        if not spool.is_enabled():
+            raise CommandError("DJANGO_ELECT_SPOOL_PATH isn't set.")
+
+        if options['retry_failed']:
+            self.stdout.write("Marked %i failed votes as pending." %
+                              spool.retry_failed())
+
+        status = spool.get_status()
+        if not status:
+            self.stdout.write("The spool is empty.")
+        for info in status:
+            line = "Election %(election_id)i: %(pending)i pending, " +\
+                   "%(stored)i stored, %(failed)i failed"
+            if info['oldest_pending']:
+                line += " (oldest pending vote is %i seconds old)" % (
+                    time.time() - info['oldest_pending'])
+            self.stdout.write(line % info)
+        for spool_id, election_id, account_id, error in spool.get_failed(10):
+            self.stdout.write("Failed vote %i (election %i, account %i): %s" %
+                              (spool_id, election_id, account_id, error))
@@ -0,0 +1,228 @@
+"""
+The points each vote in an election gave each candidate, as a matrix with a
+row per vote and a column per candidate, which is what the spreadsheet
+export shows and what audits of the tallies need.
+
+build_matrix() fills it from the VotePlurality and VotePreferential rows
+that exist, so the queries only return the selections that were made rather
+than every combination of a vote and a candidate. VoteMatrix stores every
+cell as an unsigned 16-bit integer: in a NumPy array when NumPy is
+installed, so the matrix can be used in vectorized calculations, and
+otherwise in a flat array('H'). SparseVoteMatrix only stores the
+selections, which takes far less memory when voters only select a few of
+the candidates, and makes each row when it's read.
+"""
+from array import array
+from bisect import bisect_left
+from collections import Mapping
+from heapq import merge
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class BaseVoteMatrix(object):
+    """
+    self.vote_ids and self.candidate_ids are arrays with the primary keys of
+    the votes and candidates in the order of the rows and columns. The votes
+    are ordered by primary key.
+    """
+    def __init__(self, vote_ids, candidate_ids):
+        self.vote_ids = array('l', sorted(vote_ids))
+        self.candidate_ids = array('l', candidate_ids)
+        self.width = len(self.candidate_ids)
+        self.columns = dict((pk, j) for j, pk in enumerate(self.candidate_ids))
+
+    def __len__(self):
+        return len(self.vote_ids)
+
+    @property
+    def shape(self):
+        return (len(self.vote_ids), self.width)
+
+    def index(self, vote_id):
+        """
+        Returns the number of the row of the vote with the given primary key,
+        or None if it isn't in the matrix.
+        """
+        i = bisect_left(self.vote_ids, vote_id)
+        if i < len(self.vote_ids) and self.vote_ids[i] == vote_id:
+            return i
+        return None
+
+    def row(self, i):
+        """
+        Returns the points of the vote in the given row, as a list.
+        """
+        raise NotImplementedError
+
+    def __iter__(self):
+        """
+        Yields a (vote ID, list of points) tuple for each row.
+        """
+        for i, vote_id in enumerate(self.vote_ids):
+            yield vote_id, self.row(i)
+
+    def totals(self):
+        """
+        Returns a list with the sum of the points given to each candidate,
+        which should match their CandidateTally.
+        """
+        raise NotImplementedError
+
+
+class VoteMatrix(BaseVoteMatrix):
+    """
+    With NumPy, self.data is an array of shape self.shape, and otherwise
+    it's an array of unsigned shorts with one row of self.width numbers per
+    vote.
+    """
+    def __init__(self, vote_ids, candidate_ids, selections=()):
+        super(VoteMatrix, self).__init__(vote_ids, candidate_ids)
+        if numpy is not None:
+            self.data = numpy.zeros(self.shape, dtype=numpy.uint16)
+        else:
+            self.data = array('H', [0]) * (len(self.vote_ids) * self.width)
+        for vote_id, candidate_id, points in selections:
+            self.add(vote_id, candidate_id, points)
+
+    def add(self, vote_id, candidate_id, points):
+        """
+        Adds points to the cell of the given vote and candidate. Votes and
+        candidates that aren't in the matrix, e.g. because they were created
+        after it, are ignored.
+        """
+        i = self.index(vote_id)
+        j = self.columns.get(candidate_id)
+        if i is None or j is None:
+            return
+        if numpy is not None:
+            self.data[i, j] += points
+        else:
+            self.data[i * self.width + j] += points
+
+    def row(self, i):
+        if numpy is not None:
+            return self.data[i].tolist()
+        start = i * self.width
+        return self.data[start:start + self.width].tolist()
+
+    def totals(self):
+        if numpy is not None:
+            return self.data.sum(axis=0).tolist()
+        totals = [0] * self.width
+        for start in xrange(0, len(self.data), self.width):
+            for j, points in enumerate(self.data[start:start + self.width]):
+                totals[j] += points
+        return totals
+
+
+class SparseVoteMatrix(BaseVoteMatrix):
+    """
+    Only the cells with points are stored, in compressed sparse row form:
+    the cells of row i are at positions self.offsets[i] up to
+    self.offsets[i + 1] of self.cells, which has their column numbers, and
+    self.points, which has their points. The selections must be given in
+    order of vote ID.
+    """
+    def __init__(self, vote_ids, candidate_ids, selections=()):
+        super(SparseVoteMatrix, self).__init__(vote_ids, candidate_ids)
+        self.offsets = array('l', [0])
+        # elections with many write-ins can have more candidates than an
+        # unsigned short can number
+        self.cells = array('l')
+        self.points = array('H')
+        for vote_id, candidate_id, points in selections:
+            i = self.index(vote_id)
+            j = self.columns.get(candidate_id)
+            if i is None or j is None:
+                continue
+            # end the rows before this one
+            while len(self.offsets) <= i:
+                self.offsets.append(len(self.cells))
+            self.cells.append(j)
+            self.points.append(points)
+        while len(self.offsets) <= len(self.vote_ids):
+            self.offsets.append(len(self.cells))
+
+    def row(self, i):
+        row = [0] * self.width
+        for k in xrange(self.offsets[i], self.offsets[i + 1]):
+            row[self.cells[k]] += self.points[k]
+        return row
+
+    def totals(self):
+        totals = [0] * self.width
+        for j, points in zip(self.cells, self.points):
+            totals[j] += points
+        return totals
+
+
+class VotePoints(Mapping):
+    """
+    Maps each of the given Vote objects to the list of its points in the
+    given matrix. The lists are made when they're read, so the rows of a
+    SparseVoteMatrix are only densified one at a time.
+    """
+    def __init__(self, votes, matrix):
+        self.votes = votes
+        self.matrix = matrix
+
+    def __getitem__(self, vote):
+        i = self.matrix.index(vote.pk)
+        if i is None:
+            raise KeyError(vote)
+        return self.matrix.row(i)
+
+    def __iter__(self):
+        return iter(self.votes)
+
+    def __len__(self):
+        return len(self.votes)
+
+    def iteritems(self):
+        # templates should use this rather than items(), which makes every
+        # list at once
+        for vote in self.votes:
+            yield vote, self[vote]
+
+
+def iter_selections(election):
+    """
+    Yields a (vote ID, candidate ID, points) tuple for each VotePlurality
+    and VotePreferential of the given election, ordered by vote ID and then
+    by candidate ID. Plurality selections are worth one point.
+    """
+    from django_elect.models import VotePlurality, VotePreferential
+
+    pluralities = VotePlurality.objects \
+        .filter(vote__election=election) \
+        .order_by('vote_id', 'candidate_id') \
+        .values_list('vote', 'candidate')
+    preferentials = VotePreferential.objects \
+        .filter(vote__election=election) \
+        .order_by('vote_id', 'candidate_id') \
+        .values_list('vote', 'candidate', 'point')
+    return merge(((vote_id, candidate_id, 1) for vote_id, candidate_id
+                  in pluralities.iterator()),
+                 preferentials.iterator())
+
+
+def build_matrix(election, candidate_ids=None, sparse=False):
+    """
+    Returns a VoteMatrix for the given election, or a SparseVoteMatrix if
+    sparse is True. The columns are the candidates with the given primary
+    keys, or if None, all the election's candidates ordered by ballot ID and
+    then by candidate ID.
+    """
+    from django_elect.models import Candidate
+
+    if candidate_ids is None:
+        candidate_ids = Candidate.objects.filter(ballot__election=election) \
+                                         .order_by('ballot', 'pk') \
+                                         .values_list('pk', flat=True)
+    vote_ids = election.votes.order_by('pk').values_list('pk', flat=True)
+    cls = SparseVoteMatrix if sparse else VoteMatrix
+    return cls(vote_ids, candidate_ids, iter_selections(election))
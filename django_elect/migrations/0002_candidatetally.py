@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def populate_tallies(apps, schema_editor):
+    Candidate = apps.get_model('django_elect', 'Candidate')
+    CandidateTally = apps.get_model('django_elect', 'CandidateTally')
+    VotePlurality = apps.get_model('django_elect', 'VotePlurality')
+    VotePreferential = apps.get_model('django_elect', 'VotePreferential')
+    tallies = dict((pk, CandidateTally(candidate_id=pk))
+                   for pk in Candidate.objects.values_list('pk', flat=True))
+    pluralities = VotePlurality.objects.values('candidate') \
+        .annotate(votes=Count('id'))
+    for row in pluralities:
+        tallies[row['candidate']].votes += row['votes']
+    preferentials = VotePreferential.objects.values('candidate') \
+        .annotate(votes=Count('id'), points=Sum('point'))
+    for row in preferentials:
+        tallies[row['candidate']].votes += row['votes']
+        tallies[row['candidate']].points += row['points']
+    CandidateTally.objects.bulk_create(tallies.values())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_elect', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CandidateTally',
+            fields=[
+                ('candidate', models.OneToOneField(related_name='tally', primary_key=True, serialize=False, to='django_elect.Candidate')),
+                ('votes', models.IntegerField(default=0)),
+                ('points', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(populate_tallies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_elect', '0002_candidatetally'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='vote',
+            unique_together=set([('election', 'account')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='candidate',
+            index_together=set([('ballot', 'write_in')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='voteplurality',
+            index_together=set([('candidate', 'vote')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='votepreferential',
+            index_together=set([('candidate', 'point')]),
+        ),
+    ]
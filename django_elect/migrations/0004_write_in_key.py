@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import unicodedata
+
+from django.db import migrations, models
+from django.db.models import F
+from django.utils.encoding import force_text
+
+
+def normalize_name(first_name, last_name):
+    """
+    Copy of django_elect.models.normalize_name() as of this migration, so
+    later changes to it don't change what the migration does.
+    """
+    text = unicodedata.normalize('NFKD',
+                                 force_text(first_name + " " + last_name))
+    text = u"".join(c for c in text if not unicodedata.combining(c))
+    return u" ".join(text.lower().split())[:255]
+
+
+def populate_write_in_keys(apps, schema_editor):
+    """
+    Sets write_in_key for existing write-in candidates and merges write-in
+    candidates on the same ballot that have the same key, so the unique
+    constraint can be added.
+    """
+    Candidate = apps.get_model('django_elect', 'Candidate')
+    CandidateTally = apps.get_model('django_elect', 'CandidateTally')
+    VotePlurality = apps.get_model('django_elect', 'VotePlurality')
+    VotePreferential = apps.get_model('django_elect', 'VotePreferential')
+    kept = {}
+    for candidate in Candidate.objects.filter(write_in=True).order_by('pk'):
+        key = normalize_name(candidate.first_name, candidate.last_name)
+        original = kept.get((candidate.ballot_id, key))
+        if original is None:
+            candidate.write_in_key = key
+            candidate.save()
+            kept[(candidate.ballot_id, key)] = candidate
+            continue
+        VotePlurality.objects.filter(candidate=candidate) \
+            .update(candidate=original)
+        VotePreferential.objects.filter(candidate=candidate) \
+            .update(candidate=original)
+        tally = CandidateTally.objects.filter(candidate=candidate).first()
+        if tally:
+            CandidateTally.objects.filter(candidate=original).update(
+                votes=F('votes') + tally.votes,
+                points=F('points') + tally.points)
+        candidate.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_elect', '0003_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='candidate',
+            name='write_in_key',
+            field=models.CharField(max_length=255, null=True, editable=False, blank=True),
+        ),
+        migrations.RunPython(populate_write_in_keys,
+                             migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='candidate',
+            unique_together=set([('ballot', 'write_in_key')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_elect', '0005_ballot_tally_method'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ballot',
+            name='tally_method',
+            field=models.CharField(default=b'borda', help_text=b'How the winners of a preferential ballot are determined. Only the Borda count can be used for secret ballots.', max_length=20, choices=[(b'borda', b'Borda count'), (b'irv', b'Instant-runoff'), (b'stv', b'Single transferable vote'), (b'schulze', b'Schulze'), (b'ranked_pairs', b'Ranked pairs')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_elect', '0006_ranked_pairs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vote',
+            name='token',
+            field=models.CharField(max_length=32, unique=True, null=True, editable=False),
+        ),
+    ]
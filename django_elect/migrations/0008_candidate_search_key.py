@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import unicodedata
+
+from django.db import migrations, models
+from django.utils.encoding import force_text
+
+
+def normalize_name(first_name, last_name):
+    """
+    Copy of django_elect.models.normalize_name() as of this migration, so
+    later changes to it don't change what the migration does.
+    """
+    text = unicodedata.normalize('NFKD',
+                                 force_text(first_name + " " + last_name))
+    text = u"".join(c for c in text if not unicodedata.combining(c))
+    return u" ".join(text.lower().split())[:255]
+
+
+def populate_search_keys(apps, schema_editor):
+    """
+    Sets search_key for existing candidates.
+    """
+    Candidate = apps.get_model('django_elect', 'Candidate')
+    candidates = Candidate.objects.values_list('pk', 'first_name',
+                                               'last_name')
+    for pk, first_name, last_name in candidates.iterator():
+        Candidate.objects.filter(pk=pk).update(
+            search_key=normalize_name(first_name, last_name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_elect', '0007_vote_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='candidate',
+            name='search_key',
+            field=models.CharField(db_index=True, max_length=255, editable=False, blank=True),
+        ),
+        migrations.RunPython(populate_search_keys,
+                             migrations.RunPython.noop),
+    ]
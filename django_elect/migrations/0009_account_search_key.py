@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import unicodedata
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import migrations, models
+from django.utils.encoding import force_text
+
+from django_elect import settings
+
+
+def get_keys(first_name, last_name):
+    """
+    Copy of django_elect.models.AccountSearchKey.get_keys() as of this
+    migration, so later changes to it don't change what the migration does.
+    """
+    text = unicodedata.normalize('NFKD',
+                                 force_text(first_name + " " + last_name))
+    text = u"".join(c for c in text if not unicodedata.combining(c))
+    words = u" ".join(text.lower().split())[:255].split()
+    return sorted(set(u" ".join(words[i:]) for i in range(len(words))))
+
+
+def populate_account_search_keys(apps, schema_editor):
+    """
+    Creates the search keys for existing accounts, in batches. Skipped for
+    user models without first_name and last_name fields, which can't use
+    the backend that searches them.
+    """
+    AccountSearchKey = apps.get_model('django_elect', 'AccountSearchKey')
+    User = apps.get_model(*settings.DJANGO_ELECT_USER_MODEL.split('.'))
+    try:
+        User._meta.get_field('first_name')
+        User._meta.get_field('last_name')
+    except FieldDoesNotExist:
+        return
+    accounts = User.objects.order_by('pk').values_list('pk', 'first_name',
+                                                       'last_name')
+    last_pk = None
+    while True:
+        batch = accounts
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        batch = list(batch[:1000])
+        if not batch:
+            break
+        AccountSearchKey.objects.bulk_create([
+            AccountSearchKey(account_id=pk, key=key)
+            for pk, first_name, last_name in batch
+            for key in get_keys(first_name, last_name)])
+        last_pk = batch[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_elect', '0008_candidate_search_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountSearchKey',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('key', models.CharField(max_length=255)),
+                ('account', models.ForeignKey(related_name='+', to=settings.DJANGO_ELECT_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='accountsearchkey',
+            index_together=set([('key', 'account')]),
+        ),
+        migrations.RunPython(populate_account_search_keys,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.utils.text import slugify
+
+
+def populate_slugs(apps, schema_editor):
+    """
+    Sets slug for existing elections, based on their names.
+    """
+    Election = apps.get_model('django_elect', 'Election')
+    used = set()
+    for election in Election.objects.order_by('pk'):
+        base = slugify(election.name)[:240] or "election"
+        slug, i = base, 1
+        while slug in used:
+            i += 1
+            slug = "%s-%i" % (base, i)
+        used.add(slug)
+        Election.objects.filter(pk=election.pk).update(slug=slug)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_elect', '0009_account_search_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='election',
+            name='slug',
+            field=models.SlugField(max_length=255, null=True, blank=True),
+        ),
+        migrations.RunPython(populate_slugs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='election',
+            name='slug',
+            field=models.SlugField(help_text="Used in the URLs of the election's pages, e.g. elections/&lt;slug&gt;/ for the voting page. Generated from the name if left empty.", unique=True, max_length=255, blank=True),
+        ),
+    ]
@@ -1,9 +1,19 @@
+import operator
+import time
+import unicodedata
 from datetime import datetime
 
 from django.http import Http404
-from django.db import models, connection
-from django.db.models import Q
-from django_elect import settings
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import Q, F, Case, When, Count, Sum, Prefetch, \
+    Value as V
+from django.db.models.functions import Coalesce
+from django.db.models.signals import pre_save, post_save, post_delete, \
+    m2m_changed
+from django.dispatch import receiver
+from django.utils.encoding import force_text
+from django.utils.text import slugify
+from django_elect import settings, caching, matrix, tally
 
 
 class VotingNotAllowedException(Exception):
@@ -18,6 +28,10 @@ class Election(models.Model):
     name = models.CharField(max_length=255, blank=False, unique=True,
         help_text="Used to uniquely identify elections. Will be shown "+\
         "with ' Election' appended to it on all publicly-visible pages.")
+    slug = models.SlugField(max_length=255, blank=True, unique=True,
+        help_text="Used in the URLs of the election's pages, e.g. "+\
+        "elections/&lt;slug&gt;/ for the voting page. Generated from the "+\
+        "name if left empty.")
     introduction = models.TextField(blank=True,
         help_text="This is printed at the top of the voting page below "+\
         "the header. Enter the text as HTML.")
@@ -30,14 +44,68 @@ class Election(models.Model):
     def __unicode__(self):
         return unicode(self.name)
 
-    def voting_allowed_for_user(self, user):
+    def save(self, *args, **kwargs):
+        if not self.slug:
+            self.slug = self._make_slug()
+        super(Election, self).save(*args, **kwargs)
+
+    def _make_slug(self):
+        """
+        Returns a slug based on the name that isn't used by another election.
         """
-        Returns True if not is between vote_start and vote_end, inclusive,
+        base = slugify(self.name)[:240] or "election"
+        slug, i = base, 1
+        others = Election.objects.exclude(pk=self.pk)
+        while others.filter(slug=slug).exists():
+            i += 1
+            slug = "%s-%i" % (base, i)
+        return slug
+
+    def voting_allowed_for_user(self, user, cached=False):
+        """
+        Returns True if now is between vote_start and vote_end, inclusive,
         and given user is in allowed_voters and user hasn't already voted.
+        If cached is True, the user's eligibility is read from the cache when
+        possible instead of the database.
+        """
+        if not self.voting_allowed():
+            return False
+        if cached:
+            eligibility = caching.get_eligibility(self, user)
+        else:
+            eligibility = self.get_eligibility(user)
+        roll_empty, on_roll, voted = eligibility
+        return not voted and (roll_empty or on_roll)
+
+    def get_eligibility(self, user):
         """
-        return (self.voting_allowed() and not self.has_voted(user) and
-            (self.allowed_voters.count() == 0 or
-            self.allowed_voters.filter(id=user.id)))
+        Returns a tuple of booleans of the form
+        (allowed_voters is empty, user is in allowed_voters, user has voted)
+        using a single query.
+        """
+        field = Election._meta.get_field('allowed_voters')
+        query = """
+            SELECT
+                CASE WHEN EXISTS (
+                    SELECT 1 FROM %(voters)s WHERE %(election_col)s = %%s
+                ) THEN 0 ELSE 1 END,
+                CASE WHEN EXISTS (
+                    SELECT 1 FROM %(voters)s
+                    WHERE %(election_col)s = %%s AND %(user_col)s = %%s
+                ) THEN 1 ELSE 0 END,
+                CASE WHEN EXISTS (
+                    SELECT 1 FROM %(vote)s
+                    WHERE election_id = %%s AND account_id = %%s
+                ) THEN 1 ELSE 0 END
+        """ % {
+            'voters': field.m2m_db_table(),
+            'election_col': field.m2m_column_name(),
+            'user_col': field.m2m_reverse_name(),
+            'vote': Vote._meta.db_table,
+        }
+        cursor = connection.cursor()
+        cursor.execute(query, [self.pk, self.pk, user.pk, self.pk, user.pk])
+        return tuple(bool(i) for i in cursor.fetchone())
 
     def voting_allowed(self):
         """
@@ -45,21 +113,41 @@ class Election(models.Model):
         """
         return self.vote_start <= datetime.now() <= self.vote_end
 
-    def create_vote(self, user):
+    def create_vote(self, user, token=None):
         """
         Checks that the given account can vote in this election, and if so,
-        creates and returns a Vote object.
+        creates and returns a Vote object. token is the idempotency token of
+        the submitted vote form, if any (see has_vote_with_token()).
         """
+        msg = 'The account %s is not allowed to vote in this election.'
         if not self.voting_allowed_for_user(user):
-            msg = 'The account %s is not allowed to vote in this election.'
             raise VotingNotAllowedException(msg % unicode(user))
-        return self.votes.create(account=user, election=self)
+        try:
+            # no savepoint is needed, since the enclosing transaction (if
+            # any) can't be used after this fails anyway
+            with transaction.atomic(savepoint=False):
+                return self.votes.create(account=user, election=self,
+                                         token=token)
+        except IntegrityError:
+            # the unique index on (election, account) caught another vote
+            # that was created after the check above
+            raise VotingNotAllowedException(msg % unicode(user))
+
+    def has_vote_with_token(self, account, token):
+        """
+        Returns True if the given account's vote for this election was
+        submitted with the given idempotency token, i.e. the same vote form
+        was submitted again after the vote was recorded. This only reads a
+        single row through the unique index on the token, without locking.
+        """
+        return bool(token) and \
+            self.votes.filter(account=account, token=token).exists()
 
     def has_voted(self, account):
         """ Returns True if given account has voted for this election """
-        return self.votes.filter(account=account).count() != 0
+        return self.votes.filter(account=account).exists()
 
-    def get_full_statistics(self):
+    def get_full_statistics(self, sparse=False):
         """
         Returns dictionary of the following form:
         {
@@ -69,88 +157,167 @@ class Election(models.Model):
                 Vote#1: [ points_for_candidate1, points_for_candidate2, ... ],
                 Vote#2: [...],
             },
+            "matrix": VoteMatrix,
         }
         Where "points_for_candidate#" is 0 if the vote doesn't contain the
         corresponding candidate and either the point value (for preferential
         ballots) or 1 (for plurality) if so. Candidates are ordered by ballot
-        ID and then by candidate id.
+        ID and then by candidate id, and votes by ID. "matrix" is the
+        django_elect.matrix.VoteMatrix that the points are read from, or a
+        SparseVoteMatrix if sparse is True, in which case each vote's list of
+        points is only made when it's read.
         """
-        query = """
-            SELECT
-                v.id AS vote_id,
-                c.id AS candidate_id,
-                IF(
-                    b.type = "Pl",
-                    IF(vpl.id IS NULL, 0, 1),
-                    IFNULL(SUM(vpr.point), 0)
-                ) AS point
-            FROM %(vote)s v
-            JOIN %(ballot)s b ON (b.election_id = v.election_id)
-            JOIN %(candidate)s c ON (c.ballot_id = b.id)
-            LEFT JOIN %(vote_plurality)s vpl ON (vpl.vote_id = v.id
-                AND vpl.candidate_id = c.id)
-            LEFT JOIN %(vote_preferential)s vpr ON (vpr.vote_id = v.id
-                AND vpr.candidate_id = c.id)
-            WHERE v.election_id = '%(id)i'
-            GROUP BY v.id, c.id
-            ORDER BY v.id, b.id, c.id
-        """
-        query %= {
-            'vote': Vote._meta.db_table,
-            'ballot': Ballot._meta.db_table,
-            'candidate': Candidate._meta.db_table,
-            'vote_plurality': VotePlurality._meta.db_table,
-            'vote_preferential': VotePreferential._meta.db_table,
-            'id': self.pk,
+        candidates = self.get_statistics_candidates()
+        vote_matrix = matrix.build_matrix(self, [c.pk for c in candidates],
+                                          sparse=sparse)
+        ballots = []
+        for candidate in candidates:
+            if candidate.ballot not in ballots:
+                ballots.append(candidate.ballot)
+        # votes cast after the matrix was built are left out
+        votes = [vote for vote in self.votes.select_related('account')
+                                            .order_by('pk')
+                 if vote_matrix.index(vote.pk) is not None]
+        return {
+            'candidates': candidates,
+            'ballots': ballots,
+            'votes': matrix.VotePoints(votes, vote_matrix),
+            'matrix': vote_matrix,
         }
 
-        cursor = connection.cursor()
-        cursor.execute(query)
-
-        stats = {
-            'candidates': [],
-            'ballots': [],
-            'votes': {},
-        }
+    def get_candidate_stats(self):
+        """
+        Returns list of form [(ballot1, stats1), (ballot2, stats2), ...]
+        where stats1, stats2, ... are in the form returned by
+        Ballot.get_candidate_stats(). Only one query is done for each type
+        of ballot, rather than one per ballot.
+        """
+        ballots = list(self.ballots.all())
+        ballot_stats = dict((b.pk, []) for b in ballots)
+        for ballot_type in set(b.type for b in ballots):
+            if ballot_type not in ("Pl", "Pr"):
+                continue
+            candidates = Candidate.objects.filter(ballot__election=self,
+                ballot__type=ballot_type)
+            for c in _annotate_totals(candidates, ballot_type):
+                ballot_stats[c.ballot_id].append((c, c.total))
+        return [(b, ballot_stats[b.pk]) for b in ballots]
+
+    def get_statistics_candidates(self):
+        """
+        Returns list of all candidates for this election in the order used by
+        iter_full_statistics(), i.e. ordered by ballot ID and then by
+        candidate ID.
+        """
+        return list(Candidate.objects.filter(ballot__election=self)
+                                     .select_related('ballot')
+                                     .order_by('ballot', 'id'))
 
-        vote_points = {}
-        for row in cursor.fetchall():
-            vote_id, candidate_id, point = row[0], row[1], row[2]
-            vote_points.setdefault(vote_id, []).append(point)
-            # Every vote in the result set has the same list of candidates, so
-            # we only need to populate the candidates and ballots lists on
-            # the first one.
-            if len(vote_points) == 1:
-                candidate = Candidate.objects.get(id=candidate_id)
-                stats['candidates'].append(candidate)
-                if candidate.ballot not in stats['ballots']:
-                    stats['ballots'].append(candidate.ballot)
-
-        # convert vote_ids into Vote objects
-        for vote_id, points in vote_points.iteritems():
-            vote = Vote.objects.get(id=vote_id)
-            stats['votes'][vote] = points
-
-        return stats
+    def iter_full_statistics(self, chunk_size=1000):
+        """
+        Memory-efficient version of get_full_statistics() for exporting
+        large elections. Yields tuples of the form
+        (Vote, [points_for_candidate1, points_for_candidate2, ...])
+        in order of vote ID, where the candidates are those returned by
+        get_statistics_candidates(). Votes are fetched chunk_size at a time
+        using their primary key, so only one chunk is in memory at once.
+        """
+        candidates = self.get_statistics_candidates()
+        columns = dict((c.pk, i) for i, c in enumerate(candidates))
+        votes = self.votes.select_related('account').order_by('pk')
+        last_pk = 0
+        while True:
+            chunk = list(votes.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            vote_range = {
+                'vote__election': self,
+                'vote__pk__gt': last_pk,
+                'vote__pk__lte': chunk[-1].pk,
+            }
+            points = dict((v.pk, [0] * len(candidates)) for v in chunk)
+            pluralities = VotePlurality.objects.filter(**vote_range) \
+                .values_list('vote', 'candidate')
+            for vote_id, candidate_id in pluralities:
+                if candidate_id in columns:
+                    points[vote_id][columns[candidate_id]] = 1
+            preferentials = VotePreferential.objects.filter(**vote_range) \
+                .values_list('vote', 'candidate', 'point')
+            for vote_id, candidate_id, point in preferentials:
+                if candidate_id in columns:
+                    points[vote_id][columns[candidate_id]] += point
+            for vote in chunk:
+                yield vote, points[vote.pk]
+            last_pk = chunk[-1].pk
 
     def disassociate_accounts(self):
         """
         Sets account = NULL for all Vote objects associated with this election.
-        Returns number of rows affected.
+        The idempotency tokens are cleared too, since the voter's browser
+        could otherwise be used to identify their vote, and the votes that
+        were stored from the vote spool are removed from it. Returns number
+        of rows affected.
         """
         from django.db import connection
         cursor = connection.cursor()
         query = """
             UPDATE %(vote)s
-            SET account_id = NULL
+            SET account_id = NULL, token = NULL
             WHERE election_id = %(id)i
         """
         cursor.execute(query % {
             'vote': Vote._meta.db_table,
             'id': self.pk,
         })
+        self._purge_spool()
+        caching.invalidate_eligibility(self.pk)
+        caching.invalidate_election(self.pk)
         return cursor.rowcount
 
+    def disassociate_accounts_in_batches(self, batch_size, sleep=0,
+                                         start_pk=0, progress=None,
+                                         max_batches=None):
+        """
+        Same as disassociate_accounts(), but updates at most batch_size votes
+        at a time, in order of primary key, and sleeps for the given number of
+        seconds between batches, so row locks aren't held for long. Each
+        batch is committed separately unless called inside a transaction.
+
+        Votes with a primary key less than or equal to start_pk are skipped,
+        which can be used to resume an interrupted run. Running this again
+        is harmless. If given, progress is called after every batch with the
+        number of rows updated so far and the last primary key processed.
+        If max_batches is given, it stops after that many batches.
+        """
+        self._purge_spool()
+        votes = self.votes.filter(account__isnull=False).order_by('pk')
+        updated = 0
+        last_pk = start_pk
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            batches += 1
+            pks = list(votes.filter(pk__gt=last_pk)
+                            .values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            # update using a primary key range so only the rows in this
+            # batch are locked
+            updated += votes.filter(pk__gte=pks[0], pk__lte=pks[-1]) \
+                            .update(account=None, token=None)
+            last_pk = pks[-1]
+            caching.invalidate_eligibility(self.pk)
+            caching.invalidate_election(self.pk)
+            if progress:
+                progress(updated, last_pk)
+            if sleep:
+                time.sleep(sleep)
+        return updated
+
+    def _purge_spool(self):
+        # the vote spool records which accounts voted too
+        from django_elect import spool
+        spool.purge(self.pk)
+
     @staticmethod
     def get_latest_or_404():
         """
@@ -162,6 +329,56 @@ class Election(models.Model):
         except Election.DoesNotExist:
             raise Http404("No elections have been entered yet.")
 
+    @staticmethod
+    def get_current_or_404(slug=None):
+        """
+        Same as get_latest_or_404(), but returns the cached Election from
+        caching.get_current_election(), whose ballots and candidates are
+        prefetched. It must not be modified. If a slug is given, the election
+        with that slug is returned instead of the latest one.
+        """
+        election = caching.get_current_election(slug)
+        if election is None:
+            if slug:
+                raise Http404("No election matches the given query.")
+            raise Http404("No elections have been entered yet.")
+        return election
+
+    @staticmethod
+    def get_latest_prefetched(slug=None):
+        """
+        Returns the latest Election, or the one with the given slug, with its
+        ballots and their candidates, except write-in candidates, prefetched,
+        or None if there isn't one.
+        """
+        candidates = Candidate.objects.filter(write_in=False)
+        elections = Election.objects.prefetch_related('ballots',
+            Prefetch('ballots__candidates', queryset=candidates))
+        try:
+            if slug:
+                return elections.get(slug=slug)
+            return elections.latest()
+        except Election.DoesNotExist:
+            return None
+
+    @staticmethod
+    def get_open_for_user(user):
+        """
+        Returns a queryset of the elections that the given account can vote
+        in now, i.e. the ones that are open, that have the account in their
+        allowed_voters or have none, and that it hasn't voted in yet. This
+        is a single query using the indexes on allowed_voters and on the
+        votes' accounts.
+        """
+        now = datetime.now()
+        # an election with no allowed_voters has a single row with NULL for
+        # the account in the outer join, so no election is listed twice
+        return Election.objects.filter(vote_start__lte=now,
+                                       vote_end__gte=now) \
+                               .filter(Q(allowed_voters=user) |
+                                       Q(allowed_voters__isnull=True)) \
+                               .exclude(votes__account=user)
+
     class Meta:
         ordering = ['vote_start']
         get_latest_by = "vote_start"
@@ -176,6 +393,13 @@ class Ballot(models.Model):
         ("Pl", "Plurality"),
         ("Pr", "Preferential"),
     )
+    TALLY_METHODS = (
+        ("borda", "Borda count"),
+        ("irv", "Instant-runoff"),
+        ("stv", "Single transferable vote"),
+        ("schulze", "Schulze"),
+        ("ranked_pairs", "Ranked pairs"),
+    )
     election = models.ForeignKey(Election, related_name="ballots")
     position_number = models.PositiveSmallIntegerField(default=1,
         help_text="Change this if you want to customize the order in which "+\
@@ -191,6 +415,10 @@ class Ballot(models.Model):
         help_text="Check this for a secret ballot. This means that only the "+\
         "fact that a voter voted will be recorded, not his or her choices.")
     write_in_available = models.BooleanField(default=True)
+    tally_method = models.CharField(max_length=20, choices=TALLY_METHODS,
+        default="borda",
+        help_text="How the winners of a preferential ballot are determined. "+\
+        "Only the Borda count can be used for secret ballots.")
 
     def __unicode__(self):
         return "%s %s: %s" % (self.get_type_display(),
@@ -202,34 +430,21 @@ class Ballot(models.Model):
         where x1, x2, ... are the total number of votes if self.type == "Pl"
         or the sum of the point values if self.type == "Pr"
         """
-        stats = []
+        if self.type not in ("Pl", "Pr"):
+            return []
+        candidates = _annotate_totals(self.candidates.all(), self.type)
+        return [(c, c.total) for c in candidates]
+
+    def get_result(self, method=None):
+        """
+        Counts the votes with the given tally method (see
+        django_elect.tally.METHODS), or self.tally_method if it's None, and
+        returns a django_elect.tally.Result. Plurality ballots are always
+        counted by the number of votes.
+        """
         if self.type == "Pl":
-            stats = [(c, VotePlurality.objects.filter(candidate=c).count())
-                     for c in self.candidates.all()]
-            # sort according to # of votes, in reverse order
-            stats.sort(key=lambda x: x[1], reverse=True)
-        elif self.type == "Pr":
-            #fall back to SQL since Django DB API doesn't support sum()
-            from django.db import connection
-            cursor = connection.cursor()
-            query = """
-                SELECT c.id, IF(v.point IS NULL, 0, SUM(v.point)) AS points
-                FROM %(ballot)s b
-                JOIN %(candidate)s c ON (c.ballot_id=b.id)
-                LEFT JOIN %(vote_preferential)s v ON (v.candidate_id=c.id)
-                WHERE b.id = '%(id)i'
-                GROUP BY c.id
-                ORDER BY points DESC
-            """
-            cursor.execute(query % {
-                'ballot': Ballot._meta.db_table,
-                'candidate': Candidate._meta.db_table,
-                'vote_preferential': VotePreferential._meta.db_table,
-                'id': self.pk,
-            })
-            stats = [(Candidate.objects.get(id=c[0]), c[1])
-                     for c in cursor.fetchall()]
-        return stats
+            method = "plurality"
+        return tally.get_method(method or self.tally_method).tally(self)
 
     def candidates_with_biographies(self):
         return self.candidates.exclude(biography="")
@@ -261,6 +476,10 @@ class Candidate(models.Model):
         help_text="Enter the candidate's biography here as HTML. It will "+\
         "be shown when the user clicks the candidate's name. If you leave "+\
         "this field blank, the candidate's name will not be a link.")
+    write_in_key = models.CharField(max_length=255, null=True, blank=True,
+        editable=False)
+    search_key = models.CharField(max_length=255, blank=True, db_index=True,
+        editable=False)
 
     def __unicode__(self):
         parenthesis = self.institution or (self.write_in and "write-in")
@@ -268,12 +487,82 @@ class Candidate(models.Model):
                                  self.first_name, self.last_name,
                                  parenthesis)
 
+    def save(self, *args, **kwargs):
+        self.search_key = normalize_name(self.first_name, self.last_name)
+        if self.write_in:
+            self.write_in_key = self.search_key
+        else:
+            self.write_in_key = None
+        return super(Candidate, self).save(*args, **kwargs)
+
     def get_name(self):
         """Returns full name of candidate."""
         return self.first_name+" "+self.last_name
 
+    @staticmethod
+    def resolve_write_ins(write_ins):
+        """
+        Takes a list of tuples of the form (ballot, first_name, last_name)
+        and returns a list of the corresponding write-in candidates, which
+        are created if they don't exist yet. Names are compared using
+        normalize_name(), so spelling variants resolve to the same candidate.
+        Existing candidates are fetched with a single query.
+        """
+        keys = [(ballot.pk, normalize_name(first_name, last_name))
+                for ballot, first_name, last_name in write_ins]
+        if not keys:
+            return []
+        query = reduce(operator.or_, [Q(ballot=ballot_id, write_in_key=key)
+                                      for ballot_id, key in set(keys)])
+        found = dict(((c.ballot_id, c.write_in_key), c)
+                     for c in Candidate.objects.filter(query, write_in=True))
+        # create missing candidates in a consistent order to avoid deadlocks
+        missing = sorted(set(keys) - set(found))
+        by_key = dict(zip(keys, write_ins))
+        for key in missing:
+            ballot, first_name, last_name = by_key[key]
+            found[key] = Candidate._create_write_in(ballot, first_name,
+                                                    last_name)
+        return [found[key] for key in keys]
+
+    @staticmethod
+    def _create_write_in(ballot, first_name, last_name):
+        try:
+            with transaction.atomic():
+                return Candidate.objects.create(ballot=ballot, write_in=True,
+                    first_name=first_name, last_name=last_name,
+                    incumbent=False)
+        except IntegrityError:
+            # created by a concurrent submission. A locking read is used so
+            # the new row is visible under REPEATABLE READ isolation.
+            return Candidate.objects.select_for_update().get(ballot=ballot,
+                write_in_key=normalize_name(first_name, last_name))
+
     class Meta:
         ordering = ['last_name', 'first_name']
+        index_together = [('ballot', 'write_in')]
+        # write_in_key is NULL for candidates that aren't write-ins, so this
+        # only applies to write-in candidates
+        unique_together = [('ballot', 'write_in_key')]
+
+
+def normalize_name(first_name, last_name):
+    """
+    Returns the key used to identify write-in candidates and to search for
+    candidates, which is the full name in lower case without accents or
+    redundant whitespace.
+    """
+    return normalize_text(first_name + " " + last_name)
+
+
+def normalize_text(text):
+    """
+    Returns the given text in lower case without accents or redundant
+    whitespace, as used by normalize_name().
+    """
+    text = unicodedata.normalize('NFKD', force_text(text))
+    text = u"".join(c for c in text if not unicodedata.combining(c))
+    return u" ".join(text.lower().split())[:255]
 
 
 class Vote(models.Model):
@@ -283,6 +572,10 @@ class Vote(models.Model):
     """
     account = models.ForeignKey(settings.DJANGO_ELECT_USER_MODEL, null=True)
     election = models.ForeignKey(Election, related_name="votes")
+    # random token from the vote form, so a repeated submission of the same
+    # form can be recognized. Cleared along with the account.
+    token = models.CharField(max_length=32, null=True, unique=True,
+        editable=False)
 
     def __unicode__(self):
         return unicode(self.account) + " - " + unicode(self.election)
@@ -291,21 +584,74 @@ class Vote(models.Model):
         """
         Returns list in form
         [ (ballot1, [vote1, vote2, ...]), (ballot2, [vote3, vote4, ...]), ...]
+        The details loaded by Vote.prefetch_details() are used if available.
+        """
+        details = getattr(self, '_prefetched_details', None)
+        if details is None:
+            details = Vote.get_details_for([self])[self.pk]
+        return details
+
+    @staticmethod
+    def get_details_for(votes):
         """
-        details = []
-        for ballot in self.election.ballots.all():
-            votes = []
-            if ballot.type == "Pl":
-                votes = (self.pluralities
-                             .filter(candidate__ballot=ballot)
-                             .order_by('candidate'))
-            elif ballot.type == "Pr":
-                votes = (self.preferentials
-                             .filter(candidate__ballot=ballot)
-                             .order_by('candidate'))
-            details.append((ballot, votes))
+        Returns a dictionary mapping the primary key of each of the given
+        votes to its details, in the form returned by get_details(). Uses
+        three queries, however many votes and ballots there are.
+        """
+        votes = list(votes)
+        ballots = Ballot.objects.filter(
+            election__in=set(v.election_id for v in votes))
+        selections = {}
+        vote_ids = [v.pk for v in votes]
+        for model in (VotePlurality, VotePreferential):
+            query = model.objects.filter(vote__in=vote_ids) \
+                                 .select_related('candidate') \
+                                 .order_by('candidate')
+            for selection in query:
+                key = (selection.vote_id, selection.candidate.ballot_id)
+                selections.setdefault(key, []).append(selection)
+        by_election = {}
+        for ballot in ballots:
+            by_election.setdefault(ballot.election_id, []).append(ballot)
+        details = {}
+        for vote in votes:
+            details[vote.pk] = [
+                (ballot, selections.get((vote.pk, ballot.pk), []))
+                for ballot in by_election.get(vote.election_id, [])]
         return details
 
+    @staticmethod
+    def prefetch_details(votes):
+        """
+        Loads the details of the given list of votes with get_details_for(),
+        so their get_details() doesn't have to query the database.
+        """
+        details = Vote.get_details_for(votes)
+        for vote in votes:
+            vote._prefetched_details = details[vote.pk]
+
+    class Meta:
+        # also makes sure an account can only vote once per election. NULL
+        # accounts (i.e. disassociated votes) aren't considered equal.
+        unique_together = [('election', 'account')]
+
+
+def _annotate_totals(candidates, ballot_type):
+    """
+    Annotates the given Candidate queryset with "total", which is the number
+    of votes if ballot_type == "Pl" or the sum of the point values if
+    ballot_type == "Pr", and orders it by that in descending order. The
+    totals are read from CandidateTally instead of the vote tables, after
+    creating any that are missing.
+    """
+    CandidateTally.create_missing(candidates)
+    if ballot_type == "Pl":
+        total = Coalesce('tally__votes', V(0))
+    else:
+        total = Coalesce('tally__points', V(0))
+    return (candidates.annotate(total=total)
+                      .order_by('-total', 'last_name', 'first_name'))
+
 
 def _get_choices(ballot_type):
     """
@@ -330,6 +676,9 @@ class VotePreferential(models.Model):
         return "%s vote, %i points for %s" % (self.vote, self.point,
                                               self.candidate.get_name())
 
+    class Meta:
+        index_together = [('candidate', 'point')]
+
 
 class VotePlurality(models.Model):
     """
@@ -341,3 +690,304 @@ class VotePlurality(models.Model):
 
     def __unicode__(self):
         return "%s vote for %s" % (self.vote, self.candidate.get_name())
+
+    class Meta:
+        index_together = [('candidate', 'vote')]
+
+
+class CandidateTally(models.Model):
+    """
+    Running totals of the selections for a single candidate. These are kept
+    up to date as VotePlurality and VotePreferential objects are created and
+    deleted, so statistics can be read without scanning the vote tables. Use
+    the rebuild_tallies management command to verify or repair them.
+    """
+    candidate = models.OneToOneField(Candidate, primary_key=True,
+        related_name="tally")
+    votes = models.IntegerField(default=0)
+    points = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return "%s: %i votes, %i points" % (self.candidate.get_name(),
+                                            self.votes, self.points)
+
+    @staticmethod
+    def add_selections(selections, sign=1):
+        """
+        Adds the given VotePlurality and VotePreferential objects to the
+        tallies for their candidates (or subtracts them if sign is -1) using
+        a single UPDATE query. Should be called in the same transaction that
+        the selections are saved in.
+        """
+        votes, points = {}, {}
+        for selection in selections:
+            pk = selection.candidate_id
+            votes[pk] = votes.get(pk, 0) + sign
+            points[pk] = points.get(pk, 0) + sign * getattr(selection,
+                                                            'point', 0)
+        if not votes:
+            return
+        updated = CandidateTally._increment(votes, points)
+        if updated < len(votes) and sign > 0:
+            # only happens if tallies are missing for some candidates, e.g.
+            # because they were loaded from a fixture or deleted manually.
+            # Their tallies are counted from the vote tables, which already
+            # include the new selections.
+            CandidateTally.create_missing(
+                Candidate.objects.filter(pk__in=votes.keys()))
+
+    @staticmethod
+    def create_missing(candidates):
+        """
+        Creates the missing tallies for the given Candidate queryset by
+        counting their selections in the vote tables, e.g. for candidates
+        that were loaded from a fixture, since no tallies are created for
+        those when they're saved. Returns the number of tallies created.
+        """
+        missing = list(candidates.filter(tally__isnull=True)
+                                 .values_list('pk', flat=True))
+        if not missing:
+            return 0
+        counts = CandidateTally.count_selections(
+            Candidate.objects.filter(pk__in=missing))
+        for pk, (votes, points) in counts.items():
+            CandidateTally.objects.get_or_create(candidate_id=pk,
+                defaults={'votes': votes, 'points': points})
+        return len(counts)
+
+    @staticmethod
+    def _increment(votes, points):
+        """
+        Adds the values in the given dictionaries, which map candidate IDs to
+        numbers, to the tallies. Returns number of tallies updated.
+        """
+        def deltas(values):
+            return Case(*[When(pk=pk, then=V(value))
+                          for pk, value in values.items()],
+                        default=V(0), output_field=models.IntegerField())
+        return CandidateTally.objects.filter(pk__in=votes.keys()).update(
+            votes=F('votes') + deltas(votes),
+            points=F('points') + deltas(points))
+
+    @staticmethod
+    def count_selections(candidates):
+        """
+        Counts the selections for the given Candidate queryset directly from
+        the vote tables. Returns a dictionary mapping candidate IDs to tuples
+        of the form (votes, points).
+        """
+        counts = dict((pk, (0, 0))
+                      for pk in candidates.values_list('pk', flat=True))
+        pluralities = VotePlurality.objects.filter(candidate__in=candidates) \
+            .values('candidate').annotate(votes=Count('id'))
+        for row in pluralities:
+            votes, points = counts[row['candidate']]
+            counts[row['candidate']] = (votes + row['votes'], points)
+        preferentials = VotePreferential.objects \
+            .filter(candidate__in=candidates) \
+            .values('candidate').annotate(votes=Count('id'),
+                                          points=Sum('point'))
+        for row in preferentials:
+            votes, points = counts[row['candidate']]
+            counts[row['candidate']] = (votes + row['votes'],
+                                        points + row['points'])
+        return counts
+
+
+class AccountSearchKey(models.Model):
+    """
+    Normalized names of accounts, which the default account search backend
+    (django_elect.account_search.AccountNameBackend) searches instead of the
+    user table. Each account has a key for its full name and one for each
+    later word of it, so the beginning of any of its names can be matched
+    using the index. Kept up to date when accounts are saved; use the
+    rebuild_account_search management command after changing accounts in
+    bulk.
+    """
+    account = models.ForeignKey(settings.DJANGO_ELECT_USER_MODEL,
+        related_name="+")
+    key = models.CharField(max_length=255)
+
+    def __unicode__(self):
+        return self.key
+
+    @staticmethod
+    def get_keys(first_name, last_name):
+        """
+        Returns the search keys for an account with the given name.
+        """
+        words = normalize_name(first_name, last_name).split()
+        return sorted(set(u" ".join(words[i:]) for i in range(len(words))))
+
+    @staticmethod
+    def update_accounts(accounts):
+        """
+        Replaces the search keys of the given accounts.
+        """
+        with transaction.atomic():
+            AccountSearchKey.objects.filter(
+                account__in=[a.pk for a in accounts]).delete()
+            AccountSearchKey.objects.bulk_create([
+                AccountSearchKey(account_id=account.pk, key=key)
+                for account in accounts
+                for key in AccountSearchKey.get_keys(account.first_name,
+                                                     account.last_name)])
+
+    class Meta:
+        index_together = [('key', 'account')]
+
+
+@receiver(post_save, sender=Candidate)
+def _create_tally(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        CandidateTally.objects.get_or_create(candidate=instance)
+
+
+@receiver(pre_save, sender=VotePlurality)
+@receiver(pre_save, sender=VotePreferential)
+def _remember_selection(sender, instance, raw=False, **kwargs):
+    # store the old version of a selection that's being changed, so it can be
+    # taken out of the tallies once the new one is saved
+    instance._old_selection = None
+    if instance.pk and not raw:
+        instance._old_selection = sender.objects.filter(pk=instance.pk) \
+                                                .first()
+
+
+@receiver(post_save, sender=VotePlurality)
+@receiver(post_save, sender=VotePreferential)
+def _tally_saved_selection(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    old_selection = getattr(instance, '_old_selection', None)
+    if old_selection:
+        CandidateTally.add_selections([old_selection], sign=-1)
+    CandidateTally.add_selections([instance])
+
+
+@receiver(post_delete, sender=VotePlurality)
+@receiver(post_delete, sender=VotePreferential)
+def _tally_deleted_selection(sender, instance, **kwargs):
+    CandidateTally.add_selections([instance], sign=-1)
+
+
+@receiver(post_save, sender=VotePlurality)
+@receiver(post_save, sender=VotePreferential)
+@receiver(post_delete, sender=VotePlurality)
+@receiver(post_delete, sender=VotePreferential)
+def _selection_changed(sender, instance, raw=False, **kwargs):
+    election_id = Ballot.objects.filter(candidates=instance.candidate_id) \
+                                .values_list('election', flat=True).first()
+    if election_id is not None:
+        caching.invalidate_election(election_id)
+
+
+@receiver(post_save, sender=Election)
+def _election_saved(sender, instance, raw=False, **kwargs):
+    caching.invalidate_eligibility(instance.pk)
+    caching.invalidate_election(instance.pk)
+    caching.invalidate_biographies(instance.pk)
+    caching.invalidate_current_election()
+
+
+@receiver(post_delete, sender=Election)
+def _election_deleted(sender, instance, **kwargs):
+    caching.invalidate_current_election()
+
+
+@receiver(m2m_changed, sender=Election.allowed_voters.through)
+def _allowed_voters_changed(sender, instance, action, reverse, pk_set,
+                            **kwargs):
+    if reverse:
+        # instance is an account, and pk_set contains Election IDs
+        if action == 'pre_clear':
+            # the elections can't be found once the rows are removed, so
+            # they're remembered until the post_clear signal
+            instance._django_elect_cleared = list(
+                Election.objects.filter(allowed_voters=instance)
+                                .values_list('pk', flat=True))
+            return
+        elif action == 'post_clear':
+            pk_set = getattr(instance, '_django_elect_cleared', [])
+            instance._django_elect_cleared = []
+        elif action not in ('post_add', 'post_remove'):
+            return
+        election_ids = pk_set
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        election_ids = [instance.pk]
+    else:
+        return
+    for election_id in election_ids:
+        caching.invalidate_eligibility(election_id)
+
+
+@receiver(post_save)
+def _account_saved(sender, instance, raw=False, update_fields=None,
+                   **kwargs):
+    # the user model can't be given as the sender, since it may not be
+    # loaded yet when this module is
+    if raw or sender is not Vote._meta.get_field('account').rel.to:
+        return
+    from django_elect.account_search import AccountNameBackend, get_backend
+    backend = get_backend()
+    if not isinstance(backend, AccountNameBackend):
+        # other backends don't keep an index of the names, which the user
+        # model might not even have
+        return
+    if update_fields and not {'first_name', 'last_name'} & update_fields:
+        # e.g. last_login being updated
+        return
+    backend.update_accounts([instance])
+
+
+@receiver(post_save, sender=Vote)
+def _vote_saved(sender, instance, created, raw=False, **kwargs):
+    if not created:
+        # the account might have changed, so we don't know which accounts
+        # are affected
+        caching.invalidate_eligibility(instance.election_id)
+    elif instance.account_id:
+        caching.invalidate_eligibility(instance.election_id,
+                                       instance.account_id)
+    caching.invalidate_election(instance.election_id)
+
+
+@receiver(post_delete, sender=Vote)
+def _vote_deleted(sender, instance, **kwargs):
+    if instance.account_id:
+        caching.invalidate_eligibility(instance.election_id,
+                                       instance.account_id)
+    caching.invalidate_election(instance.election_id)
+
+
+@receiver(post_save, sender=Ballot)
+@receiver(post_delete, sender=Ballot)
+def _ballot_changed(sender, instance, raw=False, **kwargs):
+    caching.invalidate_ballot(instance.pk)
+    caching.invalidate_election(instance.election_id)
+    caching.invalidate_current_election()
+    caching.invalidate_biographies(instance.election_id)
+
+
+@receiver(post_save, sender=Candidate)
+@receiver(post_delete, sender=Candidate)
+def _candidate_changed(sender, instance, raw=False, created=False,
+                       **kwargs):
+    caching.invalidate_candidates(instance.ballot_id)
+    # write-in candidates aren't shown on the voting page, and only on the
+    # biographies page if someone gave them a biography
+    if not instance.write_in:
+        caching.invalidate_ballot(instance.ballot_id)
+    elif created and not instance.biography:
+        # new write-in candidates are created along with a vote, which
+        # changes the election's version stamp anyway
+        return
+    caching.invalidate_current_election()
+    election_id = Ballot.objects.filter(pk=instance.ballot_id) \
+                                .values_list('election', flat=True).first()
+    # if the ballot is being deleted too, its own signal handles it
+    if election_id is None:
+        return
+    caching.invalidate_election(election_id)
+    if not instance.write_in or instance.biography:
+        caching.invalidate_biographies(election_id)
@@ -0,0 +1,192 @@
+"""
+Pairwise preference matrices for preferential ballots, which the Condorcet
+methods in django_elect.tally are based on.
+
+Building a matrix takes a single pass over the ballot's VotePreferential
+rows. get_matrix() caches it per ballot, and when it's next asked for, only
+adds the votes cast since. Changes that can't be picked up that way, e.g.
+deleted or edited selections, are detected by comparing the matrix against
+the candidate tallies, in which case the matrix is rebuilt.
+"""
+from collections import defaultdict
+
+from django_elect import caching, settings
+
+
+# number of distinct rankings to collect before adding them to the matrix
+BATCH_SIZE = 1000
+
+
+class PairwiseMatrix(object):
+    """
+    Candidates are numbered from 1 in the order of self.candidate_ids, and
+    self.prefer[i][j] is the number of votes ranking candidate i above j.
+    Unranked candidates count as ranked below all ranked ones.
+
+    self.last_vote_id is the highest ID of the votes included and
+    self.totals maps each candidate's ID to the number of selections and
+    the sum of their points in the included votes, which should match the
+    candidate's CandidateTally.
+    """
+    def __init__(self, candidate_ids=()):
+        self.candidate_ids = []
+        self.prefer = [[0]]
+        # number of included votes that ranked each candidate
+        self.ranked = [0]
+        self.last_vote_id = 0
+        self.totals = {}
+        self.add_candidates(candidate_ids)
+
+    def add_candidates(self, candidate_ids):
+        """
+        Adds candidates that none of the included votes ranked, e.g.
+        write-in candidates entered since the matrix was built.
+        """
+        for pk in candidate_ids:
+            self.candidate_ids.append(pk)
+            # everyone who ranked a candidate preferred them over this one
+            for row, ranked in zip(self.prefer, self.ranked):
+                row.append(ranked)
+            self.prefer.append([0] * (len(self.candidate_ids) + 1))
+            self.ranked.append(0)
+            self.totals[pk] = (0, 0)
+
+    def add_votes(self, selections):
+        """
+        Adds votes from an iterable of (vote ID, candidate ID, points)
+        tuples, ordered by vote ID and then by points in descending order.
+        Identical rankings are collected and added in batches.
+        """
+        numbers = dict((pk, i + 1) for i, pk in enumerate(self.candidate_ids))
+        groups = defaultdict(int)
+        ranking, last_vote = [], None
+        for vote_id, candidate_id, point in selections:
+            if vote_id != last_vote and ranking:
+                groups[tuple(ranking)] += 1
+                ranking = []
+                if len(groups) >= BATCH_SIZE:
+                    self.add_groups(groups)
+                    groups.clear()
+            last_vote = vote_id
+            if candidate_id not in numbers:
+                # added after the candidates were read; the totals won't
+                # match, so the matrix will be rebuilt
+                continue
+            ranking.append(numbers[candidate_id])
+            votes, points = self.totals[candidate_id]
+            self.totals[candidate_id] = (votes + 1, points + point)
+        if ranking:
+            groups[tuple(ranking)] += 1
+        self.add_groups(groups)
+        if last_vote is not None:
+            self.last_vote_id = max(self.last_vote_id, last_vote)
+
+    def add_groups(self, groups):
+        """
+        Adds rankings given as a dictionary mapping tuples of candidate
+        numbers to their number of votes, as returned by Rankings.group().
+        """
+        pairwise_preferences(groups, len(self.candidate_ids), self.prefer)
+        for ranking, weight in groups.iteritems():
+            for n in ranking:
+                self.ranked[n] += weight
+
+    def get_margins(self):
+        """
+        Returns a list with a row for each candidate, in the form
+        (candidate ID, [margin against candidate 1, ...]), where the margin
+        is the number of votes preferring the candidate minus the number of
+        votes preferring the other one, or None for the candidate itself.
+        """
+        numbers = range(1, len(self.candidate_ids) + 1)
+        prefer = self.prefer
+        return [(pk, [prefer[i][j] - prefer[j][i] if i != j else None
+                      for j in numbers])
+                for i, pk in zip(numbers, self.candidate_ids)]
+
+
+def pairwise_preferences(groups, num_candidates, prefer=None):
+    """
+    Returns a matrix (as a list of lists indexed by candidate number) where
+    entry [i][j] is the number of votes that rank candidate i above j. If
+    prefer is given, the votes are added to it instead of a new matrix.
+    """
+    if prefer is None:
+        prefer = [[0] * (num_candidates + 1)
+                  for i in xrange(num_candidates + 1)]
+    everyone = set(range(1, num_candidates + 1))
+    for ranking, weight in groups.iteritems():
+        unranked = everyone.difference(ranking)
+        for position, n in enumerate(ranking):
+            row = prefer[n]
+            for m in ranking[position + 1:]:
+                row[m] += weight
+            for m in unranked:
+                row[m] += weight
+    return prefer
+
+
+def strongest_paths(prefer, num_candidates):
+    """
+    Returns the strengths of the strongest paths between each pair of
+    candidates, given the pairwise preference matrix.
+    """
+    candidates = range(1, num_candidates + 1)
+    strength = [[0] * (num_candidates + 1) for i in xrange(num_candidates + 1)]
+    for i in candidates:
+        for j in candidates:
+            if i != j and prefer[i][j] > prefer[j][i]:
+                strength[i][j] = prefer[i][j]
+    for k in candidates:
+        for i in candidates:
+            if i == k:
+                continue
+            row_i, via = strength[i], strength[i][k]
+            if not via:
+                continue
+            row_k = strength[k]
+            for j in candidates:
+                if j != i and j != k:
+                    row_i[j] = max(row_i[j], min(via, row_k[j]))
+    return strength
+
+
+def _get_selections(ballot, after_vote_id=0):
+    from django_elect.models import VotePreferential
+    return VotePreferential.objects \
+        .filter(candidate__ballot=ballot, vote__gt=after_vote_id) \
+        .order_by('vote', '-point', 'candidate') \
+        .values_list('vote', 'candidate', 'point') \
+        .iterator()
+
+
+def build_matrix(ballot):
+    """
+    Builds the pairwise preference matrix of the given ballot from scratch.
+    """
+    matrix = PairwiseMatrix(ballot.candidates.order_by('pk')
+                                  .values_list('pk', flat=True))
+    matrix.add_votes(_get_selections(ballot))
+    return matrix
+
+
+def get_matrix(ballot):
+    """
+    Returns the pairwise preference matrix of the given ballot, updating the
+    cached one with the votes cast since it was built if possible.
+    """
+    cache = caching.get_cache()
+    key = "django_elect:pairwise:%s" % ballot.pk
+    totals = dict((pk, (votes or 0, points or 0)) for pk, votes, points in
+                  ballot.candidates.values_list('pk', 'tally__votes',
+                                                'tally__points'))
+    matrix = cache.get(key)
+    if matrix is not None:
+        matrix.add_candidates(sorted(set(totals) - set(matrix.totals)))
+        matrix.add_votes(_get_selections(ballot, matrix.last_vote_id))
+    if matrix is None or matrix.totals != totals:
+        # e.g. a selection was deleted, or a vote with a lower ID was
+        # committed after a later one was added
+        matrix = build_matrix(ballot)
+    cache.set(key, matrix, settings.DJANGO_ELECT_PAIRWISE_CACHE_TIMEOUT)
+    return matrix
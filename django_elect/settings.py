@@ -15,7 +15,7 @@ DJANGO_ELECT_USER_MODEL = getattr(settings,
 
 """
 Function to filter a queryset on the user model with a free-form query.
-Used by django_elect.autocomplete.AccountAutocomplete.
+Used by django_elect.account_search.FilterBackend.
 """
 DJANGO_ELECT_USER_AUTOCOMPLETE_FILTER = getattr(settings,
     'DJANGO_ELECT_USER_AUTOCOMPLETE_FILTER',
@@ -35,3 +35,128 @@ DJANGO_ELECT_MIGRATION_DEPENDENCIES = getattr(settings,
 URL to redirect voters to who are not logged in.
 """
 LOGIN_URL = getattr(settings, 'LOGIN_URL', '/account/')
+
+
+"""
+Alias of the cache (as defined in the CACHES setting) that django_elect uses
+for caching, e.g. for voter eligibility. It must be shared by all the
+processes serving the site, e.g. memcached or the database cache, since it
+holds the version stamps that invalidate cached data and the ETags of the
+statistics and exports. With a per-process cache such as the default
+LocMemCache, the other processes keep serving stale pages, so the system
+checks warn about it (django_elect.W001).
+"""
+DJANGO_ELECT_CACHE = getattr(settings, 'DJANGO_ELECT_CACHE', 'default')
+
+
+"""
+Number of seconds to cache whether a voter is allowed to vote in an election.
+The cache is invalidated whenever allowed_voters changes or the voter votes,
+so this only limits how long unused entries are kept.
+"""
+DJANGO_ELECT_ELIGIBILITY_CACHE_TIMEOUT = getattr(settings,
+    'DJANGO_ELECT_ELIGIBILITY_CACHE_TIMEOUT', 60 * 60)
+
+
+"""
+Number of seconds to cache the static parts of the ballot tables on the
+voting page. The cache is invalidated whenever a ballot or one of its
+candidates is changed.
+"""
+DJANGO_ELECT_BALLOT_CACHE_TIMEOUT = getattr(settings,
+    'DJANGO_ELECT_BALLOT_CACHE_TIMEOUT', 24 * 60 * 60)
+
+
+"""
+Number of seconds to cache the current election along with its ballots and
+candidates for the voting page. The cache is invalidated whenever an
+election, ballot or candidate is changed, and when voting starts or ends.
+"""
+DJANGO_ELECT_ELECTION_CACHE_TIMEOUT = getattr(settings,
+    'DJANGO_ELECT_ELECTION_CACHE_TIMEOUT', 60 * 60)
+
+"""
+Number of seconds to cache the rendered biographies page. The cache is
+invalidated whenever the election or one of its ballots or candidates is
+changed.
+"""
+DJANGO_ELECT_BIOGRAPHIES_CACHE_TIMEOUT = getattr(settings,
+    'DJANGO_ELECT_BIOGRAPHIES_CACHE_TIMEOUT', 24 * 60 * 60)
+
+
+"""
+Number of votes to update at a time when disassociating accounts from the
+admin or with the disassociate_accounts management command, and the number
+of seconds to wait between batches.
+"""
+DJANGO_ELECT_DISASSOCIATE_BATCH_SIZE = getattr(settings,
+    'DJANGO_ELECT_DISASSOCIATE_BATCH_SIZE', 1000)
+DJANGO_ELECT_DISASSOCIATE_SLEEP = getattr(settings,
+    'DJANGO_ELECT_DISASSOCIATE_SLEEP', 0.1)
+
+
+"""
+Dictionary of additional methods for counting ballots, mapping names (as
+passed to the tally_ballot management command) to subclasses of
+django_elect.tally.TallyMethod or dotted paths to them.
+"""
+DJANGO_ELECT_TALLY_METHODS = getattr(settings,
+    'DJANGO_ELECT_TALLY_METHODS', {})
+
+
+"""
+Number of seconds to cache the pairwise preference matrices of preferential
+ballots, which the Schulze and ranked pairs methods use. Cached matrices are
+updated with new votes when they're read, so this only limits how long
+unused ones are kept.
+"""
+DJANGO_ELECT_PAIRWISE_CACHE_TIMEOUT = getattr(settings,
+    'DJANGO_ELECT_PAIRWISE_CACHE_TIMEOUT', 24 * 60 * 60)
+
+
+"""
+Path of the SQLite database to spool votes to. If set, the voting page only
+validates votes and appends them to the spool, and the drain_vote_spool
+management command (which must be kept running) stores them in the database.
+This takes load off the database when many voters vote at once. The spool
+must be on a local disk that all the web server processes share.
+"""
+DJANGO_ELECT_SPOOL_PATH = getattr(settings, 'DJANGO_ELECT_SPOOL_PATH', None)
+
+
+"""
+Maximum number of spooled votes that drain_vote_spool stores at a time.
+"""
+DJANGO_ELECT_SPOOL_BATCH_SIZE = getattr(settings,
+    'DJANGO_ELECT_SPOOL_BATCH_SIZE', 500)
+
+
+"""
+Dotted path to the class used to search accounts in the admin, a subclass
+of django_elect.account_search.AccountSearchBackend. The default backend
+searches a table of normalized names that's kept up to date when accounts
+are saved. FilterBackend uses DJANGO_ELECT_USER_AUTOCOMPLETE_FILTER instead,
+which suits user models without first_name and last_name fields.
+"""
+DJANGO_ELECT_ACCOUNT_SEARCH_BACKEND = getattr(settings,
+    'DJANGO_ELECT_ACCOUNT_SEARCH_BACKEND',
+    'django_elect.account_search.AccountNameBackend')
+
+
+"""
+Number of times a query has to be run with different parameters during one
+request to a django_elect view before
+django_elect.instrumentation.InstrumentationMiddleware logs a warning about
+it, as it usually means a missing select_related() or prefetch_related().
+"""
+DJANGO_ELECT_REPEATED_QUERY_THRESHOLD = getattr(settings,
+    'DJANGO_ELECT_REPEATED_QUERY_THRESHOLD', 5)
+
+
+"""
+Token that gives access to the metrics view when sent in an
+"Authorization: Bearer <token>" header, e.g. by a Prometheus server. If
+None, only logged in staff members can see the metrics.
+"""
+DJANGO_ELECT_METRICS_TOKEN = getattr(settings,
+    'DJANGO_ELECT_METRICS_TOKEN', None)
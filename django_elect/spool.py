@@ -0,0 +1,283 @@
+"""
+Optional spool for votes, used instead of writing votes to the database
+during the request when DJANGO_ELECT_SPOOL_PATH is set.
+
+The vote view validates the ballots as usual and then appends a signed
+record of the vote to a local SQLite database in WAL mode, which is cheap
+and durable. A unique index on (election, account) in the spool keeps
+voters from voting twice before their first vote has been stored. The
+drain_vote_spool management command moves the spooled votes into the
+database in batches, and vote_spool_status shows the backlog.
+"""
+import sqlite3
+import threading
+import time
+
+from django.core import signing
+from django.db import transaction, IntegrityError
+
+from django_elect import caching, settings
+from django_elect.models import Ballot, Candidate, CandidateTally, Vote, \
+    VotePlurality, VotePreferential, VotingNotAllowedException
+
+
+SALT = "django_elect.spool"
+
+# errors that mean a vote can't be stored, as opposed to e.g. the database
+# being unavailable, in which case the votes are left in the spool
+STORE_ERRORS = (KeyError, TypeError, ValueError, IntegrityError)
+
+# values of the status column
+PENDING = 0
+STORED = 1
+FAILED = 2
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS spooled_vote (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        election_id INTEGER NOT NULL,
+        account_id INTEGER NOT NULL,
+        record TEXT NOT NULL,
+        created REAL NOT NULL,
+        status INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        token TEXT,
+        UNIQUE (election_id, account_id)
+    );
+    CREATE INDEX IF NOT EXISTS spooled_vote_status
+        ON spooled_vote (status, id);
+"""
+
+_local = threading.local()
+
+
+def is_enabled():
+    return bool(settings.DJANGO_ELECT_SPOOL_PATH)
+
+
+def get_connection():
+    """
+    Returns a connection to the spool for the current thread, creating the
+    spool if it doesn't exist yet.
+    """
+    path = settings.DJANGO_ELECT_SPOOL_PATH
+    connection = getattr(_local, 'connection', None)
+    if connection is None or _local.path != path:
+        # autocommit, so every insert is durable once it returns
+        connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = FULL")
+        connection.executescript(SCHEMA)
+        _local.connection, _local.path = connection, path
+    return connection
+
+
+def enqueue(election, account, forms, token=None):
+    """
+    Appends a vote with the choices on the given (valid) vote forms and the
+    given idempotency token to the spool. Raises VotingNotAllowedException
+    if the account already has a vote for the election in the spool.
+    """
+    record = signing.dumps({
+        'election': election.pk,
+        'account': account.pk,
+        'token': token,
+        'ballots': [form.get_record() for form in forms],
+    }, salt=SALT, compress=True)
+    try:
+        get_connection().execute(
+            "INSERT INTO spooled_vote (election_id, account_id, record, "
+            "created, token) VALUES (?, ?, ?, ?, ?)",
+            (election.pk, account.pk, record, time.time(), token))
+    except sqlite3.IntegrityError:
+        raise VotingNotAllowedException('The account %s is not allowed to '
+            'vote in this election.' % unicode(account))
+
+
+def has_vote(election, account, token=None):
+    """
+    Returns True if the given account has a vote for the given election in
+    the spool, whether it has been stored yet or not. If token is given,
+    only a vote with that idempotency token counts.
+    """
+    query = "SELECT 1 FROM spooled_vote WHERE election_id = ? AND " +\
+            "account_id = ?"
+    params = [election.pk, account.pk]
+    if token:
+        query += " AND token = ?"
+        params.append(token)
+    return get_connection().execute(query, params).fetchone() is not None
+
+
+def get_status():
+    """
+    Returns a list of dictionaries with the keys "election_id", "pending",
+    "stored", "failed" and "oldest_pending" (the time the oldest pending vote
+    was spooled, or None), one for each election in the spool.
+    """
+    cursor = get_connection().execute(
+        "SELECT election_id, status, COUNT(*), MIN(created) "
+        "FROM spooled_vote GROUP BY election_id, status "
+        "ORDER BY election_id")
+    elections = {}
+    for election_id, status, count, oldest in cursor:
+        info = elections.setdefault(election_id, {
+            'election_id': election_id, 'pending': 0, 'stored': 0,
+            'failed': 0, 'oldest_pending': None,
+        })
+        if status == PENDING:
+            info['pending'], info['oldest_pending'] = count, oldest
+        elif status == STORED:
+            info['stored'] = count
+        else:
+            info['failed'] = count
+    return [elections[pk] for pk in sorted(elections)]
+
+
+def get_failed(limit=None):
+    """
+    Returns a list of (spool ID, election ID, account ID, error) tuples for
+    the votes that couldn't be stored.
+    """
+    query = "SELECT id, election_id, account_id, error FROM spooled_vote " +\
+            "WHERE status = ? ORDER BY id"
+    if limit:
+        query += " LIMIT %i" % limit
+    return list(get_connection().execute(query, (FAILED,)))
+
+
+def retry_failed():
+    """
+    Marks the votes that couldn't be stored as pending again, e.g. after
+    fixing the cause, and returns their number.
+    """
+    return get_connection().execute(
+        "UPDATE spooled_vote SET status = ?, error = NULL WHERE status = ?",
+        (PENDING, FAILED)).rowcount
+
+
+def drain(batch_size=None):
+    """
+    Stores up to batch_size pending votes from the spool in the database,
+    and returns the number of votes processed. The votes are stored in a
+    single transaction with bulk inserts, unless that fails, in which case
+    they're stored one at a time so a single bad vote doesn't hold up the
+    rest. Votes are left in the spool if the database can't be reached.
+    Only one process should drain the spool at a time.
+    """
+    connection = get_connection()
+    rows = connection.execute(
+        "SELECT id, record FROM spooled_vote WHERE status = ? ORDER BY id "
+        "LIMIT ?", (PENDING, batch_size or
+                    settings.DJANGO_ELECT_SPOOL_BATCH_SIZE)).fetchall()
+    results = {}
+    records = []
+    for spool_id, record in rows:
+        try:
+            records.append((spool_id, signing.loads(record, salt=SALT)))
+        except signing.BadSignature:
+            results[spool_id] = "Invalid signature"
+    try:
+        store_votes([r for spool_id, r in records])
+    except STORE_ERRORS:
+        for spool_id, record in records:
+            try:
+                store_votes([record])
+            except STORE_ERRORS as e:
+                results[spool_id] = "%s: %s" % (e.__class__.__name__, e)
+
+    # the records of stored votes are cleared, since they link the account
+    # to its choices even on secret ballots; the rest of the row is still
+    # needed by has_vote() and get_status()
+    connection.execute("BEGIN")
+    connection.executemany(
+        "UPDATE spooled_vote SET status = ?, error = ? WHERE id = ?",
+        [(FAILED, error, spool_id) for spool_id, error in results.items()])
+    connection.executemany(
+        "UPDATE spooled_vote SET status = ?, record = '' WHERE id = ?",
+        [(STORED, spool_id) for spool_id, record in rows
+         if spool_id not in results])
+    connection.execute("COMMIT")
+    return len(rows)
+
+
+def purge(election_id):
+    """
+    Removes the stored and failed votes of the election with the given
+    primary key from the spool, so it doesn't keep the accounts of the
+    voters once they've been disassociated from the votes, and returns
+    their number. Pending votes are kept, since they haven't been stored
+    yet.
+    """
+    if not is_enabled():
+        return 0
+    return get_connection().execute(
+        "DELETE FROM spooled_vote WHERE election_id = ? AND status != ?",
+        (election_id, PENDING)).rowcount
+
+
+def store_votes(records):
+    """
+    Creates the votes and selections for the given spool records in a
+    single transaction. Votes for accounts that already voted in the
+    election are skipped, e.g. if the spool was drained before but the
+    status couldn't be updated.
+    """
+    with transaction.atomic():
+        elections = {}
+        for record in records:
+            elections.setdefault(record['election'], []).append(record)
+        votes = {}
+        for election_id, election_records in elections.items():
+            accounts = [r['account'] for r in election_records]
+            existing = set(Vote.objects.filter(election=election_id,
+                account__in=accounts).values_list('account', flat=True))
+            Vote.objects.bulk_create([Vote(election_id=election_id,
+                                           account_id=r['account'],
+                                           token=r.get('token'))
+                                      for r in election_records
+                                      if r['account'] not in existing])
+            # bulk_create() doesn't return the IDs on every database
+            created = Vote.objects.filter(election=election_id,
+                account__in=set(accounts) - existing)
+            for account, vote_id in created.values_list('account', 'pk'):
+                votes[(election_id, account)] = vote_id
+
+        choices = [(record, ballot) for record in records
+                   if (record['election'], record['account']) in votes
+                   for ballot in record['ballots']]
+        ballots = Ballot.objects.in_bulk(set(b['ballot'] for r, b in choices))
+        write_ins = [(ballots[b['ballot']], b['write_in']['first_name'],
+                      b['write_in']['last_name'])
+                     for r, b in choices if b['write_in']]
+        write_ins = iter(Candidate.resolve_write_ins(write_ins))
+
+        selections = {VotePlurality: [], VotePreferential: []}
+        for record, choice in choices:
+            ballot = ballots[choice['ballot']]
+            vote_id = None
+            if not ballot.is_secret:
+                vote_id = votes[(record['election'], record['account'])]
+            candidates = list(choice['candidates'])
+            if choice['write_in']:
+                candidates.append((next(write_ins).pk,
+                                   choice['write_in'].get('points')))
+            for candidate_id, points in candidates:
+                if ballot.type == "Pl":
+                    selection = VotePlurality(vote_id=vote_id,
+                                              candidate_id=candidate_id)
+                else:
+                    selection = VotePreferential(vote_id=vote_id,
+                        candidate_id=candidate_id, point=points)
+                selections[selection.__class__].append(selection)
+        for model, objects in selections.items():
+            if objects:
+                model.objects.bulk_create(objects)
+        CandidateTally.add_selections(sum(selections.values(), []))
+
+    # bulk_create() doesn't send the post_save signals that usually do this
+    for election_id, account in votes:
+        caching.invalidate_eligibility(election_id, account)
+    for election_id in elections:
+        caching.invalidate_election(election_id)
+    caching.run_pending_invalidations()
@@ -0,0 +1,541 @@
+"""
+Counting methods for determining the winners of a ballot.
+
+Plurality and Borda results come straight from the candidate tallies. The
+ranked methods (instant-runoff and single transferable vote) need the full
+ranking of every voter, which Rankings loads in a single query into a
+compact array. Identical rankings are then merged, so the rounds only have
+to look at each distinct ranking once. The Condorcet methods (Schulze and
+ranked pairs) only need the pairwise preference matrix, which is cached.
+
+Other methods can be added with the DJANGO_ELECT_TALLY_METHODS setting.
+tally_ballots() counts several ballots at once in a pool of processes, since
+ballots are independent of each other. Forking isn't safe in a threaded web
+server, so the pool is only used by the tally_election management command.
+"""
+import multiprocessing
+from array import array
+from collections import defaultdict
+from fractions import Fraction
+
+from django.core.cache import caches
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from django_elect import pairwise, settings
+
+
+class TallyError(Exception):
+    pass
+
+
+class Rankings(object):
+    """
+    The rankings of all votes on a preferential ballot. Candidates are
+    numbered from 1 in the order of self.candidates. The rankings are stored
+    in self.data, an array of unsigned shorts with one row of self.width
+    numbers per vote, from the most to the least preferred candidate and
+    padded with zeros.
+    """
+    def __init__(self, candidates, rows=()):
+        self.candidates = list(candidates)
+        self.width = len(self.candidates)
+        self.data = array('H')
+        for row in rows:
+            self.add(row)
+
+    def __len__(self):
+        return self.width and len(self.data) // self.width
+
+    def add(self, row):
+        """
+        Adds the ranking of a vote, given as a sequence of candidate numbers.
+        """
+        self.data.extend(row)
+        self.data.extend([0] * (self.width - len(row)))
+
+    def group(self):
+        """
+        Returns a dictionary mapping each distinct ranking, as a tuple of
+        candidate numbers, to the number of votes with that ranking. Votes
+        that don't rank anyone are left out.
+        """
+        groups = defaultdict(int)
+        data, width = self.data, self.width
+        for start in xrange(0, len(data), width):
+            row = data[start:start + width]
+            end = row.index(0) if 0 in row else width
+            if end:
+                groups[tuple(row[:end])] += 1
+        return dict(groups)
+
+    @classmethod
+    def load(cls, ballot):
+        """
+        Loads the rankings of the given preferential ballot. A higher point
+        value means the candidate is preferred.
+        """
+        from django_elect.models import VotePreferential
+
+        check_ranked(ballot)
+        candidates = list(ballot.candidates.order_by('pk'))
+        numbers = dict((c.pk, i + 1) for i, c in enumerate(candidates))
+        rankings = cls(candidates)
+        selections = VotePreferential.objects \
+            .filter(candidate__ballot=ballot, vote__isnull=False) \
+            .order_by('vote', '-point', 'candidate') \
+            .values_list('vote', 'candidate')
+        row, last_vote = [], None
+        for vote_id, candidate_id in selections.iterator():
+            if vote_id != last_vote and row:
+                rankings.add(row)
+                row = []
+            row.append(numbers[candidate_id])
+            last_vote = vote_id
+        if row:
+            rankings.add(row)
+        return rankings
+
+
+class Round(object):
+    """
+    A round of counting, recorded for the audit log. counts maps candidate
+    numbers to their number of votes (or points, or pairwise wins) at the
+    start of the round, "exhausted" is the weight of the votes that no
+    longer count towards any candidate, and "tied" lists the candidates that
+    had to be decided between with a tie-break.
+    """
+    def __init__(self, number, counts, elected=(), eliminated=(),
+                 exhausted=0, tied=()):
+        self.number = number
+        self.counts = counts
+        self.elected = list(elected)
+        self.eliminated = list(eliminated)
+        self.exhausted = exhausted
+        self.tied = list(tied)
+
+    def resolve(self, candidates):
+        """
+        Replaces the candidate numbers with the given Candidate objects and
+        the fractional counts with floats, for displaying the round.
+        """
+        lookup = lambda numbers: [candidates[n - 1] for n in numbers]
+        order = sorted(self.counts, key=lambda n: (-self.counts[n], n))
+        self.counts = [(candidates[n - 1], float(self.counts[n]))
+                       for n in order]
+        self.elected = lookup(self.elected)
+        self.eliminated = lookup(self.eliminated)
+        self.tied = lookup(self.tied)
+        self.exhausted = float(self.exhausted)
+
+
+class Result(object):
+    """
+    The outcome of counting a ballot: the elected candidates in the order
+    they were elected and the rounds of counting that led to it. For
+    Condorcet methods, margins has the pairwise margins in the format of
+    PairwiseMatrix.get_margins(), but with Candidate objects.
+    """
+    margins = None
+
+    def __init__(self, method, candidates, winners, rounds):
+        self.method = method
+        self.winners = [candidates[n - 1] for n in winners]
+        for r in rounds:
+            r.resolve(candidates)
+        self.rounds = rounds
+
+
+class TallyMethod(object):
+    """
+    Base class for counting methods. Ranked methods only need to implement
+    count(), which works on candidate numbers.
+    """
+    name = None
+
+    def tally(self, ballot):
+        """
+        Counts the votes of the given ballot and returns a Result.
+        """
+        rankings = Rankings.load(ballot)
+        winners, rounds = self.count(rankings.group(), rankings.width,
+                                     ballot.seats_available)
+        return Result(self, rankings.candidates, winners, rounds)
+
+    def count(self, groups, num_candidates, seats):
+        """
+        Returns a tuple of the form (winners, rounds), where winners is a
+        list of candidate numbers and rounds is a list of Round objects.
+        groups is a dictionary mapping rankings to their number of votes,
+        as returned by Rankings.group().
+        """
+        raise NotImplementedError
+
+    def __unicode__(self):
+        return unicode(self.name)
+
+
+class PluralityCount(TallyMethod):
+    """
+    Elects the candidates with the highest totals according to the
+    candidate tallies, i.e. the most votes on plurality ballots.
+    """
+    name = "Plurality"
+
+    def tally(self, ballot):
+        candidates = list(ballot.candidates.order_by('pk'))
+        numbers = dict((c.pk, i + 1) for i, c in enumerate(candidates))
+        counts = dict((numbers[c.pk], total)
+                      for c, total in ballot.get_candidate_stats())
+        order = sorted(counts, key=lambda n: (-counts[n], n))
+        winners = order[:ballot.seats_available]
+        last = winners and counts[winners[-1]]
+        tied = [n for n in order if counts[n] == last]
+        if len(tied) == 1 or set(tied) <= set(winners):
+            tied = []
+        rounds = [Round(1, counts, elected=winners, tied=tied)]
+        return Result(self, candidates, winners, rounds)
+
+
+class BordaCount(PluralityCount):
+    """
+    Elects the candidates with the most points on preferential ballots.
+    This is what the statistics page has always shown, and it's the only
+    method that works for secret preferential ballots.
+    """
+    name = "Borda count"
+
+
+class InstantRunoff(TallyMethod):
+    """
+    Instant-runoff voting: the candidate with the fewest first preferences
+    is eliminated and their votes go to the next preference, until a
+    candidate has a majority of the remaining votes. Elects one candidate
+    regardless of the number of seats; use SingleTransferableVote for
+    multi-seat ballots.
+    """
+    name = "Instant-runoff"
+
+    def count(self, groups, num_candidates, seats):
+        continuing = set(range(1, num_candidates + 1))
+        history, rounds = [], []
+        while continuing and groups:
+            counts = dict.fromkeys(continuing, 0)
+            exhausted = 0
+            for ranking, weight in groups.iteritems():
+                for n in ranking:
+                    if n in continuing:
+                        counts[n] += weight
+                        break
+                else:
+                    exhausted += weight
+            history.append(counts)
+            current = Round(len(rounds) + 1, counts, exhausted=exhausted)
+            rounds.append(current)
+
+            leader = max(counts.values())
+            if leader * 2 > sum(counts.values()) or len(continuing) == 1:
+                tied = sorted(n for n in continuing if counts[n] == leader)
+                current.elected = [break_tie(tied, history, lowest=False)]
+                current.tied = len(tied) > 1 and tied or []
+                return current.elected, rounds
+            lowest = min(counts.values())
+            tied = sorted(n for n in continuing if counts[n] == lowest)
+            loser = break_tie(tied, history, lowest=True)
+            current.eliminated = [loser]
+            current.tied = len(tied) > 1 and tied or []
+            continuing.discard(loser)
+        return [], rounds
+
+
+class SingleTransferableVote(TallyMethod):
+    """
+    Single transferable vote with the Droop quota. The surplus of an
+    elected candidate is transferred with the Gregory method, i.e. all of
+    the candidate's votes are passed on to their next preference at a
+    fraction of their current value, so the result doesn't depend on which
+    votes are picked. Fractions are exact, so the count is reproducible.
+    """
+    name = "Single transferable vote"
+
+    def count(self, groups, num_candidates, seats):
+        continuing = set(range(1, num_candidates + 1))
+        quota = sum(groups.values()) // (seats + 1) + 1
+        # the votes currently held by each candidate, in parcels of votes
+        # with the same value: (value, [(ranking, position, votes), ...],
+        # total votes). The arithmetic on fractions is then done once per
+        # parcel instead of once per vote.
+        piles = defaultdict(list)
+
+        def transfer(parcels, factor=1):
+            # moves the votes to their next continuing preference and
+            # returns the value of the votes that have none left
+            lost = 0
+            for value, entries, total in parcels:
+                value *= factor
+                moved = defaultdict(list)
+                for ranking, position, votes in entries:
+                    for i in xrange(position, len(ranking)):
+                        if ranking[i] in continuing:
+                            moved[ranking[i]].append((ranking, i + 1, votes))
+                            break
+                    else:
+                        lost += value * votes
+                for n, moved_entries in moved.iteritems():
+                    piles[n].append((value, moved_entries,
+                                     sum(e[2] for e in moved_entries)))
+            return lost
+
+        exhausted = transfer([(Fraction(1),
+            [(ranking, 0, votes) for ranking, votes in groups.iteritems()],
+            sum(groups.values()))])
+        elected, history, rounds = [], [], []
+        while continuing and len(elected) < seats:
+            counts = dict((n, sum(value * total
+                                  for value, e, total in piles[n]))
+                          for n in continuing)
+            history.append(counts)
+            current = Round(len(rounds) + 1, counts, exhausted=exhausted)
+            rounds.append(current)
+
+            if len(continuing) <= seats - len(elected):
+                # everyone left fills the remaining seats
+                current.elected = sorted(continuing,
+                                         key=lambda n: (-counts[n], n))
+                elected.extend(current.elected)
+                break
+            reached = sorted((n for n in continuing if counts[n] >= quota),
+                             key=lambda n: (-counts[n], n))
+            if reached:
+                current.elected = reached
+                elected.extend(reached)
+                continuing.difference_update(reached)
+                for n in reached:
+                    surplus = counts[n] - quota
+                    parcels = piles.pop(n)
+                    if surplus and len(elected) < seats:
+                        exhausted += transfer(parcels,
+                                              Fraction(surplus) / counts[n])
+            else:
+                lowest = min(counts.values())
+                tied = sorted(n for n in continuing if counts[n] == lowest)
+                loser = break_tie(tied, history, lowest=True)
+                current.eliminated = [loser]
+                current.tied = len(tied) > 1 and tied or []
+                continuing.discard(loser)
+                exhausted += transfer(piles.pop(loser, []))
+        return elected, rounds
+
+
+class CondorcetMethod(TallyMethod):
+    """
+    Base class for methods based on the pairwise preference matrix, which
+    is read from the cache (see django_elect.pairwise) instead of being
+    recomputed from all votes. Subclasses implement rank().
+    """
+    def tally(self, ballot):
+        check_ranked(ballot)
+        matrix = pairwise.get_matrix(ballot)
+        candidates = ballot.candidates.in_bulk(matrix.candidate_ids)
+        candidates = [candidates[pk] for pk in matrix.candidate_ids]
+        winners, rounds = self.rank(matrix.prefer, len(candidates),
+                                    ballot.seats_available)
+        result = Result(self, candidates, winners, rounds)
+        result.margins = [(candidates[i], margins) for i, (pk, margins)
+                          in enumerate(matrix.get_margins())]
+        return result
+
+    def count(self, groups, num_candidates, seats):
+        prefer = pairwise.pairwise_preferences(groups, num_candidates)
+        return self.rank(prefer, num_candidates, seats)
+
+    def rank(self, prefer, num_candidates, seats):
+        """
+        Like count(), but takes the pairwise preference matrix instead of
+        the rankings.
+        """
+        raise NotImplementedError
+
+
+class Schulze(CondorcetMethod):
+    """
+    The Schulze method, which elects the Condorcet winner if there is one.
+    Unranked candidates are treated as ranked below all ranked ones. The
+    candidates are ordered by the number of other candidates they beat
+    through their strongest paths, and the top ones win the seats.
+    """
+    name = "Schulze"
+
+    def rank(self, prefer, num_candidates, seats):
+        candidates = range(1, num_candidates + 1)
+        strength = pairwise.strongest_paths(prefer, num_candidates)
+        wins = dict((i, sum(1 for j in candidates
+                            if strength[i][j] > strength[j][i]))
+                    for i in candidates)
+        order = sorted(candidates, key=lambda n: (-wins[n], n))
+        winners = order[:seats]
+        rounds = [Round(1, wins, elected=winners)]
+        return winners, rounds
+
+
+class RankedPairs(CondorcetMethod):
+    """
+    Tideman's ranked pairs method. The pairwise victories are locked in
+    from the largest to the smallest number of winning votes, skipping any
+    that would create a cycle, and the candidates are then ordered by the
+    locked victories. Each round of the audit log locks in (elected) or
+    skips (eliminated) the victory of one candidate over another.
+    """
+    name = "Ranked pairs"
+
+    def rank(self, prefer, num_candidates, seats):
+        candidates = range(1, num_candidates + 1)
+        pairs = [(i, j) for i in candidates for j in candidates
+                 if prefer[i][j] > prefer[j][i]]
+        # larger victories first, then those with fewer opposing votes
+        pairs.sort(key=lambda (i, j): (-prefer[i][j], prefer[j][i], i, j))
+        beats = dict((n, set()) for n in candidates)
+
+        def reaches(start, goal):
+            seen, stack = set(), [start]
+            while stack:
+                n = stack.pop()
+                if n == goal:
+                    return True
+                if n not in seen:
+                    seen.add(n)
+                    stack.extend(beats[n])
+            return False
+
+        rounds = []
+        for i, j in pairs:
+            current = Round(len(rounds) + 1, {i: prefer[i][j],
+                                              j: prefer[j][i]})
+            if reaches(j, i):
+                current.eliminated = [i]
+            else:
+                beats[i].add(j)
+                current.elected = [i]
+            rounds.append(current)
+
+        # repeatedly take the first candidate that no remaining one beats
+        order, remaining = [], set(candidates)
+        while remaining:
+            beaten = set()
+            for n in remaining:
+                beaten.update(beats[n])
+            n = min(remaining - beaten)
+            order.append(n)
+            remaining.discard(n)
+        return order[:seats], rounds
+
+
+def check_ranked(ballot):
+    """
+    Raises TallyError unless the rankings of the votes on the given ballot
+    are recorded, which ranked methods need.
+    """
+    if ballot.type != "Pr":
+        raise TallyError("Only preferential ballots have rankings.")
+    if ballot.is_secret:
+        raise TallyError("The rankings of secret ballots aren't recorded, so "
+                         "they can only be counted with the Borda count.")
+
+
+def break_tie(tied, history, lowest):
+    """
+    Picks one of the tied candidates: the one with the fewest (or with
+    lowest=False, the most) votes in the latest earlier round where the tied
+    candidates differ. If they were tied in every round, the candidate
+    entered last loses, or the one entered first wins.
+    """
+    for counts in reversed(history[:-1]):
+        if len(tied) == 1:
+            break
+        values = [counts.get(n, 0) for n in tied]
+        target = min(values) if lowest else max(values)
+        tied = [n for n, value in zip(tied, values) if value == target]
+    return max(tied) if lowest else min(tied)
+
+
+METHODS = {
+    'plurality': PluralityCount,
+    'borda': BordaCount,
+    'irv': InstantRunoff,
+    'stv': SingleTransferableVote,
+    'schulze': Schulze,
+    'ranked_pairs': RankedPairs,
+}
+
+
+def get_method(name):
+    """
+    Returns an instance of the counting method with the given name, which is
+    either a key of METHODS or of the DJANGO_ELECT_TALLY_METHODS setting.
+    """
+    methods = dict(METHODS, **settings.DJANGO_ELECT_TALLY_METHODS)
+    try:
+        method = methods[name]
+    except KeyError:
+        raise TallyError("Unknown tally method: %s" % name)
+    if isinstance(method, basestring):
+        method = import_string(method)
+    return method()
+
+
+def tally_ballots(ballots, method=None, processes=1):
+    """
+    Counts the votes of the given ballots with Ballot.get_result() and
+    returns a list of (ballot, Result, TallyError) tuples in the same order,
+    where either the result or the error is None.
+
+    If processes is more than 1, the ballots are counted in parallel by that
+    many worker processes, each with its own database and cache connections.
+    The connections of this process are closed before the workers are
+    forked, so they aren't shared, and they're reopened when they're next
+    used. Inside a transaction the ballots are counted in this process
+    instead, since the workers couldn't see its changes. Forking requires a
+    process without other threads, e.g. a management command or a
+    preforking server that doesn't use threads.
+    """
+    ballots = list(ballots)
+    processes = min(processes, len(ballots))
+    in_atomic_block = any(connections[alias].in_atomic_block
+                          for alias in connections)
+    if processes <= 1 or in_atomic_block:
+        outcomes = [_tally_ballot(b, method) for b in ballots]
+    else:
+        connections.close_all()
+        for cache in caches.all():
+            cache.close()
+        pool = multiprocessing.Pool(processes)
+        try:
+            outcomes = pool.map(_tally_ballot_in_worker,
+                                [(b.pk, method) for b in ballots],
+                                chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return [(ballot, result, error)
+            for ballot, (result, error) in zip(ballots, outcomes)]
+
+
+def _tally_ballot(ballot, method):
+    try:
+        return ballot.get_result(method), None
+    except TallyError as e:
+        return None, e
+
+
+def _tally_ballot_in_worker(args):
+    from django_elect.models import Ballot
+
+    ballot_id, method = args
+    try:
+        return _tally_ballot(Ballot.objects.get(pk=ballot_id), method)
+    finally:
+        # the workers exit without closing their connections, so they're
+        # closed after each ballot instead
+        connections.close_all()
+        for cache in caches.all():
+            cache.close()
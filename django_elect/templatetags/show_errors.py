@@ -1,6 +1,8 @@
 from django import template
 from django.template.loader import render_to_string
 
+from django_elect.instrumentation import timed
+
 
 register = template.Library()
 
@@ -20,6 +22,7 @@ class ShowErrorsNode(template.Node):
     def __init__(self, forms):
         self.forms = forms
 
+    @timed("show_errors")
     def render(self, context):
         # store # of errors in context variable so we can sequentially order
         if "errorNum" not in context:
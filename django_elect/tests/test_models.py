@@ -1,12 +1,20 @@
 from freezegun import freeze_time
 from datetime import datetime
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.apps import apps
+from django.db import transaction
+from django.core.management import call_command, CommandError
+from django.utils.six import StringIO
 
-from django_elect import settings
-from django_elect.models import Ballot, Candidate, Election, Vote, \
-    VotePlurality, VotePreferential, VotingNotAllowedException
+from django_elect import caching, matrix, settings
+from django_elect.models import Ballot, Candidate, CandidateTally, \
+    Election, Vote, VotePlurality, VotePreferential, \
+    VotingNotAllowedException, normalize_name
+from django_elect.tally import Rankings, InstantRunoff, \
+    SingleTransferableVote, Schulze, RankedPairs, TallyError, break_tie, \
+    tally_ballots
+from django_elect.pairwise import PairwiseMatrix, build_matrix, get_matrix
 
 
 @freeze_time("2010-10-10 00:00:00")
@@ -69,6 +77,33 @@ class ElectionTestCase(BaseTestCase):
         self.assertTrue(self.election_current.has_voted(self.user1))
         self.assertFalse(self.election_current.has_voted(self.user2))
 
+    def test_slug(self):
+        self.assertEqual(self.election_current.slug, "current")
+        # slugs are generated from the name and don't collide
+        election = Election.objects.create(name="Current!",
+            vote_start=datetime(2010, 10, 1),
+            vote_end=datetime(2010, 10, 11))
+        self.assertEqual(election.slug, "current-2")
+
+    def test_get_open_for_user(self):
+        restricted = Election.objects.create(name="restricted",
+            vote_start=datetime(2010, 10, 1),
+            vote_end=datetime(2010, 10, 11))
+        restricted.allowed_voters.add(self.user1, self.user2)
+        Election.objects.create(name="finished",
+            vote_start=datetime(2010, 10, 1),
+            vote_end=datetime(2010, 10, 9))
+        with self.assertNumQueries(1):
+            elections = list(Election.get_open_for_user(self.user1))
+        self.assertEqual(elections, [self.election_current, restricted])
+
+        self.election_current.votes.create(account=self.user1)
+        restricted.allowed_voters.remove(self.user2)
+        self.assertEqual(list(Election.get_open_for_user(self.user1)),
+                         [restricted])
+        self.assertEqual(list(Election.get_open_for_user(self.user2)),
+                         [self.election_current])
+
     def test_voting_allowed_for_user_with_empty_allowed_voters_list(self):
         self.assertTrue(self.election_current.voting_allowed_for_user(self.user1))
         self.assertTrue(self.election_current.voting_allowed_for_user(self.user2))
@@ -99,6 +134,126 @@ class ElectionTestCase(BaseTestCase):
         election_finished.allowed_voters.add(self.user1)
         self.assertFalse(election_finished.voting_allowed_for_user(self.user1))
 
+    def test_voting_allowed_for_user_cached(self):
+        election = self.election_current
+        self.assertTrue(election.voting_allowed_for_user(self.user1, True))
+        with self.assertNumQueries(0):
+            self.assertTrue(election.voting_allowed_for_user(self.user1, True))
+
+        # changing allowed_voters should invalidate the cache
+        election.allowed_voters.add(self.user2)
+        self.assertFalse(election.voting_allowed_for_user(self.user1, True))
+        self.user1.election_set.add(election)
+        self.assertTrue(election.voting_allowed_for_user(self.user1, True))
+        self.user1.election_set.clear()
+        self.assertFalse(election.voting_allowed_for_user(self.user1, True))
+
+        # voting should invalidate the cache
+        self.assertTrue(election.voting_allowed_for_user(self.user2, True))
+        election.create_vote(self.user2)
+        self.assertFalse(election.voting_allowed_for_user(self.user2, True))
+        election.disassociate_accounts()
+        self.assertTrue(election.voting_allowed_for_user(self.user2, True))
+
+    def test_eligibility_invalidated_after_commit(self):
+        election = self.election_current
+        election.allowed_voters.add(self.user2)
+        self.assertFalse(election.voting_allowed_for_user(self.user1, True))
+        with transaction.atomic():
+            election.allowed_voters.add(self.user1)
+            # simulate another request that cached the eligibility before
+            # the transaction was committed
+            caching.get_cache().set(
+                caching._eligibility_key(election.pk, self.user1.pk),
+                (False, False, False))
+        # the end of the request repeats the invalidation
+        caching.run_pending_invalidations(force=True)
+        self.assertTrue(election.voting_allowed_for_user(self.user1, True))
+
+    def test_election_invalidated_after_commit(self):
+        election = self.election_current
+        with transaction.atomic():
+            election.votes.create(account=self.user1)
+            # another request could send the results from before the commit
+            # along with this version stamp
+            version = caching.get_election_version(election.pk)
+        caching.run_pending_invalidations(force=True)
+        self.assertNotEqual(caching.get_election_version(election.pk),
+                            version)
+
+    def test_check_cache(self):
+        # the tests use a per-process cache, which the version stamps
+        # shouldn't be kept in
+        self.assertEqual([e.id for e in caching.check_cache(None)],
+                         ['django_elect.W001'])
+
+    def test_ballot_invalidated_after_commit(self):
+        ballot = self.create_current_pl_ballot()
+        with transaction.atomic():
+            candidate = self.create_candidate(ballot)
+            candidate.last_name = "Renamed"
+            candidate.save()
+            # another request could cache the old ballot table under this
+            # version
+            version = caching.get_version("ballot", ballot.pk)
+        caching.run_pending_invalidations(force=True)
+        self.assertNotEqual(caching.get_version("ballot", ballot.pk),
+                            version)
+
+    def test_biographies_invalidated_after_commit(self):
+        election = self.election_current
+        with transaction.atomic():
+            election.introduction = "New introduction"
+            election.save()
+            # another request could cache the old page, with its ETag and
+            # Last-Modified, under this version
+            version = caching.get_version("biographies", election.pk)
+        caching.run_pending_invalidations(force=True)
+        self.assertNotEqual(caching.get_version("biographies", election.pk),
+                            version)
+
+    def test_candidates_invalidated_after_commit(self):
+        ballot = self.create_current_pl_ballot()
+        candidate = self.create_candidate(ballot)
+        with transaction.atomic():
+            candidate.last_name = "Renamed"
+            candidate.save()
+            # another request could keep the old names under this version
+            version = caching.get_version("candidates", ballot.pk)
+        caching.run_pending_invalidations(force=True)
+        self.assertNotEqual(caching.get_version("candidates", ballot.pk),
+                            version)
+
+    def test_current_election_invalidated_after_commit(self):
+        with transaction.atomic():
+            self.election_current.name = "Renamed"
+            self.election_current.save()
+            # simulate another request that cached the election before the
+            # transaction was committed
+            key = "django_elect:current_election:%s:" % \
+                caching.get_version("current_election", "latest")
+            caching.get_cache().set(key, (datetime.max, None))
+        caching.run_pending_invalidations(force=True)
+        self.assertEqual(caching.get_current_election().name, "Renamed")
+
+    def test_current_election_by_slug(self):
+        self.assertEqual(caching.get_current_election("current"),
+                         self.election_current)
+        # elections that don't exist aren't cached, so requests for random
+        # slugs can't fill the cache
+        self.assertIsNone(caching.get_current_election("unknown"))
+        self.assertNotIn("unknown", caching._current_elections)
+
+        # only the elections used last are kept in memory
+        self.addCleanup(setattr, caching, 'ELECTION_CACHE_SIZE',
+                        caching.ELECTION_CACHE_SIZE)
+        caching.ELECTION_CACHE_SIZE = 1
+        other = Election.objects.create(name="other",
+            vote_start=datetime(2010, 10, 1),
+            vote_end=datetime(2010, 10, 11))
+        self.assertEqual(caching.get_current_election("other"), other)
+        self.assertEqual(list(caching._current_elections), ["other"])
+
     def test_create_vote_for_user_not_allowed(self):
         self.election_current.allowed_voters.add(self.user2)
         create_vote = lambda: self.election_current.create_vote(self.user1)
@@ -110,6 +265,32 @@ class ElectionTestCase(BaseTestCase):
         self.assertEqual(vote.account, self.user1)
         self.assertEqual(vote.election, self.election_current)
 
+    def test_create_vote_twice_concurrently(self):
+        self.election_current.create_vote(self.user1)
+        # simulate another request that checked eligibility before the first
+        # vote was created
+        self.election_current.voting_allowed_for_user = lambda user: True
+        with self.assertRaises(VotingNotAllowedException):
+            with transaction.atomic():
+                self.election_current.create_vote(self.user1)
+        self.assertEqual(self.election_current.votes.count(), 1)
+
+    def test_create_vote_with_token(self):
+        token = "a" * 32
+        self.election_current.create_vote(self.user1, token)
+        self.assertTrue(
+            self.election_current.has_vote_with_token(self.user1, token))
+        self.assertFalse(
+            self.election_current.has_vote_with_token(self.user2, token))
+        self.assertFalse(
+            self.election_current.has_vote_with_token(self.user1, "b" * 32))
+        self.assertFalse(
+            self.election_current.has_vote_with_token(self.user1, None))
+
+        # the token must be cleared with the account
+        self.election_current.disassociate_accounts()
+        self.assertEqual(self.election_current.votes.get().token, None)
+
     def test_disassociate_accounts(self):
         self.election_current.votes.create(account=self.user1)
         self.election_current.votes.create(account=self.user2)
@@ -120,6 +301,34 @@ class ElectionTestCase(BaseTestCase):
         self.assertFalse(self.election_current.has_voted(self.user1))
         self.assertFalse(self.election_current.has_voted(self.user2))
 
+    def test_disassociate_accounts_in_batches(self):
+        user_model = apps.get_model(settings.DJANGO_ELECT_USER_MODEL)
+        users = [user_model.objects.create_user(username="batch%i" % i)
+                 for i in range(5)]
+        votes = [self.election_current.votes.create(account=u) for u in users]
+        other_election = Election.objects.create(name="other",
+            vote_start=datetime(2010, 10, 1), vote_end=datetime(2010, 10, 11))
+        other_election.votes.create(account=self.user1)
+
+        progress = []
+        updated = self.election_current.disassociate_accounts_in_batches(2,
+            start_pk=votes[0].pk,
+            progress=lambda *args: progress.append(args))
+        self.assertEqual(updated, 4)
+        self.assertEqual(progress, [(2, votes[2].pk), (4, votes[4].pk)])
+        self.assertTrue(self.election_current.has_voted(users[0]))
+        for user in users[1:]:
+            self.assertFalse(self.election_current.has_voted(user))
+        self.assertTrue(other_election.has_voted(self.user1))
+
+        # running it again should be harmless
+        stdout = StringIO()
+        call_command('disassociate_accounts', str(self.election_current.pk),
+                     batch_size=3, sleep=0, stdout=stdout)
+        self.assertIn("Disassociated 1 votes", stdout.getvalue())
+        self.assertEqual(self.election_current.votes.filter(
+            account__isnull=False).count(), 0)
+
     def test_full_statistics(self):
         ballot_plurality = self.create_current_pl_ballot(seats_available=6)
         pl_candidate1 = self.create_candidate(ballot_plurality)
@@ -145,17 +354,121 @@ class ElectionTestCase(BaseTestCase):
         self.assertEqual(expected_votes, stats['votes'])
 
         # Add another vote
-        vote2 = self.election_current.votes.create(account=self.user1)
+        vote2 = self.election_current.votes.create(account=self.user2)
         vote2.pluralities.create(candidate=pl_candidate3)
         vote2.pluralities.create(candidate=pl_candidate2)
         vote2.preferentials.create(candidate=pr_candidate1, point=3)
 
-        stats = self.election_current.get_full_statistics()
         expected_votes[vote2] = [0, 1, 1, 3, 0]
-        # candidates and ballots should be unchanged and in same order
-        self.assertEqual(expected_candidates, stats['candidates'])
-        self.assertEqual(expected_ballots, stats['ballots'])
-        self.assertEqual(expected_votes, stats['votes'])
+        for sparse in (False, True):
+            stats = self.election_current.get_full_statistics(sparse)
+            # candidates and ballots should be unchanged and in same order
+            self.assertEqual(expected_candidates, stats['candidates'])
+            self.assertEqual(expected_ballots, stats['ballots'])
+            self.assertEqual(expected_votes, stats['votes'])
+            self.assertEqual([(vote1, expected_votes[vote1]),
+                              (vote2, expected_votes[vote2])],
+                             stats['votes'].items())
+
+    def test_build_matrix(self):
+        ballot_plurality = self.create_current_pl_ballot(seats_available=6)
+        pl_candidate1 = self.create_candidate(ballot_plurality)
+        pl_candidate2 = self.create_candidate(ballot_plurality)
+
+        ballot_preferential = self.create_current_pr_ballot(seats_available=2)
+        pr_candidate1 = self.create_candidate(ballot_preferential)
+        pr_candidate2 = self.create_candidate(ballot_preferential)
+
+        vote1 = self.election_current.votes.create(account=self.user1)
+        vote1.pluralities.create(candidate=pl_candidate2)
+        vote1.preferentials.create(candidate=pr_candidate1, point=2)
+        vote2 = self.election_current.votes.create(account=self.user2)
+        vote2.preferentials.create(candidate=pr_candidate1, point=1)
+        vote2.preferentials.create(candidate=pr_candidate2, point=2)
+        vote3 = self.election_current.votes.create(account=None)
+
+        # the candidates, the votes and each selection model are read with
+        # one query each, however many votes there are
+        with self.assertNumQueries(4):
+            vote_matrix = matrix.build_matrix(self.election_current)
+        self.assertEqual(vote_matrix.shape, (3, 4))
+        self.assertEqual(list(vote_matrix.candidate_ids), [pl_candidate1.pk,
+            pl_candidate2.pk, pr_candidate1.pk, pr_candidate2.pk])
+        self.assertEqual(list(vote_matrix), [
+            (vote1.pk, [0, 1, 2, 0]),
+            (vote2.pk, [0, 0, 1, 2]),
+            (vote3.pk, [0, 0, 0, 0]),
+        ])
+        self.assertEqual(vote_matrix.totals(), [0, 1, 3, 2])
+        self.assertEqual(vote_matrix.index(vote2.pk), 1)
+        self.assertIsNone(vote_matrix.index(vote3.pk + 1))
+
+        # the sparse matrix only stores the selections, but has the same rows
+        sparse_matrix = matrix.build_matrix(self.election_current,
+                                            sparse=True)
+        self.assertEqual(len(sparse_matrix.cells), 4)
+        self.assertEqual(list(sparse_matrix), list(vote_matrix))
+        self.assertEqual(sparse_matrix.totals(), vote_matrix.totals())
+
+        # columns beyond what an unsigned short can number
+        wide_matrix = matrix.SparseVoteMatrix([1], range(70000),
+                                              [(1, 69999, 2)])
+        self.assertEqual(wide_matrix.row(0)[69999], 2)
+
+    def test_iter_full_statistics(self):
+        ballot_plurality = self.create_current_pl_ballot(seats_available=6)
+        pl_candidate1 = self.create_candidate(ballot_plurality)
+        pl_candidate2 = self.create_candidate(ballot_plurality)
+
+        ballot_preferential = self.create_current_pr_ballot(seats_available=2)
+        pr_candidate1 = self.create_candidate(ballot_preferential)
+        pr_candidate2 = self.create_candidate(ballot_preferential)
+
+        vote1 = self.election_current.votes.create(account=self.user1)
+        vote1.pluralities.create(candidate=pl_candidate2)
+        vote1.preferentials.create(candidate=pr_candidate1, point=2)
+        vote2 = self.election_current.votes.create(account=self.user2)
+        vote2.preferentials.create(candidate=pr_candidate1, point=1)
+        vote2.preferentials.create(candidate=pr_candidate2, point=2)
+        vote3 = self.election_current.votes.create(account=None)
+
+        self.assertEqual(self.election_current.get_statistics_candidates(),
+            [pl_candidate1, pl_candidate2, pr_candidate1, pr_candidate2])
+        expected = [
+            (vote1, [0, 1, 2, 0]),
+            (vote2, [0, 0, 1, 2]),
+            (vote3, [0, 0, 0, 0]),
+        ]
+        for chunk_size in (1, 2, 1000):
+            stats = self.election_current.iter_full_statistics(chunk_size)
+            self.assertEqual(list(stats), expected)
+
+    def test_get_candidate_stats(self):
+        ballot_plurality = self.create_current_pl_ballot(seats_available=6)
+        pl_candidate1 = self.create_candidate(ballot_plurality, last_name='a')
+        pl_candidate2 = self.create_candidate(ballot_plurality, last_name='b')
+
+        ballot_preferential = self.create_current_pr_ballot(seats_available=2)
+        pr_candidate1 = self.create_candidate(ballot_preferential)
+        pr_candidate2 = self.create_candidate(ballot_preferential)
+
+        vote1 = self.election_current.votes.create(account=self.user1)
+        vote1.pluralities.create(candidate=pl_candidate2)
+        vote1.preferentials.create(candidate=pr_candidate2, point=2)
+        vote1.preferentials.create(candidate=pr_candidate1, point=1)
+        vote2 = self.election_current.votes.create(account=self.user2)
+        vote2.preferentials.create(candidate=pr_candidate2, point=2)
+
+        # one query for the ballots, plus two per ballot type: one for
+        # missing tallies and one to read them
+        with self.assertNumQueries(5):
+            stats = self.election_current.get_candidate_stats()
+        self.assertEqual(stats, [
+            (ballot_plurality, [(pl_candidate2, 1), (pl_candidate1, 0)]),
+            (ballot_preferential, [(pr_candidate2, 4), (pr_candidate1, 1)]),
+        ])
+        for ballot, ballot_stats in stats:
+            self.assertEqual(ballot_stats, ballot.get_candidate_stats())
 
 
 class BallotTestCase(BaseTestCase):
@@ -266,6 +579,37 @@ class CandidateTestCase(BaseTestCase):
             incumbent=True)
         self.assertEqual(candidate.get_name(), "FOO BAR")
 
+    def test_normalize_name(self):
+        self.assertEqual(normalize_name(u" Jos\xe9 ", u"DE  la Cruz"),
+                         u"jose de la cruz")
+
+    def test_resolve_write_ins(self):
+        ballot1 = self.create_current_pl_ballot()
+        ballot2 = self.create_current_pr_ballot()
+        existing = ballot1.candidates.create(first_name="Jade",
+            last_name="Stern", write_in=True)
+        self.assertEqual(existing.write_in_key, "jade stern")
+        # candidates that aren't write-ins shouldn't be matched
+        self.create_candidate(ballot1)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(Candidate.resolve_write_ins([
+                (ballot1, "jade", " STERN"),
+                (ballot1, "Jade", "Stern"),
+            ]), [existing, existing])
+
+        candidates = Candidate.resolve_write_ins([
+            (ballot1, "Foo", "Bar"),
+            (ballot2, "Jade", "Stern"),
+            (ballot2, "JADE", "stern"),
+        ])
+        self.assertEqual(candidates[1], candidates[2])
+        self.assertNotEqual(candidates[1], existing)
+        self.assertTrue(all(c.write_in for c in candidates))
+        self.assertEqual(candidates[0].get_name(), "Foo Bar")
+        self.assertEqual(ballot1.candidates.filter(write_in=True).count(), 2)
+        self.assertEqual(ballot2.candidates.count(), 1)
+
 
 class VoteTestCase(BaseTestCase):
     "Tests for the Vote model"
@@ -298,3 +642,317 @@ class VoteTestCase(BaseTestCase):
         self.assertEqual(repr(vote.get_details()), repr(
             [(ballot_plurality, [vote_pl1]),
              (ballot_preferential, [vote_pr1, vote_pr2])]))
+
+    def test_prefetch_details(self):
+        ballot = self.create_current_pl_ballot(seats_available=2)
+        candidate1 = self.create_candidate(ballot)
+        candidate2 = self.create_candidate(ballot)
+        votes = []
+        for user in (self.user1, self.user2):
+            vote = self.election_current.votes.create(account=user)
+            vote.pluralities.create(candidate=candidate1)
+            votes.append(vote)
+        votes[1].pluralities.create(candidate=candidate2)
+
+        votes = list(Vote.objects.order_by('pk'))
+        with self.assertNumQueries(3):
+            Vote.prefetch_details(votes)
+        with self.assertNumQueries(0):
+            details = [[(b, [s.candidate for s in selections])
+                        for b, selections in vote.get_details()]
+                       for vote in votes]
+        self.assertEqual(details, [
+            [(ballot, [candidate1])],
+            [(ballot, [candidate1, candidate2])],
+        ])
+
+
+class CandidateTallyTestCase(BaseTestCase):
+    "Tests for the CandidateTally model"
+    def get_tally(self, candidate):
+        tally = CandidateTally.objects.get(candidate=candidate)
+        return (tally.votes, tally.points)
+
+    def test_tally_follows_selections(self):
+        ballot = self.create_current_pr_ballot()
+        candidate1 = self.create_candidate(ballot)
+        candidate2 = self.create_candidate(ballot)
+        self.assertEqual(self.get_tally(candidate1), (0, 0))
+
+        vote = self.election_current.votes.create(account=self.user1)
+        selection = vote.preferentials.create(candidate=candidate1, point=2)
+        self.assertEqual(self.get_tally(candidate1), (1, 2))
+
+        selection.candidate = candidate2
+        selection.point = 1
+        selection.save()
+        self.assertEqual(self.get_tally(candidate1), (0, 0))
+        self.assertEqual(self.get_tally(candidate2), (1, 1))
+
+        CandidateTally.add_selections([
+            VotePreferential(candidate=candidate1, point=2),
+            VotePreferential(candidate=candidate2, point=3),
+        ])
+        self.assertEqual(self.get_tally(candidate1), (1, 2))
+        self.assertEqual(self.get_tally(candidate2), (2, 4))
+
+        vote.delete()
+        self.assertEqual(self.get_tally(candidate2), (1, 3))
+
+    def test_missing_tallies(self):
+        # e.g. candidates and votes loaded from a fixture, which don't get
+        # tallies when they're saved
+        ballot = self.create_current_pl_ballot()
+        candidate1 = self.create_candidate(ballot, last_name="a")
+        candidate2 = self.create_candidate(ballot, last_name="b")
+        vote1 = self.election_current.votes.create(account=self.user1)
+        vote1.pluralities.create(candidate=candidate1)
+        CandidateTally.objects.all().delete()
+
+        self.assertEqual(ballot.get_candidate_stats(),
+                         [(candidate1, 1), (candidate2, 0)])
+        self.assertEqual(self.get_tally(candidate1), (1, 0))
+
+        CandidateTally.objects.all().delete()
+        vote2 = self.election_current.votes.create(account=self.user2)
+        vote2.pluralities.create(candidate=candidate1)
+        self.assertEqual(self.get_tally(candidate1), (2, 0))
+
+    def test_rebuild_tallies_command(self):
+        ballot = self.create_current_pl_ballot()
+        candidate = self.create_candidate(ballot)
+        vote = self.election_current.votes.create(account=self.user1)
+        vote.pluralities.create(candidate=candidate)
+        call_command('rebuild_tallies', verify=True, stdout=StringIO())
+
+        CandidateTally.objects.filter(candidate=candidate).update(votes=5)
+        self.assertRaises(CommandError, call_command, 'rebuild_tallies',
+                          verify=True, stdout=StringIO())
+        self.assertEqual(self.get_tally(candidate), (5, 0))
+
+        call_command('rebuild_tallies', stdout=StringIO())
+        self.assertEqual(self.get_tally(candidate), (1, 0))
+
+        CandidateTally.objects.all().delete()
+        call_command('rebuild_tallies', str(self.election_current.pk),
+                     stdout=StringIO())
+        self.assertEqual(self.get_tally(candidate), (1, 0))
+
+
+class TallyTestCase(BaseTestCase):
+    "Tests for the counting methods in django_elect.tally"
+    def test_rankings(self):
+        rankings = Rankings([1, 2, 3], [(1, 2), (3,), (1, 2), ()])
+        self.assertEqual(len(rankings), 4)
+        self.assertEqual(list(rankings.data),
+                         [1, 2, 0, 3, 0, 0, 1, 2, 0, 0, 0, 0])
+        self.assertEqual(rankings.group(), {(1, 2): 2, (3,): 1})
+
+    def test_instant_runoff(self):
+        winners, rounds = InstantRunoff().count(
+            {(1, 2): 4, (2,): 3, (3, 2): 2}, 3, 1)
+        self.assertEqual(winners, [2])
+        self.assertEqual([r.counts for r in rounds],
+                         [{1: 4, 2: 3, 3: 2}, {1: 4, 2: 5}])
+        self.assertEqual(rounds[0].eliminated, [3])
+
+    def test_single_transferable_vote(self):
+        # the quota is 6, so 2 of candidate 1's votes are transferred to
+        # candidate 3, who then beats candidate 2
+        winners, rounds = SingleTransferableVote().count(
+            {(1, 3): 8, (2,): 4, (3,): 3}, 3, 2)
+        self.assertEqual(winners, [1, 3])
+        self.assertEqual(rounds[0].elected, [1])
+        self.assertEqual(rounds[1].counts, {2: 4, 3: 5})
+        self.assertEqual(rounds[1].eliminated, [2])
+        self.assertEqual(rounds[2].elected, [3])
+        self.assertEqual(rounds[2].exhausted, 4)
+
+    def test_schulze(self):
+        # 1 > 2 > 3 > 1 is a cycle, which 1 wins through its stronger paths
+        winners, rounds = Schulze().count(
+            {(1, 2, 3): 3, (2, 3, 1): 2, (3, 1, 2): 2}, 3, 2)
+        self.assertEqual(winners, [1, 2])
+
+    def test_ranked_pairs(self):
+        # 1 > 2 (5 votes) and 2 > 3 (5 votes) are locked in, 3 > 1 (4 votes)
+        # would create a cycle
+        winners, rounds = RankedPairs().count(
+            {(1, 2, 3): 3, (2, 3, 1): 2, (3, 1, 2): 2}, 3, 2)
+        self.assertEqual(winners, [1, 2])
+        self.assertEqual([(r.elected, r.eliminated) for r in rounds],
+                         [([1], []), ([2], []), ([], [3])])
+
+    def test_break_tie(self):
+        history = [{1: 2, 2: 1}, {1: 3, 2: 3}]
+        self.assertEqual(break_tie([1, 2], history, lowest=True), 2)
+        self.assertEqual(break_tie([1, 2], history, lowest=False), 1)
+        self.assertEqual(break_tie([1, 2], history[1:], lowest=True), 2)
+        # a candidate with no votes in the earlier round has the fewest
+        history = [{1: 0, 2: 1, 3: 5}, {1: 2, 2: 2, 3: 5}]
+        self.assertEqual(break_tie([1, 2], history, lowest=True), 1)
+
+    def test_get_result(self):
+        ballot = self.create_current_pr_ballot(seats_available=1)
+        candidate1 = self.create_candidate(ballot, last_name="a")
+        candidate2 = self.create_candidate(ballot, last_name="b")
+        candidate3 = self.create_candidate(ballot, last_name="c")
+        user_model = apps.get_model(settings.DJANGO_ELECT_USER_MODEL)
+        rankings = [(candidate1,), (candidate1,), (candidate2,),
+                    (candidate2,), (candidate3, candidate2)]
+        for i, ranking in enumerate(rankings):
+            account = user_model.objects.create_user(username="voter%i" % i)
+            vote = self.election_current.votes.create(account=account)
+            for rank, candidate in enumerate(ranking):
+                vote.preferentials.create(candidate=candidate, point=3 - rank)
+
+        result = ballot.get_result()
+        self.assertEqual(result.method.name, "Borda count")
+        self.assertEqual(result.winners, [candidate2])
+
+        result = ballot.get_result("irv")
+        self.assertEqual(result.winners, [candidate2])
+        self.assertEqual(result.rounds[0].counts, [(candidate1, 2.0),
+            (candidate2, 2.0), (candidate3, 1.0)])
+        self.assertEqual(result.rounds[0].eliminated, [candidate3])
+
+        out = StringIO()
+        call_command('tally_ballot', str(ballot.pk), method="stv", stdout=out)
+        self.assertIn("Elected: %s" % candidate2, out.getvalue())
+
+        ballot.is_secret = True
+        self.assertRaises(TallyError, ballot.get_result, "schulze")
+        self.assertRaises(TallyError, ballot.get_result, "foo")
+
+    def test_tally_ballots(self):
+        ballot1 = self.create_current_pr_ballot(seats_available=1)
+        candidate1 = self.create_candidate(ballot1, last_name="a")
+        candidate2 = self.create_candidate(ballot1, last_name="b")
+        ballot2 = self.create_current_pl_ballot(seats_available=1)
+        candidate3 = self.create_candidate(ballot2, last_name="c")
+        ballot3 = self.election_current.ballots.create(type="Pr",
+            seats_available=1, is_secret=True, tally_method="irv")
+        vote = self.election_current.votes.create(account=self.user1)
+        vote.preferentials.create(candidate=candidate2, point=2)
+        vote.preferentials.create(candidate=candidate1, point=1)
+        vote.pluralities.create(candidate=candidate3)
+
+        # within the test's transaction, the ballots are counted in this
+        # process, but the outcome is the same
+        outcomes = tally_ballots([ballot1, ballot2, ballot3], processes=3)
+        self.assertEqual([ballot for ballot, result, error in outcomes],
+                         [ballot1, ballot2, ballot3])
+        self.assertEqual(outcomes[0][1].winners, [candidate2])
+        self.assertEqual(outcomes[1][1].winners, [candidate3])
+        self.assertIsNone(outcomes[2][1])
+        self.assertIsInstance(outcomes[2][2], TallyError)
+
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('tally_election', str(self.election_current.pk),
+                         stdout=out)
+        self.assertIn("Plurality): %s" % candidate3, out.getvalue())
+        self.assertIn("Counted 2 ballots", out.getvalue())
+
+
+class ParallelTallyTestCase(TransactionTestCase):
+    """
+    Tests for counting ballots in a pool of processes, which only happens
+    outside a transaction, since the workers couldn't see its changes.
+    """
+    def test_tally_ballots(self):
+        user_model = apps.get_model(settings.DJANGO_ELECT_USER_MODEL)
+        account = user_model.objects.create_user(username="user1")
+        election = Election.objects.create(name="current",
+            vote_start=datetime(2010, 10, 1),
+            vote_end=datetime(2010, 10, 11))
+        ballot1 = election.ballots.create(type="Pr", seats_available=1)
+        candidate1 = ballot1.candidates.create(first_name="foo",
+                                               last_name="a")
+        candidate2 = ballot1.candidates.create(first_name="foo",
+                                               last_name="b")
+        ballot2 = election.ballots.create(type="Pl", seats_available=1)
+        candidate3 = ballot2.candidates.create(first_name="foo",
+                                               last_name="c")
+        ballot3 = election.ballots.create(type="Pr", seats_available=1,
+            is_secret=True, tally_method="irv")
+        vote = election.votes.create(account=account)
+        vote.preferentials.create(candidate=candidate2, point=2)
+        vote.preferentials.create(candidate=candidate1, point=1)
+        vote.pluralities.create(candidate=candidate3)
+
+        outcomes = tally_ballots([ballot1, ballot2, ballot3], processes=3)
+        self.assertEqual([ballot for ballot, result, error in outcomes],
+                         [ballot1, ballot2, ballot3])
+        self.assertEqual(outcomes[0][1].winners, [candidate2])
+        self.assertEqual(outcomes[1][1].winners, [candidate3])
+        self.assertIsNone(outcomes[2][1])
+        self.assertIsInstance(outcomes[2][2], TallyError)
+        # this process's connections can still be used afterwards
+        self.assertEqual(Election.objects.count(), 1)
+
+
+class PairwiseTestCase(BaseTestCase):
+    "Tests for the pairwise preference matrices in django_elect.pairwise"
+    def setUp(self):
+        super(PairwiseTestCase, self).setUp()
+        self.ballot = self.create_current_pr_ballot(seats_available=1)
+        self.candidate1 = self.create_candidate(self.ballot)
+        self.candidate2 = self.create_candidate(self.ballot)
+        self.voters = 0
+
+    def add_vote(self, *ranking):
+        user_model = apps.get_model(settings.DJANGO_ELECT_USER_MODEL)
+        self.voters += 1
+        account = user_model.objects.create_user(
+            username="voter%i" % self.voters)
+        vote = self.election_current.votes.create(account=account)
+        for rank, candidate in enumerate(ranking):
+            vote.preferentials.create(candidate=candidate, point=5 - rank)
+        return vote
+
+    def assertMatrixCurrent(self, matrix):
+        fresh = build_matrix(self.ballot)
+        self.assertEqual(matrix.candidate_ids, fresh.candidate_ids)
+        self.assertEqual(matrix.prefer, fresh.prefer)
+        self.assertEqual(matrix.totals, fresh.totals)
+
+    def test_add_candidates(self):
+        matrix = PairwiseMatrix([1, 2])
+        matrix.add_votes([(1, 1, 2), (1, 2, 1), (2, 2, 2)])
+        self.assertEqual(matrix.prefer, [[0, 0, 0], [0, 0, 1], [0, 1, 0]])
+        matrix.add_candidates([3])
+        self.assertEqual(matrix.prefer[1][3], 1)
+        self.assertEqual(matrix.prefer[2][3], 2)
+        self.assertEqual(matrix.get_margins(), [
+            (1, [None, 0, 1]), (2, [0, None, 2]), (3, [-1, -2, None])])
+
+    def test_get_matrix(self):
+        self.add_vote(self.candidate1, self.candidate2)
+        matrix = get_matrix(self.ballot)
+        self.assertMatrixCurrent(matrix)
+        self.assertEqual(matrix.get_margins(), [
+            (self.candidate1.pk, [None, 1]), (self.candidate2.pk, [-1, None])])
+
+        # new votes and write-in candidates are added to the cached matrix
+        vote = self.add_vote(self.candidate2)
+        write_in = self.ballot.candidates.create(first_name="foo",
+            last_name="write-in", write_in=True)
+        self.add_vote(write_in, self.candidate1)
+        with self.assertNumQueries(2):
+            matrix = get_matrix(self.ballot)
+        self.assertMatrixCurrent(matrix)
+
+        # deleted votes make it rebuild the matrix
+        vote.delete()
+        matrix = get_matrix(self.ballot)
+        self.assertMatrixCurrent(matrix)
+        self.assertEqual(len(matrix.candidate_ids), 3)
+
+    def test_get_result(self):
+        self.add_vote(self.candidate2, self.candidate1)
+        self.add_vote(self.candidate2)
+        result = self.ballot.get_result("ranked_pairs")
+        self.assertEqual(result.winners, [self.candidate2])
+        self.assertEqual(result.margins, [(self.candidate1, [None, -2]),
+                                          (self.candidate2, [2, None])])
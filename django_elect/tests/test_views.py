@@ -1,13 +1,23 @@
+import json
+import os
+import shutil
+import tempfile
+from collections import deque
 from freezegun import freeze_time
 from datetime import datetime
 
 from django.apps import apps
 from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import StringIO
 from django.conf import settings
 
-from django_elect import settings
-from django_elect.models import Ballot, Candidate, Election, Vote, \
-    VotePlurality, VotePreferential
+from django_elect import caching, instrumentation, settings, spool, views
+from django_elect.autocomplete import AccountAutocomplete
+from django_elect.models import AccountSearchKey, Ballot, Candidate, \
+    Election, Vote, VotePlurality, VotePreferential
 
 
 @freeze_time("2010-10-10 00:00:00")
@@ -17,6 +27,11 @@ class VoteTestCase(TestCase):
     """
     urls = 'django_elect.tests.urls'
 
+    def setUp(self):
+        # elections from earlier tests are rolled back without the signals
+        # that invalidate the cached current election
+        caching.get_cache().clear()
+
     def test_when_voting_unallowed(self):
         # should get redirected when not logged in
         response = self.client.get("/election/")
@@ -183,6 +198,25 @@ class PluralityVoteTestCase(BaseBallotVoteTestCase):
         })
         self.assertContains(response, 'id="error0"')
 
+    def test_repeated_submission(self):
+        # the form should include an idempotency token
+        response = self.client.get("/election/")
+        self.assertContains(response, 'name="vote_token"')
+
+        # submitting the same form again should show the original result
+        data = {'ballot1-1': 'on', 'vote_token': "a" * 32}
+        response = self.client.post("/election/", data)
+        self.assertRedirects(response, "/election/success")
+        response = self.client.post("/election/", data)
+        self.assertRedirects(response, "/election/success")
+        self.assertEqual(Vote.objects.count(), 1)
+        self.assertEqual(VotePlurality.objects.count(), 1)
+
+        # but a different form should be rejected
+        data['vote_token'] = "b" * 32
+        response = self.client.post("/election/", data)
+        self.assertRedirects(response, settings.LOGIN_URL)
+
     def test_single_selection(self):
         # should be able to vote by just checking one candidate
         response = self.client.post("/election/", {'ballot1-1': 'on'})
@@ -264,6 +298,80 @@ class PluralityVoteTestCase(BaseBallotVoteTestCase):
             for vpl in vpl_objects:
                 self.assertEquals(vpl.vote, vote_objects[0])
 
+    def test_ballot_cache_invalidation(self):
+        response = self.client.get("/election/")
+        self.assertContains(response, "Ballot 1 Candidate 1")
+
+        # the cached ballot table should be invalidated by changes to
+        # candidates and ballots
+        candidate = Candidate.objects.get(id=1)
+        candidate.last_name = "Renamed"
+        candidate.institution = "Some University"
+        candidate.save()
+        response = self.client.get("/election/")
+        self.assertNotContains(response, "Ballot 1 Candidate 1")
+        self.assertContains(response, "Ballot 1 Renamed")
+        self.assertContains(response, "Some University")
+
+        candidate.delete()
+        response = self.client.get("/election/")
+        self.assertNotContains(response, "Ballot 1 Renamed")
+
+    def test_cached_election(self):
+        # once cached, the vote page shouldn't read the election, ballots or
+        # candidates
+        caching.run_pending_invalidations(force=True)
+        self.client.get("/election/")
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get("/election/")
+        self.assertContains(response, "Ballot 4 Candidate 2")
+        for query in context.captured_queries:
+            self.assertNotRegexpMatches(query['sql'],
+                "django_elect_(election|ballot|candidate)\\b")
+
+    def test_vote_by_slug(self):
+        other = Election.objects.create(name="Other Region",
+            vote_start=datetime(2010, 10, 2),
+            vote_end=datetime(2010, 10, 11))
+        other.ballots.create(type="Pl", seats_available=1) \
+                     .candidates.create(first_name="Other", last_name="Guy")
+
+        # the elections are listed, and each one has its own voting page
+        response = self.client.get("/election/elections/")
+        self.assertContains(response, 'href="/election/elections/current/"')
+        self.assertContains(response,
+                            'href="/election/elections/other-region/"')
+        response = self.client.get("/election/")
+        self.assertContains(response, "Other Guy")
+        response = self.client.get("/election/elections/current/")
+        self.assertContains(response, "Ballot 4 Candidate 2")
+        self.assertNotContains(response, "Other Guy")
+        response = self.client.get("/election/elections/missing/")
+        self.assertEqual(response.status_code, 404)
+
+        response = self.client.post("/election/elections/current/",
+                                    {'ballot1-1': 'on'})
+        self.assertRedirects(response, "/election/elections/current/success")
+        self.assertTrue(self.election.has_voted(self.user1))
+        self.assertFalse(other.has_voted(self.user1))
+        response = self.client.get("/election/elections/")
+        self.assertNotContains(response, "/election/elections/current/")
+
+    def test_complete_ballot_query_count(self):
+        # eligibility should be checked with a single query, each selection
+        # model should be written with a single bulk insert and the tallies
+        # updated with a single query, so the number of queries shouldn't
+        # depend on the number of candidates
+        data = {
+            'ballot1-1': 'on',
+            'ballot2-7': 'on',
+            'ballot2-8': 'on',
+            'ballot3': 'ballot3-12',
+        }
+        with self.assertNumQueries(12):
+            response = self.client.post("/election/", data)
+        self.assertRedirects(response, "/election/success")
+
 
 class PreferentialVoteTestCase(BaseBallotVoteTestCase):
     """
@@ -367,8 +475,7 @@ class PreferentialVoteTestCase(BaseBallotVoteTestCase):
         self.assertEqual(vpr_objects[0].point, 3)
         self.assertTrue(vpr_objects[0].vote is None)
 
-    def test_complete_ballot(self):
-        # now try doing a proper vote
+    def get_complete_ballot_data(self):
         fields = self.b1_post_fields + self.b2_post_fields
         post_data = dict.fromkeys(fields, "0")
         modifications = {
@@ -387,9 +494,49 @@ class PreferentialVoteTestCase(BaseBallotVoteTestCase):
             'ballot2-10': '2',
         }
         post_data.update(modifications)
-        response = self.client.post("/election/", post_data)
+        return post_data
+
+    def test_complete_ballot(self):
+        # now try doing a proper vote
+        response = self.client.post("/election/",
+                                    self.get_complete_ballot_data())
         self.assertRedirects(response, "/election/success")
+        self.check_complete_ballot()
+
+    def test_complete_ballot_spooled(self):
+        # with a spool, the vote should only be stored once it's drained
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        self.addCleanup(setattr, settings, 'DJANGO_ELECT_SPOOL_PATH',
+                        settings.DJANGO_ELECT_SPOOL_PATH)
+        settings.DJANGO_ELECT_SPOOL_PATH = os.path.join(spool_dir, "spool.db")
+        data = self.get_complete_ballot_data()
+        response = self.client.post("/election/", data)
+        self.assertRedirects(response, "/election/success")
+        self.assertEqual(Vote.objects.count(), 0)
+        self.assertEqual(VotePreferential.objects.count(), 0)
 
+        # voting again is prevented by the spool
+        response = self.client.post("/election/", data)
+        self.assertRedirects(response, settings.LOGIN_URL)
+        out = StringIO()
+        call_command('vote_spool_status', stdout=out)
+        self.assertIn("1 pending, 0 stored, 0 failed", out.getvalue())
+
+        call_command('drain_vote_spool', stdout=StringIO())
+        self.check_complete_ballot()
+        out = StringIO()
+        call_command('vote_spool_status', stdout=out)
+        self.assertIn("0 pending, 1 stored, 0 failed", out.getvalue())
+
+        # the spool shouldn't keep the choices of stored votes
+        self.assertEqual(spool.get_connection().execute(
+            "SELECT record FROM spooled_vote").fetchall(), [("",)])
+        # and disassociating the accounts removes the votes from it
+        Vote.objects.get(account=self.user1).election.disassociate_accounts()
+        self.assertEqual(spool.get_status(), [])
+
+    def check_complete_ballot(self):
         vote_objects = Vote.objects.filter(account=self.user1)
         self.assertEqual(vote_objects.count(), 1)
 
@@ -414,3 +561,424 @@ class PreferentialVoteTestCase(BaseBallotVoteTestCase):
         self.assertEqual(vpr_objects.get(candidate__id=8).point, 3)
         self.assertEqual(vpr_objects.get(candidate__id=9).point, 6)
         self.assertEqual(vpr_objects.get(candidate__id=10).point, 2)
+
+
+@freeze_time("2010-10-10 00:00:00")
+class BiographiesTestCase(TestCase):
+    """
+    Tests for the biographies() view
+    """
+    urls = 'django_elect.tests.urls'
+
+    def test_biographies(self):
+        election = Election.objects.create(
+            name="current",
+            vote_start=datetime(2010, 10, 1),
+            vote_end=datetime(2010, 10, 11))
+        ballot = election.ballots.create(type="Pl", seats_available=1,
+            description="Board")
+        candidate = ballot.candidates.create(first_name="Foo",
+            last_name="Bar", biography="Foo's biography")
+        ballot.candidates.create(first_name="Lorem", last_name="Ipsum")
+        # the request that made the changes would have repeated the
+        # invalidations at its end
+        caching.run_pending_invalidations(force=True)
+
+        response = self.client.get("/election/biographies")
+        self.assertContains(response, "Foo's biography")
+        self.assertNotContains(response, "Lorem Ipsum")
+        etag = response['ETag']
+
+        # revalidating an unchanged page shouldn't need any queries, since
+        # the election is cached too
+        with self.assertNumQueries(0):
+            response = self.client.get("/election/biographies",
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # the cached page should be invalidated by changes to candidates
+        candidate.biography = "Foo's new biography"
+        candidate.save()
+        response = self.client.get("/election/biographies",
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, "Foo's new biography")
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class StatisticsTestCase(TestCase):
+    """
+    Tests for the statistics() view
+    """
+    urls = 'django_elect.tests.urls'
+
+    def test_conditional_get(self):
+        user_model = apps.get_model(settings.DJANGO_ELECT_USER_MODEL)
+        staff = user_model.objects.create_superuser(username="admin",
+            email="admin@foo.com", password="foo")
+        self.client.login(username="admin", password="foo")
+        election = Election.objects.create(
+            name="current",
+            vote_start=datetime(2010, 10, 1),
+            vote_end=datetime(2010, 10, 11))
+        ballot = election.ballots.create(type="Pl", seats_available=1,
+            description="Board")
+        candidate = ballot.candidates.create(first_name="Foo",
+            last_name="Bar")
+        url = "/election/statistics/%i" % election.pk
+        # the request that made the changes would have repeated the
+        # invalidations at its end
+        caching.run_pending_invalidations(force=True)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        # an unchanged page shouldn't need to read the votes
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        for query in context.captured_queries:
+            self.assertNotIn("django_elect_vote", query['sql'])
+
+        # a new vote should change the ETag
+        vote = election.votes.create(account=staff)
+        vote.pluralities.create(candidate=candidate)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class DisassociateTestCase(TestCase):
+    """
+    Tests for the disassociate_accounts() view
+    """
+    urls = 'django_elect.tests.urls'
+
+    def setUp(self):
+        caching.get_cache().clear()
+        user_model = apps.get_model(settings.DJANGO_ELECT_USER_MODEL)
+        user_model.objects.create_superuser(username="admin",
+            email="admin@foo.com", password="foo")
+        self.client.login(username="admin", password="foo")
+        self.election = Election.objects.create(
+            name="current",
+            vote_start=datetime(2010, 10, 1),
+            vote_end=datetime(2010, 10, 11))
+        for i in range(3):
+            voter = user_model.objects.create_user(username="voter%i" % i)
+            self.election.votes.create(account=voter)
+        self.url = "/election/disassociate/%i/" % self.election.pk
+        # one vote per batch and two batches per request
+        for module, name, value in [
+                (settings, 'DJANGO_ELECT_DISASSOCIATE_BATCH_SIZE', 1),
+                (settings, 'DJANGO_ELECT_DISASSOCIATE_SLEEP', 0),
+                (views, 'DISASSOCIATE_BATCHES_PER_REQUEST', 2)]:
+            self.addCleanup(setattr, module, name, getattr(module, name))
+            setattr(module, name, value)
+
+    def get_associated(self):
+        return self.election.votes.filter(account__isnull=False).count()
+
+    def test_disassociate(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, 'name="confirm"')
+
+        response = self.client.post(self.url, {'confirm': "1"})
+        self.assertRedirects(response, self.url)
+        self.assertEqual(self.get_associated(), 1)
+        response = self.client.get(self.url)
+        self.assertContains(response, "2 of 3 votes have been processed")
+        self.assertContains(response, 'name="continue"')
+
+        response = self.client.post(self.url, {'continue': "1"})
+        self.assertRedirects(response, self.url)
+        self.assertEqual(self.get_associated(), 0)
+        response = self.client.get(self.url)
+        self.assertContains(response, "succesfully disassociated")
+
+    def test_concurrent_requests(self):
+        # a request that's already processing batches holds the lock, so
+        # another one doesn't start processing the same votes
+        caching.acquire_lock("disassociate", self.election.pk, 60)
+        self.client.post(self.url, {'confirm': "1"})
+        self.assertEqual(self.get_associated(), 3)
+        self.assertIsNone(
+            caching.get_job_status("disassociate", self.election.pk))
+
+        caching.release_lock("disassociate", self.election.pk)
+        self.client.post(self.url, {'confirm': "1"})
+        self.assertEqual(self.get_associated(), 1)
+
+
+class CandidateAutocompleteTestCase(TestCase):
+    """
+    Tests for CandidateAutocomplete
+    """
+    urls = 'django_elect.tests.urls'
+
+    def setUp(self):
+        user_model = apps.get_model(settings.DJANGO_ELECT_USER_MODEL)
+        user_model.objects.create_superuser(username="admin",
+            email="admin@foo.com", password="foo")
+        self.client.login(username="admin", password="foo")
+        self.election = Election.objects.create(
+            name="current",
+            vote_start=datetime(2010, 10, 1),
+            vote_end=datetime(2010, 10, 11))
+        ballot = self.election.ballots.create(type="Pl", seats_available=1)
+        self.candidate = ballot.candidates.create(first_name=u"Jos\xe9",
+            last_name=u"\xc1lvarez")
+        ballot.candidates.create(first_name="Foo", last_name="Bar")
+
+    def search(self, query, **forward):
+        response = self.client.get("/election/vote-plurality-autocomplete/",
+            {'q': query, 'forward': json.dumps(forward)})
+        return [r['id'] for r in json.loads(response.content)['results']]
+
+    def test_search(self):
+        # names should be matched without accents or case
+        self.assertEqual(self.search("jose"), [str(self.candidate.pk)])
+        self.assertEqual(self.search(u"Jos\xe9 \xc1l"),
+                         [str(self.candidate.pk)])
+        # without an election, only the beginning of the name is matched
+        self.assertEqual(self.search("alv"), [])
+
+        election = self.election.pk
+        self.assertEqual(self.search("alv", election=election),
+                         [str(self.candidate.pk)])
+        self.assertEqual(self.search("lv", election=election), [])
+
+        # renamed candidates should be found under their new name
+        self.candidate.last_name = "Baz"
+        self.candidate.save()
+        self.assertEqual(self.search("alv", election=election), [])
+        self.assertEqual(len(self.search("ba", election=election)), 2)
+
+
+class AccountAutocompleteTestCase(TestCase):
+    """
+    Tests for AccountAutocomplete
+    """
+    urls = 'django_elect.tests.urls'
+
+    def setUp(self):
+        user_model = apps.get_model(settings.DJANGO_ELECT_USER_MODEL)
+        user_model.objects.create_superuser(username="admin",
+            email="admin@foo.com", password="foo")
+        self.client.login(username="admin", password="foo")
+        self.users = []
+        for i in range(5):
+            self.users.append(user_model.objects.create_user(
+                username="user%i" % i, first_name=u"J\xfcrgen",
+                last_name="Smith%i" % i))
+
+    def search(self, query, page=1, **forward):
+        response = self.client.get("/election/account-autocomplete/",
+            {'q': query, 'page': page, 'forward': json.dumps(forward)})
+        data = json.loads(response.content)
+        return ([int(r['id']) for r in data['results']],
+                data['pagination']['more'])
+
+    def test_search(self):
+        ids = [u.pk for u in self.users]
+        # any of the names should match, without accents or case
+        self.assertEqual(self.search("jurgen"), (ids, False))
+        self.assertEqual(self.search("smith3"), ([ids[3]], False))
+        self.assertEqual(self.search("urgen"), ([], False))
+
+        # renamed accounts should be found under their new name
+        self.users[3].last_name = "Jones"
+        self.users[3].save()
+        self.assertEqual(self.search("smith3"), ([], False))
+        self.assertEqual(self.search("jones"), ([ids[3]], False))
+
+        # only the allowed voters should be searched if there are any
+        election = Election.objects.create(
+            name="current",
+            vote_start=datetime(2010, 10, 1),
+            vote_end=datetime(2010, 10, 11))
+        self.assertEqual(self.search("smith", election=election.pk),
+                         (ids[:3] + ids[4:], False))
+        election.allowed_voters.add(self.users[1], self.users[4])
+        self.assertEqual(self.search("smith", election=election.pk),
+                         ([ids[1], ids[4]], False))
+
+    def test_filter_backend(self):
+        # accounts saved while another backend is used aren't indexed
+        self.addCleanup(setattr, settings,
+                        'DJANGO_ELECT_ACCOUNT_SEARCH_BACKEND',
+                        settings.DJANGO_ELECT_ACCOUNT_SEARCH_BACKEND)
+        settings.DJANGO_ELECT_ACCOUNT_SEARCH_BACKEND = \
+            'django_elect.account_search.FilterBackend'
+        self.users[0].last_name = "Jones"
+        self.users[0].save()
+        self.assertFalse(AccountSearchKey.objects.filter(
+            account=self.users[0], key__startswith="jones").exists())
+
+    def test_pagination(self):
+        ids = [u.pk for u in self.users]
+        old_paginate_by = AccountAutocomplete.paginate_by
+        AccountAutocomplete.paginate_by = 2
+        try:
+            self.assertEqual(self.search("jurgen"), (ids[:2], True))
+            self.assertEqual(self.search("jurgen", 2), (ids[2:4], True))
+            self.assertEqual(self.search("jurgen", 3), (ids[4:], False))
+
+            # an account with several matching names is only listed once,
+            # under the first of them
+            user_model = apps.get_model(settings.DJANGO_ELECT_USER_MODEL)
+            other = user_model.objects.create_user(username="other",
+                first_name="Jurgen", last_name="Jurgenson")
+            self.assertEqual(self.search("jurg"), ([other.pk, ids[0]], True))
+            self.assertEqual(self.search("jurg", 2), (ids[1:3], True))
+            self.assertEqual(self.search("jurg", 3), (ids[3:], True))
+            self.assertEqual(self.search("jurg", 4), ([], False))
+        finally:
+            AccountAutocomplete.paginate_by = old_paginate_by
+
+
+class InstrumentationTestCase(TestCase):
+    """
+    Tests for django_elect.instrumentation
+    """
+    urls = 'django_elect.tests.urls'
+
+    def setUp(self):
+        self.election = Election.objects.create(
+            name="current",
+            vote_start=datetime(2010, 10, 1),
+            vote_end=datetime(2010, 10, 11))
+        ballot = self.election.ballots.create(type="Pl", seats_available=1)
+        for i in range(6):
+            ballot.candidates.create(first_name="Foo", last_name="Bar%i" % i,
+                                     biography="Biography %i" % i)
+
+    def test_middleware(self):
+        measurements = []
+
+        def receiver(sender, measurement, **kwargs):
+            measurements.append(measurement)
+        instrumentation.request_measured.connect(receiver)
+        try:
+            with self.modify_settings(MIDDLEWARE_CLASSES={'append':
+                    'django_elect.instrumentation.InstrumentationMiddleware'}):
+                self.client.get("/election/biographies")
+                # views from other apps shouldn't be measured
+                self.client.get("/account/")
+        finally:
+            instrumentation.request_measured.disconnect(receiver)
+        self.assertEqual(len(measurements), 1)
+        measurement = measurements[0]
+        self.assertEqual(measurement.name, "django_elect_biographies")
+        self.assertTrue(measurement.queries > 0)
+        self.assertTrue(measurement.timings['render'] > 0)
+        self.assertEqual(measurement.repeated_queries, [])
+
+        user_model = apps.get_model(settings.DJANGO_ELECT_USER_MODEL)
+        user_model.objects.create_superuser(username="admin",
+            email="admin@foo.com", password="foo")
+        self.client.login(username="admin", password="foo")
+        response = self.client.get("/election/metrics")
+        self.assertContains(response,
+            'django_elect_requests_total{view="django_elect_biographies"}')
+        self.assertContains(response, 'part="render"')
+
+    def test_repeated_queries(self):
+        candidate_ids = Candidate.objects.values_list('pk', flat=True)
+        with instrumentation.measure("test") as measurement:
+            for pk in candidate_ids:
+                Candidate.objects.get(pk=pk)
+        self.assertEqual(measurement.queries, 7)
+        self.assertEqual(len(measurement.repeated_queries), 1)
+        sql, count = measurement.repeated_queries[0]
+        self.assertEqual(count, 6)
+
+    def test_full_query_log(self):
+        # queries are still counted once the connection's log is full
+        self.addCleanup(setattr, connection, 'queries_log',
+                        connection.queries_log)
+        connection.queries_log = deque(maxlen=2)
+        candidate_ids = list(Candidate.objects.values_list('pk', flat=True))
+        with instrumentation.measure("outer") as outer:
+            Candidate.objects.count()
+            with instrumentation.measure("inner") as inner:
+                for pk in candidate_ids:
+                    Candidate.objects.get(pk=pk)
+        self.assertEqual(inner.queries, 6)
+        self.assertEqual(inner.repeated_queries[0][1], 6)
+        self.assertEqual(outer.queries, 7)
+
+
+class VoteAdminTestCase(TestCase):
+    """
+    Tests for VoteAdmin
+    """
+    urls = 'django_elect.tests.urls'
+
+    def test_changelist_query_count(self):
+        user_model = apps.get_model(settings.DJANGO_ELECT_USER_MODEL)
+        user_model.objects.create_superuser(username="admin",
+            email="admin@foo.com", password="foo")
+        self.client.login(username="admin", password="foo")
+        election = Election.objects.create(
+            name="current",
+            vote_start=datetime(2010, 10, 1),
+            vote_end=datetime(2010, 10, 11))
+        ballot = election.ballots.create(type="Pl", seats_available=1)
+        candidate = ballot.candidates.create(first_name="Foo",
+                                             last_name="Bar")
+
+        def add_votes(number):
+            for i in range(number):
+                voter = user_model.objects.create_user(
+                    username="voter%i" % user_model.objects.count())
+                vote = election.votes.create(account=voter)
+                vote.pluralities.create(candidate=candidate)
+
+        # the number of queries shouldn't depend on the number of votes
+        add_votes(2)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get("/admin/django_elect/vote/")
+        self.assertContains(response, "Foo Bar", 2)
+        add_votes(3)
+        with self.assertNumQueries(len(context.captured_queries)):
+            response = self.client.get("/admin/django_elect/vote/")
+        self.assertContains(response, "Foo Bar", 5)
+
+
+class CsvExportTestCase(TestCase):
+    """
+    Tests for the generate_csv() view
+    """
+    urls = 'django_elect.tests.urls'
+
+    def test_generate_csv(self):
+        user_model = apps.get_model(settings.DJANGO_ELECT_USER_MODEL)
+        staff = user_model.objects.create_superuser(username="admin",
+            email="admin@foo.com", password="foo")
+        self.client.login(username="admin", password="foo")
+        election = Election.objects.create(
+            name="current",
+            vote_start=datetime(2010, 10, 1),
+            vote_end=datetime(2010, 10, 11))
+        ballot = election.ballots.create(type="Pr", seats_available=2,
+            description="Board")
+        ballot.candidates.create(first_name="Foo", last_name="Bar")
+        candidate2 = ballot.candidates.create(first_name="Lorem",
+            last_name="Ipsum")
+        vote = election.votes.create(account=staff)
+        vote.preferentials.create(candidate=candidate2, point=2)
+        caching.run_pending_invalidations(force=True)
+
+        response = self.client.get("/election/csv/%i" % election.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = ''.join(response.streaming_content).splitlines()
+        self.assertEqual(lines[1], "Vote ID,Voter,Foo Bar,Lorem Ipsum")
+        self.assertEqual(lines[2], "%i,admin,0,2" % vote.pk)
+        self.assertEqual(len(lines), 3)
+
+        # an unchanged election shouldn't be exported again
+        response = self.client.get("/election/csv/%i" % election.pk,
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
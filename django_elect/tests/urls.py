@@ -1,5 +1,6 @@
 from django.http import HttpResponseNotFound, HttpResponse
 from django.conf.urls import patterns, url, include
+from django.contrib import admin
 
 
 handler404 = lambda request: HttpResponseNotFound()
@@ -7,5 +8,7 @@ handler404 = lambda request: HttpResponseNotFound()
 urlpatterns = patterns('',
     url(r'^account/', lambda request: HttpResponse("LOGIN")),
     url(r'^election/', include('django_elect.urls')),
+    # the statistics page links to the admin
+    url(r'^admin/', include(admin.site.urls)),
 )
 
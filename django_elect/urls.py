@@ -4,12 +4,23 @@ from django_elect import views, autocomplete
 
 
 urlpatterns = patterns('',
+    url(r'^elections/$', views.open_elections,
+        name="django_elect_open_elections"),
+    url(r'^elections/(?P<slug>[-\w]+)/(?:index\.html)?$', views.vote,
+        name="django_elect_election_vote"),
+    url(r'^elections/(?P<slug>[-\w]+)/biographies', views.biographies,
+        name="django_elect_election_biographies"),
+    url(r'^elections/(?P<slug>[-\w]+)/success', views.success,
+        name="django_elect_election_success"),
     url(r'^biographies', views.biographies, name="django_elect_biographies"),
     url(r'^success', views.success, name="django_elect_success"),
     url(r'^statistics/(?P<id>\d+)', views.statistics,
         name="django_elect_stats"),
     url(r'^spreadsheet/(?P<id>\d+)', views.generate_spreadsheet,
         name="django_elect_spreadsheet"),
+    url(r'^csv/(?P<id>\d+)', views.generate_csv,
+        name="django_elect_csv"),
+    url(r'^metrics$', views.metrics, name="django_elect_metrics"),
     url(r'^disassociate/(?P<id>\d+)', views.disassociate_accounts,
         name="django_elect_disassociate"),
     url(r'^vote-plurality-autocomplete/$',
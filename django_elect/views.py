@@ -1,47 +1,135 @@
-from django.http import HttpResponse, HttpResponseRedirect
-from django.shortcuts import render_to_response, get_object_or_404
+import csv
+import re
+from datetime import datetime
+from hashlib import md5
+from uuid import uuid4
+
+from django.http import HttpResponse, HttpResponseRedirect, \
+    HttpResponseForbidden, StreamingHttpResponse
+from django.db.models import Prefetch
+from django.shortcuts import get_object_or_404
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
+from django.utils import lru_cache
+from django.utils.crypto import constant_time_compare
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.cache import never_cache
+from django.views.decorators.http import condition
 
-from django_elect.models import Election, Vote
-from django_elect.forms import PluralityVoteForm, PreferentialVoteForm
-from django_elect import settings
+from django_elect.models import Candidate, Election, Vote, \
+    VotingNotAllowedException
+from django_elect.forms import PluralityVoteForm, PreferentialVoteForm, \
+    save_vote_forms
+from django_elect import settings, caching, instrumentation, spool
+from django_elect.instrumentation import render_to_response, render_to_string
+from django_elect.tally import tally_ballots
 
 
-def biographies(request):
-    election = Election.get_latest_or_404()
-    ballot_candidates = dict((b, b.candidates_with_biographies())
-        for b in election.ballots.all() if b.candidates_with_biographies())
-    return render_to_response('django_elect/biographies.html', {
-        'election': election,
-        'ballot_candidates': ballot_candidates.items(),
-    })
+# number of batches of votes that each request to disassociate_accounts()
+# processes
+DISASSOCIATE_BATCHES_PER_REQUEST = 10
+
+# number of seconds after which a request processing batches is assumed to
+# have died, so another one can take over
+DISASSOCIATE_JOB_TIMEOUT = 5 * 60
+
+# number of seconds to keep the status of a disassociation job, after which
+# the page offers to run it again (which finds nothing left to do if it
+# finished)
+DISASSOCIATE_STATUS_TIMEOUT = 24 * 60 * 60
+
+# format of the idempotency tokens in the vote form
+VOTE_TOKEN_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _get_biographies_page(request, slug=None):
+    """
+    Returns a dictionary with the rendered biographies page of the latest
+    election, or the one with the given slug ("content"), its ETag ("etag")
+    and the time it was rendered ("last_modified"). The page is only
+    rendered again when the election or one of its ballots or candidates
+    changes, or voting starts or ends.
+    """
+    page = getattr(request, '_django_elect_biographies', None)
+    if page is not None:
+        return page
+    election = Election.get_current_or_404(slug)
+    cache = caching.get_cache()
+    key = "django_elect:biographies:%s:%s:%i" % (election.pk,
+        caching.get_version("biographies", election.pk),
+        election.voting_allowed())
+    page = cache.get(key)
+    if page is None:
+        candidates = Candidate.objects.exclude(biography="")
+        ballots = election.ballots.prefetch_related(Prefetch('candidates',
+            queryset=candidates, to_attr='biography_candidates'))
+        content = render_to_string('django_elect/biographies.html', {
+            'election': election,
+            'ballot_candidates': [(b, b.biography_candidates)
+                                  for b in ballots if b.biography_candidates],
+        })
+        page = {
+            'content': content,
+            'etag': md5(content.encode('utf-8')).hexdigest(),
+            'last_modified': datetime.utcnow(),
+        }
+        cache.set(key, page, settings.DJANGO_ELECT_BIOGRAPHIES_CACHE_TIMEOUT)
+    request._django_elect_biographies = page
+    return page
+
+
+@condition(
+    etag_func=lambda request, slug=None:
+        _get_biographies_page(request, slug)['etag'],
+    last_modified_func=lambda request, slug=None:
+        _get_biographies_page(request, slug)['last_modified'])
+def biographies(request, slug=None):
+    return HttpResponse(_get_biographies_page(request, slug)['content'])
+
+
+def _election_etag(request, id):
+    """
+    Returns the ETag of the pages with the results of the election with the
+    given primary key, which is based on its version stamp so it can be
+    checked without reading the votes.
+    """
+    return "%s-%s" % (id, caching.get_election_version(id))
 
 
 @staff_member_required
 @never_cache
+@condition(etag_func=_election_etag)
 def statistics(request, id):
     """
     Displays a table for each ballot with statistics for the candidates.
     """
     election = get_object_or_404(Election, pk=id)
+    candidate_stats = election.get_candidate_stats()
+    # show the rounds of counting (and for Condorcet methods, the pairwise
+    # margins) for ranked methods
+    ranked = [ballot for ballot, stats in candidate_stats
+              if ballot.type == "Pr" and ballot.tally_method != "borda"]
+    results = dict((ballot.pk, (result, error)) for ballot, result, error
+                   in tally_ballots(ranked))
+    ballot_stats = [(ballot, stats) + results.get(ballot.pk, (None, None))
+                    for ballot, stats in candidate_stats]
     return render_to_response('django_elect/statistics.html', {
         'title': "Election Statistics",
         'election': election,
+        'ballot_stats': ballot_stats,
     })
 
 
 @staff_member_required
+@condition(etag_func=_election_etag)
 def generate_spreadsheet(request, id):
     """
     Generates an Excel spreadsheet for review by a staff member.
     """
     election = get_object_or_404(Election, pk=id)
     response = render_to_response("django_elect/spreadsheet.html", {
-        'full_stats': election.get_full_statistics(),
+        'full_stats': election.get_full_statistics(sparse=True),
     })
     filename = "election%s.xls" % (election.pk)
     response['Content-Disposition'] = 'attachment; filename='+filename
@@ -49,35 +137,135 @@ def generate_spreadsheet(request, id):
     return response
 
 
+class _Echo(object):
+    """
+    File-like object that returns what's written to it instead of storing it,
+    so csv.writer can be used to generate rows for a StreamingHttpResponse.
+    """
+    def write(self, value):
+        return value
+
+
+@staff_member_required
+@condition(etag_func=_election_etag)
+def generate_csv(request, id):
+    """
+    Generates a CSV file with the same data as generate_spreadsheet(). The
+    rows are streamed to the client as they're read from the database, so
+    this works for elections that are too large to export in one go.
+    """
+    election = get_object_or_404(Election, pk=id)
+    candidates = election.get_statistics_candidates()
+
+    def encode(row):
+        return [unicode(col).encode('utf-8') for col in row]
+
+    def rows():
+        writer = csv.writer(_Echo())
+        yield writer.writerow(encode(
+            ["", ""] + [c.ballot for c in candidates]))
+        yield writer.writerow(encode(
+            ["Vote ID", "Voter"] + [c.get_name() for c in candidates]))
+        for vote, points in election.iter_full_statistics():
+            yield writer.writerow(encode(
+                [vote.pk, vote.account or ""] + points))
+
+    response = StreamingHttpResponse(rows(), content_type='text/csv')
+    filename = "election%s.csv" % (election.pk)
+    response['Content-Disposition'] = 'attachment; filename='+filename
+    return response
+
+
 @staff_member_required
 def disassociate_accounts(request, id):
     """
     Disassociates accounts (i.e. sets account_ids to NULL) for all Vote
     objects. 'id' corresponds to the primary key of the Election objects.
+    This is done in batches: each POST request processes up to
+    DISASSOCIATE_BATCHES_PER_REQUEST of them and records the progress with
+    caching.set_job_status(), and the page keeps submitting itself until
+    it's finished. If it's interrupted, it resumes where it stopped.
     """
     election = get_object_or_404(Election, pk=id)
-    success = False
-    if request.POST and "confirm" in request.POST:
-        election.disassociate_accounts()
-        success = True
+    job = caching.get_job_status("disassociate", election.pk)
+    done = job and job['state'] == "done"
+    if request.POST and ("confirm" in request.POST or
+                         "continue" in request.POST) and not done:
+        _disassociate_next_batches(election, job)
+        return HttpResponseRedirect(request.path)
     return render_to_response("django_elect/disassociate.html", {
         "title": "Disassociate Accounts for Election %s" % election,
         "election": election,
-        "success": success,
+        "job": job,
+        "running": job and job['state'] == "running",
+        "success": done,
     }, context_instance=RequestContext(request))
 
 
+def _disassociate_next_batches(election, job):
+    """
+    Disassociates the accounts of the next DISASSOCIATE_BATCHES_PER_REQUEST
+    batches of votes of the given election, continuing from the given job
+    status, and records the new status. Does nothing if another request is
+    already doing this for the election.
+    """
+    if not caching.acquire_lock("disassociate", election.pk,
+                                DISASSOCIATE_JOB_TIMEOUT):
+        return
+    try:
+        # the status may have changed while the lock was being acquired
+        job = caching.get_job_status("disassociate", election.pk) or job
+        if job and job['state'] == "done":
+            return
+        if job:
+            status = dict(job)
+        else:
+            total = election.votes.filter(account__isnull=False).count()
+            status = {'updated': 0, 'last_pk': 0, 'total': total}
+        updated = election.disassociate_accounts_in_batches(
+            settings.DJANGO_ELECT_DISASSOCIATE_BATCH_SIZE,
+            settings.DJANGO_ELECT_DISASSOCIATE_SLEEP, status['last_pk'],
+            lambda updated, last_pk: status.update(last_pk=last_pk),
+            max_batches=DISASSOCIATE_BATCHES_PER_REQUEST)
+        status['updated'] += updated
+        remaining = election.votes.filter(account__isnull=False,
+                                          pk__gt=status['last_pk'])
+        status['state'] = "running" if remaining.exists() else "done"
+        caching.set_job_status("disassociate", election.pk,
+                               DISASSOCIATE_STATUS_TIMEOUT, **status)
+    finally:
+        caching.release_lock("disassociate", election.pk)
+
+
 @login_required
-def vote(request):
-    election = Election.get_latest_or_404()
-    if not election.voting_allowed_for_user(request.user):
+def vote(request, slug=None):
+    """
+    Shows the ballots of the latest election, or the one with the given
+    slug, and records the user's vote.
+    """
+    election = Election.get_current_or_404(slug)
+    if slug:
+        success_url = reverse("django_elect_election_success",
+                              kwargs={'slug': slug})
+    else:
+        success_url = reverse("django_elect_success")
+    # a random token identifying this copy of the vote form, so submitting
+    # it twice (e.g. by double-clicking) isn't treated as voting twice
+    token = request.POST.get('vote_token', '')
+    if not VOTE_TOKEN_RE.match(token):
+        token = uuid4().hex
+    if not election.voting_allowed_for_user(request.user, cached=True) or \
+       (spool.is_enabled() and spool.has_vote(election, request.user)):
+        if request.POST and _is_resubmission(election, request.user, token):
+            return HttpResponseRedirect(success_url)
         # they aren't supposed to be on this page
         return HttpResponseRedirect(settings.LOGIN_URL)
 
     forms = []
     none_selected = False
     data = request.POST or None
-    # fill forms list with Form objects, one for each ballot
+    # fill forms list with Form objects, one for each ballot. The ballots
+    # and candidates are prefetched by the cached election.
     for b in election.ballots.all():
         prefix = "ballot%i" % (b.id)
         if b.type == "Pl":
@@ -89,10 +277,18 @@ def vote(request):
     if request.POST and all(x.is_valid() for x in forms):
         #all forms valid, so save unless no candidates were selected
         if any(f.has_candidates() for f in forms):
-            vote = election.create_vote(request.user)
-            for f in forms:
-                f.save(vote)
-            return HttpResponseRedirect(reverse("django_elect_success"))
+            try:
+                if spool.is_enabled():
+                    # the vote is stored later by drain_vote_spool
+                    spool.enqueue(election, request.user, forms, token)
+                else:
+                    save_vote_forms(election, request.user, forms, token)
+            except VotingNotAllowedException:
+                # they voted in another request since the check above, which
+                # is fine if it was the same form
+                if not _is_resubmission(election, request.user, token):
+                    return HttpResponseRedirect(settings.LOGIN_URL)
+            return HttpResponseRedirect(success_url)
         else:
             # they must not have selected any candidates, so show an error
             none_selected = True
@@ -103,8 +299,58 @@ def vote(request):
         'election': election,
         'forms': forms,
         'none_selected': none_selected,
+        'vote_token': token,
     }, context_instance=RequestContext(request))
 
 
-def success(request):
-    return render_to_response('django_elect/success.html')
+def _is_resubmission(election, account, token):
+    """
+    Returns True if the given account's vote was submitted with the given
+    idempotency token before.
+    """
+    if spool.is_enabled() and spool.has_vote(election, account, token):
+        return True
+    return election.has_vote_with_token(account, token)
+
+
+@lru_cache.lru_cache()
+def _get_success_page():
+    """
+    Returns the rendered success page and its ETag. The page doesn't change,
+    so it's only rendered once per process.
+    """
+    content = render_to_string('django_elect/success.html')
+    return content, md5(content.encode('utf-8')).hexdigest()
+
+
+@condition(etag_func=lambda request, slug=None: _get_success_page()[1])
+def success(request, slug=None):
+    return HttpResponse(_get_success_page()[0])
+
+
+@login_required
+def open_elections(request):
+    """
+    Lists the elections that the user can vote in now.
+    """
+    return render_to_response('django_elect/open_elections.html', {
+        'current_tab': 'election',
+        'elections': Election.get_open_for_user(request.user),
+    }, context_instance=RequestContext(request))
+
+
+@never_cache
+def metrics(request):
+    """
+    Exports the measurements recorded by
+    django_elect.instrumentation.InstrumentationMiddleware in the Prometheus
+    text format. Only staff members can see them, or requests with an
+    "Authorization: Bearer" header containing DJANGO_ELECT_METRICS_TOKEN.
+    """
+    token = settings.DJANGO_ELECT_METRICS_TOKEN
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    if not (token and constant_time_compare(header, "Bearer " + token)) \
+       and not (request.user.is_active and request.user.is_staff):
+        return HttpResponseForbidden()
+    return HttpResponse(instrumentation.format_metrics(),
+                        content_type='text/plain; version=0.0.4')